@@ -57,3 +57,27 @@ def test_init_db(path_isfile_retval, check_dbv_retval, path_is_dbc_path):
             ])
         assert res == m_sl3.connect.return_value
         assert res.isolation_level is None
+
+
+def test_convert_hashes_to_binary():
+    """test that text hashes become binary and duplicates of binary hashes are dropped."""
+    import sqlite3
+    from version.database import db
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute(db.hashes_sql())
+    rows = [
+        ('aa' * 20, 0),
+        (bytes.fromhex('aa' * 20), 0), # already converted
+        ('bb' * 20, 1),
+        ('BB' * 20, 2),
+        ('not a hash', 3),
+    ]
+    conn.executemany('INSERT INTO hashes(hash, series_id, chapter_id, page) VALUES(?, 1, 1, ?)', rows)
+    db.convert_hashes_to_binary(conn)
+    res = conn.execute('SELECT hash, page FROM hashes ORDER BY page').fetchall()
+    assert [(r['hash'], r['page']) for r in res] == [
+        (bytes.fromhex('aa' * 20), 0),
+        (bytes.fromhex('bb' * 20), 1),
+        (bytes.fromhex('bb' * 20), 2),
+    ]
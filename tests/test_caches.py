@@ -0,0 +1,81 @@
+"""test caches module."""
+import os
+from unittest import mock
+
+import pytest
+
+from version.caches import ResponseCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    """response cache in its own file."""
+    return ResponseCache(str(tmpdir.join('cache.db')))
+
+
+@pytest.mark.parametrize('negative, age, expected', [
+    (False, 50, ['hit']),
+    (False, 150, None),
+    (True, 5, ['hit']),
+    (True, 50, None),
+])
+def test_response_cache_ttl(cache, negative, age, expected):
+    """test that entries expire after ttl and negative entries after negative_ttl."""
+    with mock.patch('version.caches.time.time', return_value=1000):
+        cache.put('source', 'key', ['hit'], negative)
+    with mock.patch('version.caches.time.time', return_value=1000 + age):
+        assert cache.get('source', 'key', 100, 10) == expected
+
+
+def test_response_cache_clear(cache):
+    """test that sources are kept apart and can be cleared separately."""
+    cache.put('a', 'key', 1)
+    cache.put('b', 'key', 2)
+    assert (cache.get('a', 'key', 100, 100), cache.get('b', 'key', 100, 100)) == (1, 2)
+    cache.clear('a')
+    assert (cache.get('a', 'key', 100, 100), cache.get('b', 'key', 100, 100)) == (None, 2)
+    cache.clear()
+    assert cache.get('b', 'key', 100, 100) is None
+
+
+@pytest.mark.parametrize('evict_every, expected', [
+    (1, [None, None, 2, 3, 4]),
+    (100, [0, 1, 2, 3, 4]),
+])
+def test_response_cache_size(cache, evict_every, expected):
+    """test that the oldest entries are dropped above size when the size is checked."""
+    cache._EVICT_EVERY = evict_every
+    for n in range(5):
+        with mock.patch('version.caches.time.time', return_value=1000 + n):
+            cache.put('source', n, n, size=3)
+    with mock.patch('version.caches.time.time', return_value=1005):
+        assert [cache.get('source', n, 100, 100) for n in range(5)] == expected
+
+
+def test_scan_snapshot_invalidate(tmpdir):
+    """test that an entry and the entries containing it are examined again after invalidate."""
+    from version.caches import ScanSnapshotCache
+    snapshot = ScanSnapshotCache(str(tmpdir.join('cache.db')))
+    root = str(tmpdir.join('root'))
+    stamps = [(os.path.join(root, name), (1.0, 1)) for name in ['a', 'ab', 'b.zip']]
+    snapshot.update(root, stamps)
+    assert snapshot.changed(root, stamps) == []
+    snapshot.invalidate(os.path.join(root, 'a', 'chapter'))
+    assert snapshot.changed(root, stamps) == [stamps[0][0]]
+    snapshot.invalidate(stamps[2][0])
+    assert snapshot.changed(root, stamps) == [stamps[0][0], stamps[2][0]]
+
+
+def test_tree_stamp(tmpdir):
+    """test that folders added below a directory change its stamp."""
+    from version.caches import tree_stamp
+    gallery = tmpdir.mkdir('gallery')
+    gallery.join('1.jpg').write('img')
+    chapter = gallery.mkdir('chapter')
+    os.utime(str(gallery), (1000, 1000))
+    os.utime(str(chapter), (1000, 1000))
+    stamp = tree_stamp(str(gallery))
+    assert stamp == (1000, 2)
+    chapter.mkdir('nested')
+    assert tree_stamp(str(gallery))[0] > stamp[0]
+    assert tree_stamp(str(tmpdir.join('missing'))) is None
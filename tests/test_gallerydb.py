@@ -0,0 +1,81 @@
+"""test gallerydb module."""
+import os
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from version import gallerydb
+
+
+@pytest.fixture
+def hash_db():
+    """in-memory DB used by the DB classes, returns a function to add hashes to a gallery."""
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.isolation_level = None
+    conn.executescript(gallerydb.db.STRUCTURE_SCRIPT)
+    old_conn = gallerydb.DBBase._DB_CONN
+    gallerydb.DBBase._DB_CONN = conn
+
+    def add_hashes(g_id, hashes):
+        conn.execute('INSERT OR IGNORE INTO series(series_id, title) VALUES(?, ?)', (g_id, str(g_id)))
+        conn.execute('INSERT OR IGNORE INTO chapters(chapter_id, series_id, chapter_number) VALUES(?, ?, 0)',
+                     (g_id, g_id))
+        conn.executemany('INSERT INTO hashes(hash, series_id, chapter_id, page) VALUES(?, ?, ?, ?)',
+                         [(bytes.fromhex(h), g_id, g_id, n) for n, h in enumerate(hashes)])
+    yield add_hashes
+    gallerydb.DBBase._DB_CONN = old_conn
+    conn.close()
+
+
+@pytest.mark.parametrize('max_vars', [900, 1])
+def test_hash_db_find_gallery(hash_db, max_vars, monkeypatch):
+    """test that hashes are ranked per gallery and only a gallery with all of them is found."""
+    monkeypatch.setattr(gallerydb.HashDB, '_MAX_VARS', max_vars)
+    hash_db(1, ['aa', 'bb'])
+    hash_db(2, ['aa', 'bb', 'cc'])
+    hash_db(3, ['dd'])
+    assert gallerydb.HashDB.find_galleries(['aa', 'bb', 'cc', 'cc']) == [(2, 3), (1, 2)]
+    assert gallerydb.HashDB.find_gallery(['aa', 'bb', 'cc']).id == 2
+    assert gallerydb.HashDB.find_gallery([bytes.fromhex('dd')]).id == 3
+    # every hash is known, but no gallery has all of them
+    assert gallerydb.HashDB.find_gallery(['cc', 'dd']) is None
+    assert gallerydb.HashDB.find_gallery(['ee']) is None
+
+
+@pytest.mark.parametrize('galleries, expected', [
+    # each bucket member joining later is shown with one which was found before
+    ([(1, 'a', '1'), (2, 'A ', '2'), (3, 'a', '3'), (4, 'a', '4')], [(1, 2), (1, 3), (1, 4)]),
+    # a gallery in two buckets is only yielded again to go with a new one
+    ([(1, 'a', '1'), (2, 'a', '2'), (3, 'b', '2'), (4, 'c', '4')], [(1, 2), (2, 3)]),
+    ([(1, 'a', '1'), (2, 'b', '1'), (3, 'a', '3')], [(1, 2), (1, 3)]),
+    ([(1, 'a', '1'), (2, 'b', '2')], []),
+])
+def test_duplicate_finder_buckets(galleries, expected):
+    """test that title and path buckets never yield a gallery without something to compare with."""
+    galleries = [SimpleNamespace(id=g_id, title=title, path=path) for g_id, title, path in galleries]
+    found = list(gallerydb.DuplicateFinder().find(galleries))
+    assert [tuple(g.id for g in f) for f in found] == expected
+
+
+def test_gallery_path_index():
+    """test lookups as galleries are added, moved and removed, with paths of different case."""
+    index = gallerydb.GalleryPathIndex()
+    new = SimpleNamespace(id=None, path='/a/Gallery')
+    added = SimpleNamespace(id=1, path='/a/Gallery')
+    index.add(new)
+    index.add(added)
+    assert index.get(os.path.normcase('/a/Gallery')) is new
+    assert index.get_id('/a/Gallery') == 1
+    added.path = '/b/Gallery'
+    index.move(added, '/a/Gallery')
+    assert (index.get_id('/a/Gallery'), index.get_id('/b/Gallery')) == (None, 1)
+    index.move(added, '/c/not indexed')
+    assert index.get('/b/Gallery') is added
+    index.remove(new)
+    assert '/a/Gallery' not in index
+    assert len(index) == 1
+    index.remove(added)
+    assert index.get('/b/Gallery') is None
+    assert len(index) == 0
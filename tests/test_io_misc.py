@@ -0,0 +1,98 @@
+"""test io_misc module."""
+import os
+
+import pytest
+
+pytest.importorskip('watchdog')
+
+
+@pytest.mark.parametrize('format', [1, 2])
+def test_gallery_imp_exp_round_trip(tmpdir, format):
+    """test that galleries and lists read back the same in both export formats."""
+    from version.io_misc import GalleryImpExpData
+    first = {'pages': 10, '0': 'aa', '5': 'bb'}
+    other = {'pages': 3, '1': 'cc'}
+    exp = GalleryImpExpData(format)
+    exp.open(str(tmpdir), galleries=2, lists=1)
+    exp.add_gallery('1', {'title': 'First', 'identifier': first})
+    exp.add_gallery('2', {'title': 'Second', 'identifier': {'pages': 1, '0': 'dd'}})
+    exp.add_list('5', {'name': 'List'}, {'1': first, '3': other})
+    exp.close()
+
+    path = tmpdir.listdir()
+    assert len(path) == 1
+    header, records = GalleryImpExpData.read(str(path[0]))
+    assert (header['galleries'], header['lists']) == (2, 1)
+    records = list(records)
+    assert [r[:2] for r in records] == [('gallery', '1'), ('gallery', '2'), ('list', '5')]
+    assert records[0][2] == {'title': 'First', 'identifier': first}
+    l_data = records[2][2]
+    assert l_data['name'] == 'List'
+    if format == GalleryImpExpData.STREAM_FORMAT:
+        # galleries already written are only referenced by id
+        assert l_data['galleries'] == {'1': None, '3': {'1': 'cc'}}
+    else:
+        assert l_data['galleries'] == {'1': {'0': 'aa', '5': 'bb'}, '3': {'1': 'cc'}}
+
+
+@pytest.mark.parametrize('events, expected', [
+    # files created below a pending created folder are looked at with it
+    ([('created', 'a'), ('created', 'a/1.jpg')], [('created', 'a', None)]),
+    # a created path which is moved before settling is only looked at in its new location
+    ([('created', 'a'), ('moved', 'a', 'b')], [('created', 'b', None)]),
+    ([('created', 'a'), ('deleted', 'a')], []),
+    # a pending move or delete is kept and the path created again is looked at after it
+    ([('moved', 'a', 'b'), ('created', 'a')], [('moved', 'a', 'b'), ('created', 'a', None)]),
+    ([('deleted', 'a'), ('created', 'a')], [('deleted', 'a', None), ('created', 'a', None)]),
+    ([('deleted', 'a'), ('created', 'a'), ('deleted', 'a')], [('deleted', 'a', None)]),
+    ([('deleted', 'a'), ('created', 'a'), ('moved', 'a', 'b')],
+     [('deleted', 'a', None), ('created', 'b', None)]),
+])
+def test_watcher_event_queue(tmpdir, events, expected):
+    """test how events at the same path are merged and in which order they settle."""
+    import threading
+    import time
+    from version.io_misc import WatcherEventQueue
+    root = str(tmpdir)
+    settled_events = []
+    settled = threading.Event()
+
+    def on_settle(batch):
+        settled_events.extend([(kind, os.path.relpath(path, root).replace(os.sep, '/'),
+                         dest and os.path.relpath(dest, root).replace(os.sep, '/'))
+                        for kind, path, dest, _ in batch])
+        settled.set()
+
+    q = WatcherEventQueue(on_settle, quiet=0.05)
+    for kind, path, *dest in events:
+        q.add(kind, os.path.join(root, path), *[os.path.join(root, d) for d in dest])
+    deadline = time.monotonic() + 2
+    while len(settled_events) < len(expected) and time.monotonic() < deadline:
+        settled.wait(0.1)
+        settled.clear()
+    time.sleep(0.2) # nothing else should settle
+    assert settled_events == expected
+
+
+@pytest.mark.parametrize('old, new, expected', [
+    # only the top of a new or removed tree is reported
+    ({}, {'a': (1, 2), 'a/b': (1, 1), 'a/b/1.zip': (1, 10)}, [('DirCreatedEvent', 'a', None)]),
+    ({'a': (1, 2), 'a/1.zip': (1, 10)}, {}, [('DirDeletedEvent', 'a', None)]),
+    # entries which disappear and appear with the same stamp were moved
+    ({'a': (1, 2)}, {'b': (1, 2)}, [('DirMovedEvent', 'a', 'b')]),
+    ({'1.zip': (1, 10)}, {'2.zip': (1, 10)}, [('FileMovedEvent', '1.zip', '2.zip')]),
+    # an archive and a folder are never taken for each other
+    ({'1.zip': (1, 2)}, {'b': (1, 2)}, [('FileDeletedEvent', '1.zip', None), ('DirCreatedEvent', 'b', None)]),
+    # ambiguous moves are reported as deleted and created
+    ({'a': (1, 2)}, {'b': (1, 2), 'c': (1, 2)},
+     [('DirDeletedEvent', 'a', None), ('DirCreatedEvent', 'b', None), ('DirCreatedEvent', 'c', None)]),
+    ({'a': (1, 2), 'a/1.zip': (1, 10)}, {'a': (2, 2), 'a/1.zip': (1, 11)},
+     [('DirModifiedEvent', 'a', None), ('FileModifiedEvent', 'a/1.zip', None)]),
+])
+def test_gallery_poller_diff(old, new, expected):
+    """test which events describe the differences between two snapshots."""
+    from version.io_misc import GalleryPoller
+    poller = GalleryPoller(None, '')
+    events = [(type(e).__name__, e.src_path, getattr(e, 'dest_path', None) or None)
+              for e in poller._diff(old, new)]
+    assert sorted(events) == sorted(expected)
@@ -0,0 +1,81 @@
+"""test pewnet module."""
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('bs4')
+pytest.importorskip('robobrowser')
+
+
+@pytest.mark.parametrize('burst, expected', [
+    (1, [0, 2, 4]),
+    (2, [0, 0, 2]),
+])
+def test_rate_limiter_acquire(burst, expected):
+    """test that requests past the burst wait for their slot and hosts don't share buckets."""
+    from version.pewnet import RateLimiter
+    limiter = RateLimiter()
+    with mock.patch('version.pewnet.time') as mock_time, \
+            mock.patch('version.pewnet.app_constants.GLOBAL_EHEN_TIME', 2), \
+            mock.patch('version.pewnet.app_constants.HEN_RATE_BURST', burst), \
+            mock.patch('version.pewnet.app_constants.HEN_RATE_JITTER', 0):
+        mock_time.monotonic.return_value = 100
+        waits = [limiter.acquire('https://e-hentai.org/?f_shash={}'.format(n)) for n in range(3)]
+        assert waits == expected
+        assert limiter.acquire('https://exhentai.org/') == 0
+        assert mock_time.sleep.mock_calls == [mock.call(w) for w in expected if w]
+    assert limiter.in_flight('https://e-hentai.org/') == 3
+    assert limiter.in_flight() == 4
+    limiter.release('https://e-hentai.org/')
+    assert limiter.in_flight('https://e-hentai.org/') == 2
+    stats = limiter.stats()['https://e-hentai.org']
+    assert (stats['requests'], stats['waited'], stats['max_wait']) == (3, sum(expected), max(expected))
+
+
+def test_rate_limiter_throttle():
+    """test that a throttled host waits out the delay and other hosts don't."""
+    from version.pewnet import RateLimiter
+    limiter = RateLimiter()
+    with mock.patch('version.pewnet.time') as mock_time, \
+            mock.patch('version.pewnet.app_constants.GLOBAL_EHEN_TIME', 2), \
+            mock.patch('version.pewnet.app_constants.HEN_RATE_BURST', 3), \
+            mock.patch('version.pewnet.app_constants.HEN_RATE_JITTER', 0):
+        mock_time.monotonic.return_value = 100
+        limiter.throttle('https://e-hentai.org/', 10)
+        assert limiter.acquire('https://e-hentai.org/') == 12
+        assert limiter.acquire('https://exhentai.org/') == 0
+
+
+@pytest.mark.parametrize('method, statuses, expected', [
+    ('GET', [429, 200], 200),
+    ('GET', [200], 200),
+    # non-idempotent requests are never sent twice
+    ('POST', [429, 200], 429),
+])
+def test_session_manager_request(method, statuses, expected):
+    """test that cookies get their own session and 429 responses go through the limiter."""
+    from version.pewnet import SessionManager
+    sessions = SessionManager()
+    with mock.patch('version.pewnet.requests.Session') as mock_session, \
+            mock.patch('version.pewnet.LIMITER') as mock_limiter:
+        mock_session.side_effect = lambda: mock.MagicMock()
+        plain = sessions.session('https://e-hentai.org/g/1/')
+        assert sessions.session('https://e-hentai.org/g/2/') is plain
+        cookied = sessions.session('https://e-hentai.org/', {'ipb_member_id': '1'})
+        assert cookied is not plain
+        cookied.cookies.update.assert_called_once_with({'ipb_member_id': '1'})
+        plain.cookies.update.assert_not_called()
+
+        cookied.request.side_effect = [mock.Mock(status_code=s, headers={'Retry-After': '5'})
+                                       for s in statuses]
+        r = sessions.request(method, 'https://e-hentai.org/', cookies={'ipb_member_id': '1'})
+        assert r.status_code == expected
+        plain.request.assert_not_called()
+        if statuses[0] == 429:
+            mock_limiter.throttle.assert_called_once_with('https://e-hentai.org/', 5)
+        else:
+            mock_limiter.throttle.assert_not_called()
+        assert mock_limiter.acquire.call_count == mock_limiter.release.call_count
+    sent = len(statuses) if method == 'GET' else 1
+    assert sessions.stats()['https://e-hentai.org']['requests'] == sent
@@ -1,4 +1,5 @@
 """test utils module."""
+import os
 from unittest import mock
 from itertools import product
 
@@ -62,3 +63,130 @@ def test_run_backup_database(mock_exists_retval, mock_isdir_retval):
         else:
             mock_os.mkdir.assert_called_once_with(mock_os.path.join.return_value)
         mock_os.assert_has_calls(os_calls, any_order=True)
+
+
+def test_archive_file_tree_index(tmpdir):
+    """test directory lookups answered from the archive tree index."""
+    import zipfile
+    from version.utils import ArchiveFile, ArchivePool
+    path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(path, 'w') as z:
+        for name in ['1.jpg', 'a/', 'a/1.jpg', 'a/b/', 'a/b/1.jpg', 'ab/', 'ab/1.jpg']:
+            z.writestr(name, b'' if name.endswith('/') else b'img')
+    pool = ArchivePool(2)
+    archive = pool.get(path)
+    assert isinstance(archive, ArchiveFile)
+    assert archive.dir_list() == ['a/', 'a/b/', 'ab/']
+    assert archive.dir_list(True) == ['a/', 'ab/']
+    assert archive.dir_contents('') == ['1.jpg', 'a/', 'ab/']
+    assert archive.dir_contents('a/') == ['a/1.jpg', 'a/b/']
+    assert archive.is_dir('a/b/')
+    assert not archive.is_dir('a/1.jpg')
+    archive.close()
+    assert pool.get(path) is archive
+    archive.close()
+    pool.clear()
+    assert pool.get(path) is not archive
+
+
+@pytest.mark.parametrize('title, expected', [
+    ('[Artist] Title [English]', ('Title', 'Artist', 'English')),
+    ('[Artist] Title.zip', ('Title', 'Artist', 'English')),
+    ('path/to/[Artist] Title [japanese]', ('Title', 'Artist', 'Japanese')),
+    ('Title', ('Title', '', '')),
+])
+def test_title_normalizer(title, expected):
+    """test title parsing and that memoized results are not shared."""
+    from version.utils import TitleNormalizer
+    normalizer = TitleNormalizer()
+    parsed = normalizer.parse_title(title)
+    assert (parsed['title'], parsed['artist'], parsed['language']) == expected
+    parsed['title'] = 'changed'
+    assert normalizer.parse_title(title)['title'] == expected[0]
+
+
+@pytest.mark.parametrize('names, chapter_path', [
+    (['ch/', 'ch/1.jpg', 'ch/2.jpg', 'ch/sub/', 'ch/sub/3.jpg'], 'ch/'),
+    # no pages in the top folder of the chapter
+    (['ch/', 'ch/sub/', 'ch/sub/1.jpg', 'ch/sub/2.jpg'], 'ch/'),
+    (['sub/', 'sub/1.jpg'], ''),
+])
+def test_extraction_cache_extract(tmpdir, names, chapter_path):
+    """test that the returned chapter exists, is completed in the background and reused."""
+    import zipfile
+    from version.utils import ExtractionCache
+    path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(path, 'w') as z:
+        for name in names:
+            z.writestr(name, b'' if name.endswith('/') else b'img')
+    cache = ExtractionCache()
+    with mock.patch('version.utils.app_constants.temp_dir', str(tmpdir.join('temp'))), \
+            mock.patch('version.utils.TEMP_MANAGER'):
+        chapter = cache.extract(path, chapter_path)
+        assert os.listdir(chapter)
+        cache.wait(path, chapter_path, timeout=5)
+        extracted = sorted(os.path.relpath(os.path.join(d, f), chapter).replace(os.sep, '/')
+                           for d, _, fs in os.walk(chapter) for f in fs)
+        assert extracted == sorted(n[len(chapter_path):] for n in names if not n.endswith('/'))
+        assert cache.extract(path, chapter_path) == chapter
+        assert cache.total_size == 3 * len(extracted)
+
+
+def test_temp_manager(tmpdir):
+    """test that least recently used folders are evicted above the cap and purge keeps handed out ones."""
+    from version.utils import TempManager
+    manager = TempManager()
+    manager.cap = 10
+    with mock.patch('version.utils.app_constants.temp_dir', str(tmpdir)):
+        first, second, third = [manager.allocate() for x in range(3)]
+        for folder in (first, second):
+            with open(os.path.join(folder, 'page.jpg'), 'wb') as f:
+                f.write(b'123456')
+        manager.account(os.path.join(first, 'page.jpg'))
+        manager.touch(third)
+        manager.account(os.path.join(second, 'page.jpg'))
+        assert manager.total_size == 6
+        tmpdir.join('stray').write('left behind')
+        manager.purge()
+        manager._queue.join()
+        assert sorted(os.listdir(str(tmpdir))) == sorted(os.path.basename(p) for p in (second, third))
+        with manager.scoped() as path:
+            assert os.path.isdir(path)
+        manager._queue.join()
+        assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('values, value, max_distance, expected', [
+    ([0b0000, 0b0001, 0b0011, 0b1111], 0b0000, 1, [(0, 0b0000), (1, 0b0001)]),
+    ([0b0000, 0b0001, 0b0011, 0b1111], 0b0111, 1, [(1, 0b0011), (1, 0b1111)]),
+    ([0b0000, 0b0000, 0b1111], 0b0000, 0, [(0, 0b0000), (0, 0b0000)]),
+    ([], 0b0000, 4, []),
+])
+def test_bk_tree_search(values, value, max_distance, expected):
+    """test that exactly the values within the distance are found."""
+    from version.utils import BKTree
+    tree = BKTree()
+    for v in values:
+        tree.add(v, v)
+    assert sorted(tree.search(value, max_distance)) == expected
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_image_dhash(tmpdir, use_numpy):
+    """test that similar images get close hashes and different ones don't."""
+    Image = pytest.importorskip('PIL.Image')
+    from version import utils
+    if use_numpy and not utils.numpy:
+        pytest.skip('numpy is not installed')
+    gradient = Image.new('L', (64, 64))
+    gradient.putdata([x * 4 for y in range(64) for x in range(64)])
+    paths = []
+    for n, im in enumerate([gradient, gradient.point(lambda p: p // 2 + 20),
+                            gradient.transpose(Image.FLIP_LEFT_RIGHT)]):
+        paths.append(str(tmpdir.join('{}.png'.format(n))))
+        im.save(paths[-1])
+    with mock.patch('version.utils.numpy', utils.numpy if use_numpy else None):
+        hashes = [utils.image_dhash(p) for p in paths]
+    assert hashes[0] == 2 ** 64 - 1 # every pixel is brighter than the one left of it
+    assert utils.hamming_distance(hashes[0], hashes[1]) <= 4
+    assert utils.hamming_distance(hashes[0], hashes[2]) > 32
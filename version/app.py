@@ -13,6 +13,7 @@
 #"""
 
 import sys
+import time
 import logging
 import os
 import threading
@@ -35,7 +36,7 @@ from PyQt5.QtWidgets import (QMainWindow, QListView,
                              QListWidget, QListWidgetItem, QToolTip,
                              QProgressBar, QToolButton, QSystemTrayIcon,
                              QShortcut, QGraphicsBlurEffect, QTableWidget,
-                             QTableWidgetItem, QActionGroup)
+                             QTableWidgetItem, QActionGroup, QApplication)
 
 from executors import Executors
 
@@ -50,6 +51,7 @@ import gallerydb
 import settings
 import pewnet
 import utils
+import caches
 import misc_db
 import database
 
@@ -85,6 +87,8 @@ class AppWindow(QMainWindow):
         self._db_startup_thread.start()
         self.db_startup.moveToThread(self._db_startup_thread)
         self.db_startup.DONE.connect(lambda: self.scan_for_new_galleries() if app_constants.LOOK_NEW_GALLERY_STARTUP else None)
+        self.db_startup.DONE.connect(self.start_hash_backfill)
+        QApplication.instance().installEventFilter(self)
         self.db_startup_invoker.connect(self.db_startup.startup)
         self.setAcceptDrops(True)
         self.initUI()
@@ -101,6 +105,34 @@ class AppWindow(QMainWindow):
         next_view = QShortcut(QKeySequence(QKeySequence.NextChild), self, self.switch_display)
         help = QShortcut(QKeySequence(QKeySequence.HelpContents), self, lambda:utils.open_web_link("https://github.com/Pewpews/happypanda/wiki"))
 
+    def eventFilter(self, source, event):
+        if event.type() in (QEvent.KeyPress, QEvent.MouseButtonPress, QEvent.Wheel):
+            app_constants.LAST_USER_ACTIVITY = time.time()
+        return super().eventFilter(source, event)
+
+    def hash_backfill_progress(self, done, total):
+        if done % 10 == 0 or done == total:
+            txt = "Hashing library: {}/{}".format(done, total)
+            log_i(txt)
+            app_constants.STAT_MSG_METHOD(txt)
+
+    def save_hash_backfill_position(self, position):
+        settings.set(position, 'Application', 'hash backfill position')
+        settings.save()
+
+    def start_hash_backfill(self):
+        if not app_constants.HASH_BACKFILL:
+            return
+        thread = QThread(self)
+        thread.finished.connect(thread.deleteLater)
+        self.hash_backfill = gallerydb.HashBackfill(app_constants.HASH_BACKFILL_POSITION)
+        self.hash_backfill.moveToThread(thread)
+        self.hash_backfill.PROGRESS.connect(self.hash_backfill_progress)
+        self.hash_backfill.POSITION.connect(self.save_hash_backfill_position)
+        self.hash_backfill.DONE.connect(thread.quit)
+        thread.started.connect(self.hash_backfill.start)
+        thread.start()
+
     def check_site_logins(self):
         # checking logins
         # need to do this to avoid settings dialog locking up
@@ -137,8 +169,8 @@ class AppWindow(QMainWindow):
                 log_e('Could not find gallery to update from watcher')
             self.default_manga_view.replace_gallery(g, False)
 
-        def created(path):
-            self.gallery_populate([path])
+        def created(paths):
+            self.gallery_populate(paths)
 
         def modified(path, gallery):
             mod_popup = io_misc.ModifiedPopup(path, gallery, self)
@@ -564,11 +596,21 @@ class AppWindow(QMainWindow):
         scan_galleries_action.setStatusTip('Scan monitored folders for new galleries')
         scan_galleries_action.setShortcut(scan_galleries_k)
         gallery_menu.addAction(scan_galleries_action)
+        full_scan_action = QAction('Rescan all monitored folders', self)
+        full_scan_action.setIcon(app_constants.SPINNER_ICON)
+        full_scan_action.triggered.connect(lambda: self.scan_for_new_galleries(True))
+        full_scan_action.setStatusTip('Scan monitored folders including the content which did not change since the last scan')
+        gallery_menu.addAction(full_scan_action)
 
         duplicate_check_simple = QAction("Check for duplicate galleries", self)
         duplicate_check_simple.setIcon(app_constants.DUPLICATE_ICON)
         duplicate_check_simple.triggered.connect(lambda: self.duplicate_check()) # triggered emits False
         gallery_menu.addAction(duplicate_check_simple)
+        duplicate_check_advanced = QAction("Check for duplicate galleries (compare pages)", self)
+        duplicate_check_advanced.setIcon(app_constants.DUPLICATE_ICON)
+        duplicate_check_advanced.setStatusTip('Also finds galleries with the same or mostly the same pages')
+        duplicate_check_advanced.triggered.connect(lambda: self.duplicate_check(False))
+        gallery_menu.addAction(duplicate_check_advanced)
 
         self.toolbar.addWidget(gallery_action)
 
@@ -909,8 +951,8 @@ class AppWindow(QMainWindow):
             def a_progress(prog):
                 fetch_spinner.set_text("Populating... {}/{}".format(prog, self._g_populate_count))
 
-            def add_to_model(gallery):
-                self.addition_tab.view.add_gallery(gallery, app_constants.KEEP_ADDED_GALLERIES)
+            def add_to_model(galleries):
+                self.addition_tab.view.add_gallery(galleries, app_constants.KEEP_ADDED_GALLERIES)
 
             def set_count(c):
                 self._g_populate_count = c
@@ -918,7 +960,7 @@ class AppWindow(QMainWindow):
             self.g_populate_inst.moveToThread(data_thread)
             self.g_populate_inst.PROGRESS.connect(a_progress)
             self.g_populate_inst.DATA_COUNT.connect(set_count)
-            self.g_populate_inst.LOCAL_EMITTER.connect(add_to_model)
+            self.g_populate_inst.LOCAL_BATCH_EMITTER.connect(add_to_model)
             self.g_populate_inst.FINISHED.connect(finished)
             self.g_populate_inst.FINISHED.connect(self.g_populate_inst.deleteLater)
             self.g_populate_inst.SKIPPED.connect(skipped_gs)
@@ -928,7 +970,11 @@ class AppWindow(QMainWindow):
             #self.g_populate_inst.local()
             log_i('Populating DB from directory/archive')
 
-    def scan_for_new_galleries(self):
+    def scan_for_new_galleries(self, full=False):
+        """
+        Looks for new galleries in the monitored folders.
+        Only entries which changed since the last scan are examined unless full is True
+        """
         available_folders = app_constants.ENABLE_MONITOR and \
                                     app_constants.MONITOR_PATHS and all(app_constants.MONITOR_PATHS)
         if available_folders and not app_constants.SCANNING_FOR_GALLERIES:
@@ -939,10 +985,11 @@ class AppWindow(QMainWindow):
                 class ScanDir(QObject):
                     finished = pyqtSignal()
                     fetch_inst = fetch.Fetch(self)
-                    def __init__(self, addition_view, addition_tab, parent=None):
+                    def __init__(self, addition_view, addition_tab, full, parent=None):
                         super().__init__(parent)
                         self.addition_view = addition_view
                         self.addition_tab = addition_tab
+                        self.full = full
                         self._switched = False
 
                     def switch_tab(self):
@@ -952,18 +999,40 @@ class AppWindow(QMainWindow):
 
                     def scan_dirs(self):
                         paths = []
+                        snapshots = {}
+                        examined = 0
                         for p in app_constants.MONITOR_PATHS:
                             if os.path.exists(p):
                                 dir_content = scandir.scandir(p)
-                                for d in dir_content:
-                                    paths.append(d.path)
+                                stamps = [(d.path, caches.tree_stamp(d.path)) for d in dir_content]
+                                snapshots[p] = stamps
+                                examined += len(stamps)
+                                if self.full:
+                                    paths.extend(x[0] for x in stamps)
+                                else:
+                                    paths.extend(caches.SCAN_SNAPSHOT.changed(p, stamps))
                             else:
                                 log_e("Monitored path does not exists: {}".format(p.encode(errors='ignore')))
 
-                        self.fetch_inst.series_path = paths
-                        self.fetch_inst.LOCAL_EMITTER.connect(lambda g:self.addition_view.add_gallery(g, app_constants.KEEP_ADDED_GALLERIES))
-                        self.fetch_inst.LOCAL_EMITTER.connect(self.switch_tab)
-                        self.fetch_inst.local()
+                        log_i('Scan: {} changed paths, {} unchanged paths skipped'.format(len(paths), examined - len(paths)))
+                        pending = [] # galleries neither added to nor rejected from the DB
+                        if paths:
+                            self.fetch_inst.series_path = paths
+                            self.fetch_inst.LOCAL_BATCH_EMITTER.connect(lambda gs:self.addition_view.add_gallery(gs, app_constants.KEEP_ADDED_GALLERIES))
+                            self.fetch_inst.LOCAL_BATCH_EMITTER.connect(self.switch_tab)
+                            self.fetch_inst.local()
+                            if not app_constants.KEEP_ADDED_GALLERIES:
+                                pending.extend(g.path for g in self.fetch_inst._data)
+                            pending.extend(s[0] for s in self.fetch_inst.skipped_paths if s[1] == 'Error creating archive')
+                        pending = [os.path.normcase(x) for x in pending]
+
+                        def is_pending(path):
+                            path = os.path.normcase(path)
+                            return any(x == path or x.startswith(path + os.sep) for x in pending)
+
+                        # pending entries are left out so the next scan examines them again
+                        for p in snapshots:
+                            caches.SCAN_SNAPSHOT.update(p, [s for s in snapshots[p] if not is_pending(s[0])])
                         #contents = []
                         #for g in self.scanned_data:
                         #	contents.append(g)
@@ -989,7 +1058,7 @@ class AppWindow(QMainWindow):
                 new_gall_spinner.show()
 
                 thread = QThread(self)
-                self.scan_inst = ScanDir(self.addition_tab.view, self.addition_tab)
+                self.scan_inst = ScanDir(self.addition_tab.view, self.addition_tab, full)
                 self.scan_inst.moveToThread(thread)
                 self.scan_inst.finished.connect(finished)
                 self.scan_inst.finished.connect(new_gall_spinner.before_hide)
@@ -1073,16 +1142,21 @@ class AppWindow(QMainWindow):
         # settings
         settings.set(self.manga_list_view.current_sort, 'General', 'current sort')
         settings.set(app_constants.IGNORE_PATHS, 'Application', 'ignore paths')
+        try:
+            self.hash_backfill.stop()
+            settings.set(self.hash_backfill.position, 'Application', 'hash backfill position')
+        except AttributeError:
+            pass
         if not self.isMaximized():
             settings.win_save(self, 'AppWindow')
+        else:
+            settings.save()
+
+        utils.ARCHIVE_POOL.clear()
 
         # temp dir
         try:
-            for root, dirs, files in scandir.walk('temp', topdown=False):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-                for name in dirs:
-                    os.rmdir(os.path.join(root, name))
+            utils.TEMP_MANAGER.purge() # whatever isn't removed by now will be on next start
             log_d('Flush temp on exit: OK')
         except:
             log.exception('Flush temp on exit: FAIL')
@@ -1151,23 +1225,23 @@ class AppWindow(QMainWindow):
             def __init__(self):
                 super().__init__()
 
-            def checkSimple(self, model):
-                galleries = model._data
-
-                duplicates = []
-                for n, g in enumerate(galleries, 1):
-                    notifbar.add_text('Checking gallery {}'.format(n))
-                    log_d('Checking gallery {}'.format(g.title.encode(errors="ignore")))
-                    for y in galleries:
-                        title = g.title.strip().lower() == y.title.strip().lower()
-                        path = os.path.normcase(g.path) == os.path.normcase(y.path)
-                        if g.id != y.id and (title or path):
-                            if g not in duplicates:
-                                duplicates.append(y)
-                                duplicates.append(g)
-                                self.found_duplicates.emit((g, y))
+            def check(self, model, advanced=False):
+                galleries = list(model._data)
+                notifbar.add_text('Checking {} galleries'.format(len(galleries)))
+                distance = app_constants.DUPLICATE_PHASH_DISTANCE
+                finder = gallerydb.DuplicateFinder(advanced, app_constants.DUPLICATE_HASH_THRESHOLD / 100,
+                                                   distance if advanced and distance >= 0 else None)
+                for found in finder.find(galleries):
+                    log_d('Found duplicates: {}'.format([g.title for g in found]).encode(errors="ignore"))
+                    self.found_duplicates.emit(found)
                 self.finished.emit()
 
+            def checkSimple(self, model):
+                self.check(model)
+
+            def checkAdvanced(self, model):
+                self.check(model, True)
+
         self._d_checker = DuplicateCheck()
         self._d_checker.moveToThread(app_constants.GENERAL_THREAD)
         self._d_checker.found_duplicates.connect(lambda t: dup_tab.view.add_gallery(t, record_time=True))
@@ -1176,6 +1250,8 @@ class AppWindow(QMainWindow):
         self._d_checker.finished.connect(duplicate_spinner.before_hide)
         if simple:
             self.duplicate_check_invoker.connect(self._d_checker.checkSimple)
+        else:
+            self.duplicate_check_invoker.connect(self._d_checker.checkAdvanced)
         self.duplicate_check_invoker.emit(self.default_manga_view.gallery_model)
 
     def excepthook(self, ex_type, ex, tb):
@@ -122,6 +122,7 @@ SYSTEM_TRAY = None
 NOTIF_BAR = None
 NOTIF_BUBBLE = None
 STAT_MSG_METHOD = None
+LAST_USER_ACTIVITY = 0 # time of last key or mouse press
 GENERAL_THREAD = None
 WHEEL_SCROLL_EFFECT = 10
 DOWNLOAD_MANAGER = None
@@ -195,6 +196,10 @@ OVERRIDE_MONITOR = False # set true to make watchers to ignore next item (will b
 LOOK_NEW_GALLERY_STARTUP = get(True, 'Application', 'look new gallery startup', bool)
 ENABLE_MONITOR = get(True, 'Application', 'enable monitor', bool)
 MONITOR_PATHS = [p for p in get([], 'Application', 'monitor paths', list) if os.path.exists(p)]
+MONITOR_QUIET_PERIOD = get(3.0, 'Application', 'monitor quiet period', float) # in seconds, events are handled when nothing happened for this long
+MONITOR_POLLING = get(False, 'Application', 'monitor polling', bool) # poll monitored folders instead of waiting for events, for network shares
+MONITOR_POLL_INTERVAL = get(60, 'Application', 'monitor poll interval', int) # in seconds
+MONITOR_POLL_WORKERS = get(4, 'Application', 'monitor poll workers', int) # folders listed at the same time when polling
 IGNORE_PATHS = get([], 'Application', 'ignore paths', list)
 IGNORE_EXTS = get([], 'Application', 'ignore exts', list)
 SCANNING_FOR_GALLERIES = False # if a scan for new galleries is being done
@@ -221,6 +226,22 @@ GALLERY_DATA_FIX_REPLACE = get("", 'Advanced', 'gallery data fix replace', str)
 
 EXTERNAL_VIEWER_ARGS = get("{$file}", 'Advanced', 'external viewer args', str)
 
+# Archives
+ARCHIVE_POOL_SIZE = get(8, 'Advanced', 'archive pool size', int) # amount of archives kept open for reuse
+EXTRACTION_CACHE_SIZE = get(1024, 'Advanced', 'extraction cache size', int) # in MB, extracted chapters kept for reuse
+TEMP_DIR_CAP = get(512, 'Advanced', 'temp dir cap', int) # in MB, other temporary files (covers, metafiles..)
+HASH_WORKERS = get(4, 'Advanced', 'hash workers', int) # threads used to hash gallery pages
+LOCAL_SEARCH_WORKERS = get(4, 'Advanced', 'local search workers', int) # paths probed at the same time when adding galleries
+IMPORT_BATCH_SIZE = get(50, 'Advanced', 'import batch size', int) # galleries added to the DB and view at once
+IMPORT_BATCH_INTERVAL = get(1.0, 'Advanced', 'import batch interval', float) # in seconds, max wait before a batch is added
+HASH_BACKFILL = get(True, 'Advanced', 'hash backfill', bool) # hash the library in the background when idle
+HASH_BACKFILL_CPU = get(25, 'Advanced', 'hash backfill cpu', int) # percentage of time spent hashing
+HASH_BACKFILL_IO = get(20, 'Advanced', 'hash backfill io', int) # max MB/s read, 0 for no limit
+HASH_BACKFILL_IDLE = get(10, 'Advanced', 'hash backfill idle', int) # seconds without user input before hashing
+HASH_BACKFILL_POSITION = get(0, 'Application', 'hash backfill position', int)
+DUPLICATE_HASH_THRESHOLD = get(50, 'Advanced', 'duplicate hash threshold', int) # percentage of pages which must be shared
+DUPLICATE_PHASH_DISTANCE = get(6, 'Advanced', 'duplicate phash distance', int) # max bits differing between similar pages, -1 to disable
+
 # Import/Export
 EXPORT_FORMAT = get(1, 'Advanced', 'export format', int)
 EXPORT_PATH = ''
@@ -231,6 +252,8 @@ HASH_GALLERY_PAGES = get('all', 'Advanced', 'hash gallery pages', int, str)
 # WEB
 INCLUDE_EH_EXPUNGED = get(False, 'Web', 'include eh expunged', bool)
 GLOBAL_EHEN_TIME = get(5, 'Web', 'global ehen time offset', int)
+HEN_RATE_BURST = get(1, 'Web', 'hen rate burst', int) # requests allowed back to back before GLOBAL_EHEN_TIME applies
+HEN_RATE_JITTER = get(0.5, 'Web', 'hen rate jitter', float) # max random seconds added to a wait
 GLOBAL_EHEN_LOCK = False
 DEFAULT_EHEN_URL = get('https://e-hentai.org/', 'Web', 'default ehen url', str)
 REPLACE_METADATA = get(False, 'Web', 'replace metadata', bool)
@@ -243,6 +266,12 @@ DOWNLOAD_DIRECTORY = get('downloads', 'Web', 'download directory', str)
 TORRENT_CLIENT = get('', 'Web', 'torrent client', str)
 HEN_LIST = get(['chaikahen'], 'Web', 'hen list', list)
 DOWNLOAD_GALLERY_TO_LIB = get(False, 'Web', 'download galleries to library', bool)
+HTTP_POOL_SIZE = get(10, 'Web', 'http pool size', int) # kept alive connections per host
+HTTP_RETRIES = get(3, 'Web', 'http retries', int)
+HTTP_RETRY_BACKOFF = get(0.5, 'Web', 'http retry backoff', float) # seconds, doubled on each retry
+HTTP_CACHE_SIZE = get(50000, 'Web', 'http cache size', int) # cached search and gallery responses, 0 to disable
+HTTP_CACHE_TTL = get(7*24*60*60, 'Web', 'http cache ttl', int) # seconds
+HTTP_CACHE_NEGATIVE_TTL = get(24*60*60, 'Web', 'http cache negative ttl', int) # seconds to remember searches without hits
 
 # External Viewer
 EXTERNAL_VIEWER_SUPPORT = {'honeyview':['Honeyview.exe']}
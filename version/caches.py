@@ -0,0 +1,300 @@
+#"""
+#This file is part of Happypanda.
+#Happypanda is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 2 of the License, or
+#any later version.
+#Happypanda is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#You should have received a copy of the GNU General Public License
+#along with Happypanda.  If not, see <http://www.gnu.org/licenses/>.
+#"""
+
+"""Contains persistent caches which are stored outside of the main database"""
+
+import os
+import json
+import sqlite3
+import threading
+import time
+import logging
+import scandir
+
+try:
+    from database import db_constants
+except ImportError:
+    from .database import db_constants
+
+log = logging.getLogger(__name__)
+log_i = log.info
+log_d = log.debug
+log_w = log.warning
+log_e = log.error
+log_c = log.critical
+
+class CacheDB:
+    """
+    Base class for a cache living in its own sqlite file (db/cache.db by default).
+    Losing the cache is harmless, so writes are not synced to disk.
+    Subclasses provide the table layout in STRUCTURE_SCRIPT.
+    """
+    STRUCTURE_SCRIPT = ""
+
+    def __init__(self, path=None):
+        self.path = path or db_constants.CACHE_PATH
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _connection(self):
+        if not self._conn:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA synchronous = OFF")
+            self._conn.executescript(self.STRUCTURE_SCRIPT)
+            self._conn.commit()
+        return self._conn
+
+    def execute(self, *args):
+        "Same as cursor.execute, commits right away"
+        with self._lock:
+            try:
+                conn = self._connection()
+                with conn:
+                    return conn.execute(*args)
+            except sqlite3.Error:
+                log.exception('Cache query failed: {}'.format(self.path.encode(errors='ignore')))
+
+    def executemany(self, *args):
+        "Same as cursor.executemany, commits right away"
+        with self._lock:
+            try:
+                conn = self._connection()
+                with conn:
+                    return conn.executemany(*args)
+            except sqlite3.Error:
+                log.exception('Cache query failed: {}'.format(self.path.encode(errors='ignore')))
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+def file_stamp(path):
+    "Returns a (size, mtime) tuple of the given path or None if it can't be accessed"
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+class ArchiveListingCache(CacheDB):
+    """
+    Remembers the listing of archives keyed by (path, size, mtime).
+    A listing is a dict with:
+        galleries -> paths in archive to potential galleries (see utils.check_archive)
+        pages -> dict of gallery path -> amount of images in it
+        first_img -> dict of gallery path -> name of first image
+        metafiles -> names of metafiles in the archive
+        names -> all members in the archive
+    get -> returns the listing if the archive is unchanged else None
+    put <- stores the listing of an archive
+    invalidate <- forgets the listing of an archive
+    """
+    STRUCTURE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS archive_listing(
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            listing TEXT);
+        """
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def get(self, path):
+        stamp = file_stamp(path)
+        if not stamp:
+            return None
+        c = self.execute('SELECT size, mtime, listing FROM archive_listing WHERE path=?', (self._key(path),))
+        row = c.fetchone() if c else None
+        if row and (row['size'], row['mtime']) == stamp:
+            try:
+                return json.loads(row['listing'])
+            except ValueError:
+                pass
+        return None
+
+    def put(self, path, listing):
+        stamp = file_stamp(path)
+        if not stamp:
+            return
+        self.execute('INSERT OR REPLACE INTO archive_listing(path, size, mtime, listing) VALUES(?, ?, ?, ?)',
+               (self._key(path), stamp[0], stamp[1], json.dumps(listing)))
+
+    def invalidate(self, path):
+        self.execute('DELETE FROM archive_listing WHERE path=?', (self._key(path),))
+
+def tree_stamp(path):
+    """
+    Returns a (mtime, size) tuple describing the given path or None if it can't be accessed.
+    Files use their own mtime and size. Directories use the newest mtime of themselves and
+    their direct subfolders and the amount of entries directly in them, so added chapters are
+    noticed without walking the whole tree.
+    """
+    if not os.path.isdir(path):
+        stamp = file_stamp(path)
+        return (stamp[1], stamp[0]) if stamp else None
+    try:
+        mtime = os.stat(path).st_mtime
+        entries = list(scandir.scandir(path))
+    except OSError:
+        return None
+    for e in entries:
+        try:
+            if e.is_dir():
+                mtime = max(mtime, e.stat().st_mtime)
+        except OSError:
+            pass
+    return mtime, len(entries)
+
+ARCHIVE_LISTING_CACHE = ArchiveListingCache()
+
+class ScanSnapshotCache(CacheDB):
+    """
+    Remembers the (mtime, size) stamp of every entry in the monitored folders from the last scan
+    get -> returns a dict of path -> stamp of the given monitored folder
+    changed -> returns the paths of the given (path, stamp) pairs which are new or have changed
+    update <- replaces the stamps of the given monitored folder with the given (path, stamp) pairs
+    invalidate <- forgets the entry of the given path and of the folders containing it,
+        so the next scan examines it again
+    clear <- forgets everything, next scan will examine every entry
+    """
+    STRUCTURE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS scan_snapshot(
+            path TEXT PRIMARY KEY,
+            root TEXT,
+            mtime REAL,
+            size INTEGER);
+        CREATE INDEX IF NOT EXISTS idx_scan_root ON scan_snapshot(root);
+        """
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def get(self, root):
+        c = self.execute('SELECT path, mtime, size FROM scan_snapshot WHERE root=?', (self._key(root),))
+        return {r['path']:(r['mtime'], r['size']) for r in c} if c else {}
+
+    def changed(self, root, stamps):
+        old = self.get(root)
+        return [p for p, s in stamps if not s or old.get(self._key(p)) != s]
+
+    def update(self, root, stamps):
+        root = self._key(root)
+        with self._lock:
+            self.execute('DELETE FROM scan_snapshot WHERE root=?', (root,))
+            self.executemany('INSERT OR REPLACE INTO scan_snapshot(path, root, mtime, size) VALUES(?, ?, ?, ?)',
+                   [(self._key(p), root, s[0], s[1]) for p, s in stamps if s])
+
+    def invalidate(self, path):
+        path = self._key(path)
+        self.execute('DELETE FROM scan_snapshot WHERE path=? OR substr(?, 1, length(path) + 1)=path || ?',
+               (path, path, os.sep))
+
+    def clear(self):
+        self.execute('DELETE FROM scan_snapshot')
+
+SCAN_SNAPSHOT = ScanSnapshotCache()
+
+class PollSnapshotCache(CacheDB):
+    """
+    Remembers the (mtime, size) stamps of the folders and archives below the monitored folders
+    which are watched by polling (see io_misc.GalleryPoller). Single images are not included.
+    get -> returns a dict of path -> stamp of the given monitored folder
+    update <- replaces the stamps of the given monitored folder with the given dict
+    """
+    STRUCTURE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS poll_snapshot(
+            root TEXT,
+            path TEXT,
+            mtime REAL,
+            size INTEGER,
+            PRIMARY KEY(root, path));
+        """
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def get(self, root):
+        c = self.execute('SELECT path, mtime, size FROM poll_snapshot WHERE root=?', (self._key(root),))
+        return {r['path']:(r['mtime'], r['size']) for r in c} if c else {}
+
+    def update(self, root, stamps):
+        root = self._key(root)
+        with self._lock:
+            self.execute('DELETE FROM poll_snapshot WHERE root=?', (root,))
+            self.executemany('INSERT OR REPLACE INTO poll_snapshot(root, path, mtime, size) VALUES(?, ?, ?, ?)',
+                   [(root, p, s[0], s[1]) for p, s in stamps.items()])
+
+POLL_SNAPSHOT = PollSnapshotCache()
+
+class ResponseCache(CacheDB):
+    """
+    Remembers responses of metadata sources keyed by (source, key), where key is a hash
+    for searches or a gallery id/token for gallery data. Values are stored as json.
+    Negative entries remember lookups without hits and usually expire sooner.
+    get -> returns the value if it's younger than ttl (negative_ttl for negative entries), else None
+    put <- stores a value, the oldest entries are dropped when there are more than size
+    clear <- forgets all responses, or only those of the given source
+    """
+    STRUCTURE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS http_response(
+            source TEXT,
+            key TEXT,
+            value TEXT,
+            negative INTEGER,
+            stamp REAL,
+            PRIMARY KEY(source, key));
+        CREATE INDEX IF NOT EXISTS idx_http_response_stamp ON http_response(stamp);
+        """
+    _EVICT_EVERY = 100 # puts between size checks
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._puts = 0
+
+    def get(self, source, key, ttl, negative_ttl):
+        c = self.execute('SELECT value, negative, stamp FROM http_response WHERE source=? AND key=?',
+               (source, str(key)))
+        row = c.fetchone() if c else None
+        if not row or time.time() - row['stamp'] > (negative_ttl if row['negative'] else ttl):
+            return None
+        try:
+            return json.loads(row['value'])
+        except ValueError:
+            return None
+
+    def put(self, source, key, value, negative=False, size=0):
+        with self._lock:
+            self.execute('INSERT OR REPLACE INTO http_response(source, key, value, negative, stamp) VALUES(?, ?, ?, ?, ?)',
+                   (source, str(key), json.dumps(value), int(negative), time.time()))
+            self._puts += 1
+            if size and (self._puts - 1) % self._EVICT_EVERY == 0:
+                self.execute("""DELETE FROM http_response WHERE rowid IN
+                       (SELECT rowid FROM http_response ORDER BY stamp
+                       LIMIT MAX((SELECT COUNT(*) FROM http_response) - ?, 0))""", (size,))
+
+    def clear(self, source=None):
+        if source:
+            self.execute('DELETE FROM http_response WHERE source=?', (source,))
+        else:
+            self.execute('DELETE FROM http_response')
+
+RESPONSE_CACHE = ResponseCache()
@@ -12,7 +12,7 @@
 #along with Happypanda.  If not, see <http://www.gnu.org/licenses/>.
 #"""
 
-import os, sqlite3, threading, queue
+import os, sqlite3, threading, queue, contextlib
 import logging, time, shutil
 
 from . import db_constants
@@ -41,6 +41,22 @@ def hashes_sql(cols=False):
         return sql, col_list
     return sql
 
+def phashes_sql(cols=False):
+    col_list = [
+    'phash_id INTEGER PRIMARY KEY',
+    'phash INTEGER',
+    'series_id INTEGER',
+    'page INTEGER',
+    'FOREIGN KEY(series_id) REFERENCES series(series_id) ON DELETE CASCADE',
+    'UNIQUE(series_id, page)'
+    ]
+
+    sql = "CREATE TABLE IF NOT EXISTS phashes({});".format(",".join(col_list))
+
+    if cols:
+        return sql, col_list
+    return sql
+
 def series_sql(cols=False):
     col_list = [
         'series_id INTEGER PRIMARY KEY',
@@ -180,7 +196,7 @@ def series_list_map_sql(cols=False):
     return sql
 
 STRUCTURE_SCRIPT = series_sql()+chapters_sql()+namespaces_sql()+tags_sql()+tags_mappings_sql()+\
-    series_tags_mappings_sql()+hashes_sql()+list_sql()+series_list_map_sql()
+    series_tags_mappings_sql()+hashes_sql()+phashes_sql()+list_sql()+series_list_map_sql()
 
 def global_db_convert(conn):
     """
@@ -196,6 +212,7 @@ def global_db_convert(conn):
     tags_mappings, tags_mappings_cols = tags_mappings_sql(True)
     series_tags_mappings, series_tags_mappings_cols = series_tags_mappings_sql(True)
     hashes, hashes_cols = hashes_sql(True)
+    phashes, phashes_cols = phashes_sql(True)
     _list, list_cols = list_sql(True)
     series_list_map, series_list_map_cols = series_list_map_sql(True)
     
@@ -207,6 +224,7 @@ def global_db_convert(conn):
     t_d['tags_mappings'] = tags_mappings_cols
     t_d['series_tags_mappings'] = series_tags_mappings_cols
     t_d['hashes'] = hashes_cols
+    t_d['phashes'] = phashes_cols
     t_d['list'] = list_cols
     t_d['series_list_map'] = series_list_map_cols
 
@@ -226,6 +244,29 @@ def global_db_convert(conn):
     log_d('Commited DB changes')
     return c
 
+def convert_hashes_to_binary(conn):
+    """
+    Converts hashes stored as 40 hex-digits to 20 byte binary.
+    Don't use this method directly. Use the add_db_revisions instead.
+    """
+    log_i('Converting hashes to binary')
+    c = conn.cursor()
+    rows = c.execute("SELECT hash_id, hash FROM hashes WHERE typeof(hash) = 'text'").fetchall()
+    converted = []
+    for r in rows:
+        try:
+            converted.append((bytes.fromhex(r['hash']), r['hash_id']))
+        except (ValueError, TypeError):
+            log_w('Invalid hash: {}'.format(r['hash']))
+    c.executemany('UPDATE OR IGNORE hashes SET hash=? WHERE hash_id=?', converted)
+    # duplicates which already existed in binary form
+    c.execute("DELETE FROM hashes WHERE typeof(hash) = 'text'")
+    conn.commit()
+    log_d('Converted {} hashes'.format(len(converted)))
+    if converted:
+        c.execute('VACUUM')
+    return c
+
 def add_db_revisions(old_db):
     """
     Adds specific DB revisions items.
@@ -237,6 +278,7 @@ def add_db_revisions(old_db):
 
     log_i('Converting tables and columns')
     c = global_db_convert(conn)
+    convert_hashes_to_binary(conn)
 
     log_d('Updating DB version')
     c.execute('UPDATE version SET version=? WHERE 1', (db_constants.CURRENT_DB_VERSION,))
@@ -314,6 +356,8 @@ class DBBase:
     _DB_CONN = None
     _AUTO_COMMIT = True
     _STATE = {'active':False}
+    _LOCK = threading.RLock() # the connection is shared by all threads
+    _TRANSACTION = {'owner':None} # thread running a transaction()
 
     def __init__(self, **kwargs):
         pass
@@ -339,32 +383,64 @@ class DBBase:
             cls._STATE['active'] = False
         #print("ENDED DB OPTIMIZE")
 
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """
+        Runs the queries made by this thread in the with block in one transaction,
+        which is rolled back if an exception is raised.
+        Unlike begin, queries from other threads wait until it's done instead of joining it
+        """
+        with cls._LOCK:
+            if cls._TRANSACTION['owner'] == threading.get_ident():
+                yield
+                return
+            cls._TRANSACTION['owner'] = threading.get_ident()
+            try:
+                # a savepoint also works inside a transaction started by begin
+                cls._DB_CONN.execute("SAVEPOINT batch")
+                try:
+                    yield
+                except:
+                    cls._DB_CONN.execute("ROLLBACK TO batch")
+                    cls._DB_CONN.execute("RELEASE batch")
+                    raise
+                cls._DB_CONN.execute("RELEASE batch")
+            finally:
+                cls._TRANSACTION['owner'] = None
+
+    @classmethod
+    def _auto_commit(cls):
+        return cls._AUTO_COMMIT and cls._TRANSACTION['owner'] != threading.get_ident()
+
     def execute(self, *args):
         "Same as cursor.execute"
         if not self._DB_CONN:
             raise db_constants.NoDatabaseConnection
         log_d('DB Query: {}'.format(args).encode(errors='ignore'))
-        if self._AUTO_COMMIT:
-            try:
-                with self._DB_CONN:
-                    return self._DB_CONN.execute(*args)
-            except sqlite3.InterfaceError:
-                    return self._DB_CONN.execute(*args)
-
-        else:
-            return self._DB_CONN.execute(*args)
+        with self._LOCK:
+            if self._auto_commit():
+                try:
+                    with self._DB_CONN:
+                        return self._DB_CONN.execute(*args)
+                except sqlite3.InterfaceError:
+                        return self._DB_CONN.execute(*args)
+
+            else:
+                return self._DB_CONN.execute(*args)
     
     def executemany(self, *args):
         "Same as cursor.executemany"
         if not self._DB_CONN:
             raise db_constants.NoDatabaseConnection
         log_d('DB Query: {}'.format(args).encode(errors='ignore'))
-        if self._AUTO_COMMIT:
-            with self._DB_CONN:
-                return self._DB_CONN.executemany(*args)
-        else:
-            c = self._DB_CONN.executemany(*args)
-            return c
+        with self._LOCK:
+            if self._auto_commit():
+                with self._DB_CONN:
+                    return self._DB_CONN.executemany(*args)
+            else:
+                c = self._DB_CONN.executemany(*args)
+                return c
 
     def commit(self):
         self._DB_CONN.commit()
@@ -15,6 +15,7 @@
 import os
 
 DB_NAME = 'happypanda.db'
+CACHE_NAME = 'cache.db'
 THUMB_NAME = "thumbnails"
 if os.name == 'posix':
 	DB_ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../db')
@@ -24,8 +25,9 @@ else:
 	DB_ROOT = "db"
 	THUMBNAIL_PATH = os.path.join("db", THUMB_NAME)
 	DB_PATH = os.path.join(DB_ROOT, DB_NAME)
+CACHE_PATH = os.path.join(DB_ROOT, CACHE_NAME)
 
-DB_VERSION = [0.26] # a list of accepted db versions. E.g. v3.5 will be backward compatible with v3.1 etc.
+DB_VERSION = [0.27] # a list of accepted db versions. E.g. v3.5 will be backward compatible with v3.1 etc.
 CURRENT_DB_VERSION = DB_VERSION[0]
 REAL_DB_VERSION = DB_VERSION[len(DB_VERSION)-1]
 METHOD_QUEUE = None
@@ -1,4 +1,4 @@
-﻿import logging, uuid, os
+﻿import logging, uuid, os, time, threading, hashlib, functools
 
 from concurrent import futures
 from PyQt5.QtCore import Qt
@@ -87,9 +87,22 @@ def _task_load_thumbnail(ppath, thumb_size, on_method=None, **kwargs):
 				on_method(img, **kwargs)
 			return img
 
+def _task_hash_file(path):
+	with open(path, 'rb', buffering=utils.HASH_CHUNK) as f:
+		h = utils.generate_img_hash(f)
+		return h, f.tell()
+
+def _task_hash_bytes(data):
+	# hashlib releases the GIL on big buffers
+	return hashlib.sha1(data).digest(), len(data)
+
 class Executors:
 	_thumbnail_exec = futures.ThreadPoolExecutor(3)
 	_profile_exec = futures.ThreadPoolExecutor(2)
+	_chapter_exec = futures.ThreadPoolExecutor(1)
+	_prefetch_exec = futures.ThreadPoolExecutor(1)
+	_hash_exec = futures.ThreadPoolExecutor(app_constants.HASH_WORKERS)
+	hash_stats = {'pages':0, 'bytes':0, 'seconds':0.0}
 	
 	@classmethod
 	def generate_thumbnail(cls, gallery_or_path, img=None, width=app_constants.THUMB_W_SIZE,
@@ -105,9 +118,103 @@ class Executors:
 
 		log_d("Returning future")
 
+	@classmethod
+	def generate_thumbnails(cls, galleries, on_method=None, chunk=10):
+		"""
+		Generates thumbnails for a batch of galleries and sets their profiles.
+		on_method is called with lists of up to chunk galleries as their thumbnails are done
+		"""
+		galleries = list(galleries)
+		if not galleries:
+			return
+		log_i("Generating {} thumbnails".format(len(galleries)))
+		remaining = [len(galleries)]
+		finished = []
+		lock = threading.Lock()
+		def done(gallery, f):
+			try:
+				gallery.profile = f.result()
+			except Exception:
+				log.exception("Failed to generate thumbnail")
+			with lock:
+				remaining[0] -= 1
+				finished.append(gallery)
+				if len(finished) < chunk and remaining[0]:
+					return
+				gs = finished[:]
+				del finished[:]
+			if on_method:
+				on_method(gs)
+		for g in galleries:
+			f = cls._thumbnail_exec.submit(_task_thumbnail, g)
+			f.add_done_callback(functools.partial(done, g))
+
 	@classmethod
 	def load_thumbnail(cls, ppath, thumb_size=app_constants.THUMB_DEFAULT, on_method=None, **kwargs):
 		"**kwargs will be passed to on_method"
 		f = cls._profile_exec.submit(_task_load_thumbnail, ppath, thumb_size, on_method, **kwargs)
 		return f
 
+	@classmethod
+	def open_chapter(cls, chapterpath, archive=None, prefetch=None):
+		"""
+		Opens chapter outside the database thread.
+		prefetch: (chapterpath, archive) of a chapter which will be extracted in the background
+		after this chapter has been opened
+		"""
+		f = cls._chapter_exec.submit(utils.open_chapter, chapterpath, archive)
+		f.add_done_callback(functools.partial(cls._chapter_done, archive or chapterpath, "open", True))
+		if prefetch:
+			f.add_done_callback(lambda _: cls.prefetch_chapter(*prefetch))
+		return f
+
+	@classmethod
+	def prefetch_chapter(cls, chapterpath, archive=None):
+		f = cls._prefetch_exec.submit(utils.prefetch_chapter, chapterpath, archive)
+		f.add_done_callback(functools.partial(cls._chapter_done, archive or chapterpath, "prefetch", False))
+		return f
+
+	@staticmethod
+	def _chapter_done(path, action, notify, f):
+		"Logs why opening or prefetching a chapter failed, and shows it on the notification bar if notify"
+		exc = f.exception()
+		if not exc:
+			return
+		log.error("Failed to {} chapter: {}".format(action, path), exc_info=exc)
+		if notify and app_constants.NOTIF_BAR:
+			app_constants.NOTIF_BAR.add_text("Failed to {} chapter: {}".format(action, exc))
+
+	@classmethod
+	def hash_pages(cls, pages, archive=None):
+		"""
+		Hashes pages on a worker pool. Returns dict of page -> hash
+		pages: dict of page -> filepath, or page -> name in archive if an ArchiveFile is given.
+		Archive members are read in archive order by the calling thread and hashed on the pool
+		"""
+		start = time.time()
+		futs = {}
+		if archive:
+			order = {n: i for i, n in enumerate(archive.namelist())}
+			in_flight = threading.Semaphore(app_constants.HASH_WORKERS * 2) # bounds memory usage
+			for p in sorted(pages, key=lambda x: order.get(pages[x], 0)):
+				data = archive.open(pages[p])
+				in_flight.acquire()
+				f = cls._hash_exec.submit(_task_hash_bytes, data)
+				f.add_done_callback(lambda _: in_flight.release())
+				futs[p] = f
+		else:
+			for p in pages:
+				futs[p] = cls._hash_exec.submit(_task_hash_file, pages[p])
+
+		hashes = {}
+		size = 0
+		for p in futs:
+			hashes[p], s = futs[p].result()
+			size += s
+		secs = max(time.time() - start, 0.000001)
+		cls.hash_stats['pages'] += len(hashes)
+		cls.hash_stats['bytes'] += size
+		cls.hash_stats['seconds'] += secs
+		log_d('Hashed {} pages ({:.1f} MB) in {:.2f}s: {:.1f} MB/s, {:.1f} pages/s'.format(
+			len(hashes), size / 1048576, secs, size / 1048576 / secs, len(hashes) / secs))
+		return hashes
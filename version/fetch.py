@@ -12,7 +12,8 @@
 #along with Happypanda.  If not, see <http://www.gnu.org/licenses/>.
 #"""
 
-import os, time, logging, uuid, random, queue, scandir
+import os, time, logging, uuid, random, queue, scandir, collections
+from concurrent import futures
 import re as regex
 
 from PyQt5.QtCore import QObject, pyqtSignal # need this for interaction with main thread
@@ -43,6 +44,7 @@ class Fetch(QObject):
 
     # local signals
     LOCAL_EMITTER = pyqtSignal(Gallery)
+    LOCAL_BATCH_EMITTER = pyqtSignal(list) # chunks of created galleries, see IMPORT_BATCH_SIZE
     FINISHED = pyqtSignal(object)
     DATA_COUNT = pyqtSignal(int)
     PROGRESS = pyqtSignal(int)
@@ -52,7 +54,6 @@ class Fetch(QObject):
     GALLERY_EMITTER = pyqtSignal(Gallery, object, object)
     AUTO_METADATA_PROGRESS = pyqtSignal(str)
     GALLERY_PICKER = pyqtSignal(object, list, queue.Queue)
-    GALLERY_PICKER_QUEUE = queue.Queue()
     
 
     def __init__(self, parent=None):
@@ -61,6 +62,8 @@ class Fetch(QObject):
         self._data = []
         self._curr_gallery = '' # for debugging purposes
         self.skipped_paths = []
+        self._batch = []
+        self._batch_time = 0
 
         # web
         self._default_ehen_url = app_constants.DEFAULT_EHEN_URL
@@ -69,26 +72,15 @@ class Fetch(QObject):
         self.error_galleries = []
         self._hen_list = []
 
-        #filter
-        self.galleries_from_db = []
-        self._refresh_filter_list()
-
         #download
         self._to_queue_container = False
         self._galleries_queue = queue.Queue()
 
-    def _refresh_filter_list(self):
-            gallery_data = app_constants.GALLERY_DATA + app_constants.GALLERY_ADDITION_DATA
-            filter_list = []
-            for g in gallery_data:
-                filter_list.append(os.path.normcase(g.path))
-            self.galleries_from_db = sorted(filter_list)
-
     def create_gallery(self, path, folder_name, do_chapters=True, archive=None):
         is_archive = True if archive else False
         temp_p = archive if is_archive else path
         folder_name = folder_name or path if folder_name or path else os.path.split(archive)[1]
-        if utils.check_ignore_list(temp_p) and not GalleryDB.check_exists(temp_p, self.galleries_from_db, False):
+        if utils.check_ignore_list(temp_p) and not GalleryDB.check_exists(temp_p):
             log_i('Creating gallery: {}'.format(folder_name.encode('utf-8', 'ignore')))
             new_gallery = Gallery()
             images_paths = []
@@ -121,7 +113,11 @@ class Fetch(QObject):
                 try:
                     if is_archive or temp_p.endswith(utils.ARCHIVE_FILES):
                         log_i('Gallery source is an archive')
-                        contents = utils.check_archive(temp_p)
+                        try:
+                            listing, metafiles = utils.scan_archive(temp_p, None if do_chapters else [path])
+                        except app_constants.CreateArchiveFail:
+                            listing, metafiles = None, {}
+                        contents = listing['galleries'] if listing else []
                         if contents:
                             new_gallery.is_archive = 1
                             new_gallery.path_in_archive = '' if not is_archive else path
@@ -143,24 +139,27 @@ class Fetch(QObject):
                                 if not archive_g:
                                     log_w('No chapters found for {}'.format(temp_p.encode(errors='ignore')))
                                     raise ValueError
+                                pages = listing['pages']
                                 for g in archive_g:
                                     chap = new_gallery.chapters.create_chapter()
                                     chap.in_archive = 1
                                     chap.title = parsed['title'] if not g else utils.title_parser(g.replace('/', ''))['title']
                                     chap.path = g
-                                    metafile.update(utils.GMetafile(g, temp_p))
-                                    arch = utils.ArchiveFile(temp_p)
-                                    chap.pages = len([x for x in arch.dir_contents(g) if x.endswith(utils.IMG_FILES)])
-                                    arch.close()
+                                    metafile.update(metafiles[g])
+                                    chap.pages = pages[g]
                             else:
                                 chap = new_gallery.chapters.create_chapter()
                                 chap.title = utils.title_parser(os.path.split(path)[1])['title']
                                 chap.in_archive = 1
                                 chap.path = path
-                                metafile.update(utils.GMetafile(path, temp_p))
-                                arch = utils.ArchiveFile(temp_p)
-                                chap.pages = len(arch.dir_contents(''))
-                                arch.close()
+                                metafile.update(metafiles[path])
+                                pages = listing['pages']
+                                if path in pages:
+                                    chap.pages = pages[path]
+                                else:
+                                    arch = utils.open_archive(temp_p)
+                                    chap.pages = len(arch.dir_contents(''))
+                                    arch.close()
                         else:
                             raise ValueError
                     else:
@@ -191,6 +190,7 @@ class Fetch(QObject):
 
             self.LOCAL_EMITTER.emit(new_gallery)
             self._data.append(new_gallery)
+            self._add_to_batch(new_gallery)
             log_i('Gallery successful created: {}'.format(folder_name.encode('utf-8', 'ignore')))
             return True
         else:
@@ -198,6 +198,59 @@ class Fetch(QObject):
             self.skipped_paths.append((temp_p, 'Already exists or ignored'))
             return False
 
+    def _add_to_batch(self, gallery):
+        if not self._batch:
+            self._batch_time = time.time()
+        self._batch.append(gallery)
+        if len(self._batch) >= app_constants.IMPORT_BATCH_SIZE or \
+            time.time() - self._batch_time >= app_constants.IMPORT_BATCH_INTERVAL:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        "Emits the galleries collected so far"
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self.LOCAL_BATCH_EMITTER.emit(batch)
+
+    def _probe(self, path, folder_name, subfolders):
+        """
+        Finds the galleries in the given entry of series_path. Runs on the discovery pool.
+        Returns a list of (args, kwargs) to call create_gallery with and a list of skipped paths
+        """
+        jobs = []
+        skipped = []
+        if subfolders:
+            log_i("Treating each subfolder as gallery")
+            if os.path.isdir(path):
+                gallery_folders, gallery_archives = utils.recursive_gallery_check(path)
+                for gs in gallery_folders:
+                    jobs.append(((gs, os.path.split(gs)[1], False), {}))
+                for gs in gallery_archives:
+                    jobs.append(((gs[0], os.path.split(gs[0])[1], False), {'archive':gs[1]}))
+            elif path.endswith(utils.ARCHIVE_FILES):
+                for g in utils.check_archive(path):
+                    jobs.append(((g, os.path.split(g)[1], False), {'archive':path}))
+        else:
+            try:
+                if os.path.isdir(path):
+                    if not list(scandir.scandir(path)):
+                        raise ValueError
+                elif not path.endswith(utils.ARCHIVE_FILES):
+                    raise NotADirectoryError
+                else:
+                    utils.check_archive(path) # warms the archive listing cache for create_gallery
+
+                log_i("Treating each subfolder as chapter")
+                jobs.append(((path, folder_name), {'do_chapters':True}))
+
+            except ValueError:
+                skipped.append((path, 'Empty directory'))
+                log_w('Directory is empty: {}'.format(path.encode(errors='ignore')))
+            except NotADirectoryError:
+                skipped.append((path, 'Unsupported file'))
+                log_w('Unsupported file: {}'.format(path.encode(errors='ignore')))
+        return jobs, skipped
+
     def local(self, s_path=None):
         """
         Do a local search in the given series_path.
@@ -213,54 +266,43 @@ class Fetch(QObject):
             mixed = True
         if len(gallery_l) != 0: # if gallery path list is not empty
             log_i('Gallery folder is not empty')
-            if len(self.galleries_from_db) != len(app_constants.GALLERY_DATA):
-                self._refresh_filter_list()
             self.DATA_COUNT.emit(len(gallery_l)) #tell model how many items are going to be added
             log_i('Received {} paths'.format(len(gallery_l)))
             progress = 0
 
-            for folder_name in gallery_l: # folder_name = gallery folder title
-                self._curr_gallery = folder_name
-                if mixed:
-                    path = folder_name
-                    folder_name = os.path.split(path)[1]
-                else:
-                    path = os.path.join(self.series_path, folder_name)
-                if app_constants.SUBFOLDER_AS_GALLERY or app_constants.OVERRIDE_SUBFOLDER_AS_GALLERY:
-                    if app_constants.OVERRIDE_SUBFOLDER_AS_GALLERY:
-                        app_constants.OVERRIDE_SUBFOLDER_AS_GALLERY = False
-                    log_i("Treating each subfolder as gallery")
-                    if os.path.isdir(path):
-                        gallery_folders, gallery_archives = utils.recursive_gallery_check(path)
-                        for gs in gallery_folders:
-                                self.create_gallery(gs, os.path.split(gs)[1], False)
-                        p_saving = {}
-                        for gs in gallery_archives:
-                                    
-                                self.create_gallery(gs[0], os.path.split(gs[0])[1], False, archive=gs[1])
-                    elif path.endswith(utils.ARCHIVE_FILES):
-                        for g in utils.check_archive(path):
-                            self.create_gallery(g, os.path.split(g)[1], False, archive=path)
-                else:
-                    try:
-                        if os.path.isdir(path):
-                            if not list(scandir.scandir(path)):
-                                raise ValueError
-                        elif not path.endswith(utils.ARCHIVE_FILES):
-                            raise NotADirectoryError
-
-                        log_i("Treating each subfolder as chapter")
-                        self.create_gallery(path, folder_name, do_chapters=True)
-
-                    except ValueError:
-                        self.skipped_paths.append((path, 'Empty directory'))
-                        log_w('Directory is empty: {}'.format(path.encode(errors='ignore')))
-                    except NotADirectoryError:
-                        self.skipped_paths.append((path, 'Unsupported file'))
-                        log_w('Unsupported file: {}'.format(path.encode(errors='ignore')))
-
-                progress += 1 # update the progress bar
-                self.PROGRESS.emit(progress)
+            subfolders = app_constants.SUBFOLDER_AS_GALLERY or app_constants.OVERRIDE_SUBFOLDER_AS_GALLERY
+            app_constants.OVERRIDE_SUBFOLDER_AS_GALLERY = False # only applies to this fetch
+            def entries():
+                for folder_name in gallery_l: # folder_name = gallery folder title
+                    if mixed:
+                        path = folder_name
+                        folder_name = os.path.split(path)[1]
+                    else:
+                        path = os.path.join(self.series_path, folder_name)
+                    yield path, folder_name, subfolders
+
+            # entries are probed concurrently but galleries are created in the original order
+            workers = max(app_constants.LOCAL_SEARCH_WORKERS, 1)
+            with futures.ThreadPoolExecutor(workers) as pool:
+                pending = collections.deque()
+                entries_it = entries()
+                while True:
+                    for entry in entries_it:
+                        pending.append((entry[1], pool.submit(self._probe, *entry)))
+                        if len(pending) >= workers * 4:
+                            break
+                    if not pending:
+                        break
+                    folder_name, probed = pending.popleft()
+                    self._curr_gallery = folder_name
+                    jobs, skipped = probed.result()
+                    self.skipped_paths.extend(skipped)
+                    for args, kwargs in jobs:
+                        self.create_gallery(*args, **kwargs)
+
+                    progress += 1 # update the progress bar
+                    self.PROGRESS.emit(progress)
+            self._flush_batch()
         else: # if gallery folder is empty
             log_e('Local search error: Invalid directory')
             log_e('Gallery folder is empty')
@@ -268,6 +310,7 @@ class Fetch(QObject):
             self.FINISHED.emit(False)
             # might want to include an error message
         app_constants.OVERRIDE_MOVE_IMPORTED_IN_FETCH = False
+        utils.ARCHIVE_POOL.clear() # don't keep the scanned archives locked
         # everything went well
         log_i('Local search: OK')
         log_i('Created {} items'.format(len(self._data)))
@@ -335,26 +378,50 @@ class Fetch(QObject):
         self.AUTO_METADATA_PROGRESS.emit('Finished applying metadata')
         log_i('Finished applying metadata')
 
+    def _search_hash(self, gallery, color_img=False, stored=None):
+        """
+        Generates the hash to search for a gallery with, runs on a hash worker and doesn't touch the DB.
+        stored is the dict of hashes in DB of the first chapter, see HashDB.get_stored_hashes.
+        Returns the hash, or None if it couldn't be generated, the new hashes to insert
+        and extra args for hen.search
+        """
+        custom_args = {} # send to hen class
+        hash = None
+        new_hashes = {}
+        try:
+            if not gallery.hashes:
+                hash_dict, new_hashes = HashDB.hash_chapter(gallery, 0, 'mid', color_img, stored=stored)
+                if color_img and 'color' in hash_dict:
+                    custom_args['color'] = hash_dict['color'] # will be path to filename
+                    hash = hash_dict['color']
+                elif hash_dict:
+                    hash = hash_dict['mid']
+            else:
+                hash = gallery.hashes[random.randint(0, len(gallery.hashes)-1)]
+        except app_constants.CreateArchiveFail:
+            pass
+        return hash, new_hashes, custom_args
+
     def _auto_metadata_process(self, galleries, hen, valid_url, **kwargs):
-        hen.LAST_USED = time.time()
+        """
+        Finds the urls of galleries and fetches their metadata as a pipeline.
+        Galleries are hashed on a pool ahead of the searches, searches are sent as fast as
+        the rate limiter allows and found urls are queued to be fetched in batches of
+        hen._QUEUE_LIMIT. Galleries with multiple hits are shown to the picker one at a time
+        while the searches go on.
+        """
         self.AUTO_METADATA_PROGRESS.emit("Checking gallery urls...")
+        color_img = kwargs['color'] if 'color' in kwargs else False # used for similarity search on EH
 
-        fetched_galleries = []
-        checked_pre_url_galleries = []
-        multiple_hit_galleries = []
-        for x, gallery in enumerate(galleries, 1):
-            custom_args = {} # send to hen class
+        to_search = []
+        for gallery in galleries:
             log_i("Checking gallery url")
 
             # coming from GalleryDialog
-            if hasattr(gallery, "_g_dialog_url"):
-                if gallery._g_dialog_url:
-                    gallery.temp_url = gallery._g_dialog_url
-                    checked_pre_url_galleries.append(gallery)
-                    # to process even if this gallery is last and fails
-                    if x == len(galleries):
-                        self.fetch_metadata(hen=hen)
-                    continue
+            if getattr(gallery, "_g_dialog_url", None):
+                gallery.temp_url = gallery._g_dialog_url
+                self.fetch_metadata(gallery, hen)
+                continue
 
             if gallery.link and app_constants.USE_GALLERY_LINK:
                 log_i("Using existing gallery url")
@@ -363,113 +430,118 @@ class Fetch(QObject):
                     # convert g.e-h to e-h
                     gallery.link = pewnet.HenManager.gtoEh(gallery.link)
                     gallery.temp_url = gallery.link
-                    checked_pre_url_galleries.append(gallery)
-                    if x == len(galleries):
-                        self.fetch_metadata(hen=hen)
+                    self.fetch_metadata(gallery, hen)
                     continue
+            to_search.append(gallery)
 
-            self.AUTO_METADATA_PROGRESS.emit("({}/{}) Generating gallery hash: {}".format(x, len(galleries), gallery.title))
-            log_i("Generating gallery hash: {}".format(gallery.title.encode(errors='ignore')))
-            hash = None
-            try:
-                if not gallery.hashes:
-                    color_img = kwargs['color'] if 'color' in kwargs else False # used for similarity search on EH
-                    hash_dict = execute(HashDB.gen_gallery_hash, False, gallery, 0, 'mid', color_img)
-                    if color_img and 'color' in hash_dict:
-                        custom_args['color'] = hash_dict['color'] # will be path to filename
-                        hash = hash_dict['color']
-                    elif hash_dict:
-                        hash = hash_dict['mid']
-                else:
-                    hash = gallery.hashes[random.randint(0, len(gallery.hashes)-1)]
-            except app_constants.CreateArchiveFail:
-                pass
-            if not hash:
-                self.error_galleries.append((gallery, "Could not generate hash"))
-                log_e("Could not generate hash for gallery: {}".format(gallery.title.encode(errors='ignore')))
-                if x == len(galleries):
-                    self.fetch_metadata(hen=hen)
-                continue
-            gallery.hash = hash
-
-            # dict -> hash:[list of title,url tuples] or None
-            self.AUTO_METADATA_PROGRESS.emit("({}/{}) Searching url for gallery: {}".format(x, len(galleries), gallery.title))
-            found_url = hen.search(gallery.hash, **custom_args)
-            if found_url == 'error':
-                app_constants.GLOBAL_EHEN_LOCK = False
-                self.FINISHED.emit(True)
-                return
-            if not gallery.hash in found_url:
-                self.error_galleries.append((gallery, "Could not find url for gallery"))
-                self.AUTO_METADATA_PROGRESS.emit("Could not find url for gallery: {}".format(gallery.title))
-                log_w('Could not find url for gallery: {}'.format(gallery.title.encode(errors='ignore')))
-                if x == len(galleries):
-                    self.fetch_metadata(hen=hen)
-                continue
-            title_url_list = found_url[gallery.hash]
-
-            if not len(title_url_list) > 1 or app_constants.ALWAYS_CHOOSE_FIRST_HIT:
-                title = title_url_list[0][0]
-                url = title_url_list[0][1]
-            else:
-                multiple_hit_galleries.append([gallery, title_url_list])
-                if x == len(galleries):
-                    self.fetch_metadata(hen=hen)
-                continue
-
-            if not gallery.link:
-                if isinstance(hen, (pewnet.EHen, pewnet.ExHen)):
-                    gallery.link = url
-                    self.GALLERY_EMITTER.emit(gallery, None, None)
-            gallery.temp_url = url
-            self.AUTO_METADATA_PROGRESS.emit("({}/{}) Adding to queue: {}".format(
-                x, len(galleries), gallery.title))
-
-            self.fetch_metadata(gallery, hen, x == len(galleries))
+        multiple_hits = collections.deque() # [gallery, title_url_list]
+        picking = [] # the gallery shown in the picker
+        # per run, so an answer left over from an aborted run can't be applied to another gallery
+        picker_queue = queue.Queue()
+        skip_all = False
 
-        if checked_pre_url_galleries:
-            for x, gallery in enumerate(checked_pre_url_galleries, 1):
-                self.AUTO_METADATA_PROGRESS.emit("({}/{}) Adding to queue: {}".format(
-                    x, len(checked_pre_url_galleries), gallery.title))
-                self.fetch_metadata(gallery, hen, x == len(checked_pre_url_galleries))
-
-        if multiple_hit_galleries:
-            skip_all = False
-            multiple_hit_g_queue = []
-            for x, g_data in enumerate(multiple_hit_galleries, 1):
-                gallery = g_data[0]
+        def show_picker():
+            while not picking and multiple_hits:
+                gallery, title_url_list = multiple_hits.popleft()
                 log_w("Multiple galleries found for gallery: {}".format(gallery.title.encode(errors='ignore')))
                 if skip_all:
                     log_w("Skipping gallery")
                     continue
-                title_url_list = g_data[1]
-
+                picking.append(gallery)
                 self.AUTO_METADATA_PROGRESS.emit("Multiple galleries found for gallery: {}".format(gallery.title))
                 app_constants.SYSTEM_TRAY.showMessage('Happypanda', 'Multiple galleries found for gallery:\n{}'.format(gallery.title),
                                     minimized=True)
-                self.GALLERY_PICKER.emit(gallery, title_url_list, self.GALLERY_PICKER_QUEUE)
-                user_choice = self.GALLERY_PICKER_QUEUE.get()
+                self.GALLERY_PICKER.emit(gallery, title_url_list, picker_queue)
 
-                if user_choice == None:
-                    skip_all = True
-                if not user_choice:
-                    log_w("Skipping gallery")
+        def take_choice(block):
+            nonlocal skip_all
+            if not picking:
+                return
+            try:
+                user_choice = picker_queue.get(block)
+            except queue.Empty:
+                return
+            gallery = picking.pop()
+            if user_choice == None:
+                skip_all = True
+            if not user_choice:
+                log_w("Skipping gallery")
+            else:
+                url = user_choice[1]
+                if not gallery.link:
+                    gallery.link = url
+                    if isinstance(hen, (pewnet.EHen, pewnet.ExHen)):
+                        self.GALLERY_EMITTER.emit(gallery, None, None)
+                gallery.temp_url = url
+                self.AUTO_METADATA_PROGRESS.emit("Adding to queue: {}".format(gallery.title))
+                self.fetch_metadata(gallery, hen)
+            show_picker()
+
+        workers = max(app_constants.HASH_WORKERS, 1)
+        with futures.ThreadPoolExecutor(workers) as pool:
+            hashing = collections.deque()
+            to_hash = iter(to_search)
+            x = 0
+            while True:
+                # keep the hash workers ahead of the searches
+                for gallery in to_hash:
+                    # the DB is only used from here, the workers just hash
+                    chap_id = stored = None
+                    if gallery.id and not gallery.hashes:
+                        chap_id, stored = execute(HashDB.get_stored_hashes, False, gallery, 0)
+                    hashing.append((gallery, chap_id, pool.submit(self._search_hash, gallery, color_img, stored)))
+                    if len(hashing) >= workers * 4:
+                        break
+                if not hashing:
+                    break
+                gallery, chap_id, hashed = hashing.popleft()
+                x += 1
+                take_choice(False)
+
+                self.AUTO_METADATA_PROGRESS.emit("({}/{}) Generating gallery hash: {}".format(x, len(to_search), gallery.title))
+                log_i("Generating gallery hash: {}".format(gallery.title.encode(errors='ignore')))
+                hash, new_hashes, custom_args = hashed.result()
+                if new_hashes:
+                    execute(HashDB.insert_hashes, True, gallery.id, chap_id, new_hashes)
+                if not hash:
+                    self.error_galleries.append((gallery, "Could not generate hash"))
+                    log_e("Could not generate hash for gallery: {}".format(gallery.title.encode(errors='ignore')))
+                    continue
+                gallery.hash = utils.hash_to_hex(hash)
+
+                # dict -> hash:[list of title,url tuples] or None
+                self.AUTO_METADATA_PROGRESS.emit("({}/{}) Searching url for gallery: {}".format(x, len(to_search), gallery.title))
+                found_url = hen.search(gallery.hash, **custom_args)
+                if found_url == 'error':
+                    app_constants.GLOBAL_EHEN_LOCK = False
+                    self.FINISHED.emit(True)
+                    return
+                if not gallery.hash in found_url:
+                    self.error_galleries.append((gallery, "Could not find url for gallery"))
+                    self.AUTO_METADATA_PROGRESS.emit("Could not find url for gallery: {}".format(gallery.title))
+                    log_w('Could not find url for gallery: {}'.format(gallery.title.encode(errors='ignore')))
                     continue
+                title_url_list = found_url[gallery.hash]
 
-                title = user_choice[0]
-                url = user_choice[1]
+                if len(title_url_list) > 1 and not app_constants.ALWAYS_CHOOSE_FIRST_HIT:
+                    multiple_hits.append([gallery, title_url_list])
+                    show_picker()
+                    continue
+                url = title_url_list[0][1]
 
                 if not gallery.link:
-                    gallery.link = url
                     if isinstance(hen, (pewnet.EHen, pewnet.ExHen)):
+                        gallery.link = url
                         self.GALLERY_EMITTER.emit(gallery, None, None)
                 gallery.temp_url = url
                 self.AUTO_METADATA_PROGRESS.emit("({}/{}) Adding to queue: {}".format(
-                    x, len(multiple_hit_galleries), gallery.title))
-                multiple_hit_g_queue.append(gallery)
+                    x, len(to_search), gallery.title))
+                self.fetch_metadata(gallery, hen)
 
-            for x, g in enumerate(multiple_hit_g_queue, 1):
-                self.fetch_metadata(g, hen, x == len(multiple_hit_g_queue))
+        while picking:
+            take_choice(True)
+        # fetch what's left of the last batch
+        self.fetch_metadata(hen=hen)
 
 
     def _website_checker(self, url):
@@ -564,6 +636,8 @@ class Fetch(QObject):
                     log_e("{}: {}".format(tup[1], tup[0].title.encode(errors='ignore')))
                 self.FINISHED.emit(self.error_galleries)
             log_i('Auto metadata fetcher is done')
+            log_d('HTTP connections: {}'.format(pewnet.SESSIONS.stats()))
+            log_d('Rate limits: {}'.format(pewnet.LIMITER.stats()))
             app_constants.GLOBAL_EHEN_LOCK = False
         else:
             log_e('Auto metadata fetcher is already running')
@@ -435,7 +435,7 @@ class GalleryModel(QAbstractTableModel):
 
     REMOVING_ROWS = False
 
-    def __init__(self, data, parent=None):
+    def __init__(self, data, parent=None, path_index=None):
         super().__init__(parent)
         self.dataChanged.connect(lambda: self.status_b_msg("Edited"))
         self.dataChanged.connect(lambda: self.ROWCOUNT_CHANGE.emit())
@@ -454,6 +454,7 @@ class GalleryModel(QAbstractTableModel):
         self._PUB_DATE = app_constants.PUB_DATE
 
         self._data = data
+        self._path_index = path_index # kept up to date with the galleries in this model
         self._data_count = 0 # number of items added to model
         self._gallery_to_add = []
         self._gallery_to_remove = []
@@ -658,13 +659,19 @@ class GalleryModel(QAbstractTableModel):
 
         self.beginInsertRows(QModelIndex(), position, position + rows - 1)
         for r in range(rows):
-            self._data.insert(position, self._gallery_to_add.pop())
+            gallery = self._gallery_to_add.pop()
+            self._data.insert(position, gallery)
+            if self._path_index is not None:
+                self._path_index.add(gallery)
         self.endInsertRows()
         return True
 
     def replaceRows(self, list_of_gallery, position, rows=1, index=QModelIndex()):
         "replaces gallery data to the data list WITHOUT adding to DB"
         for pos, gallery in enumerate(list_of_gallery):
+            if self._path_index is not None:
+                self._path_index.remove(self._data[position + pos])
+                self._path_index.add(gallery)
             del self._data[position + pos]
             self._data.insert(position + pos, gallery)
         self.dataChanged.emit(index, index, [Qt.UserRole + 1, Qt.DecorationRole])
@@ -673,10 +680,13 @@ class GalleryModel(QAbstractTableModel):
         self._data_count -= rows
         self.beginRemoveRows(QModelIndex(), position, position + rows - 1)
         for r in range(rows):
+            gallery = self._gallery_to_remove.pop()
             try:
-                self._data.remove(self._gallery_to_remove.pop())
+                self._data.remove(gallery)
             except ValueError:
                 return False
+            if self._path_index is not None:
+                self._path_index.remove(gallery)
         self.endRemoveRows()
         return True
 
@@ -1574,9 +1584,9 @@ class MangaViews:
         self.view_type = v_type
 
         if v_type == app_constants.ViewType.Default:
-            model = GalleryModel(app_constants.GALLERY_DATA, parent)
+            model = GalleryModel(app_constants.GALLERY_DATA, parent, gallerydb.PATH_INDEX)
         elif v_type == app_constants.ViewType.Addition:
-            model = GalleryModel(app_constants.GALLERY_ADDITION_DATA, parent)
+            model = GalleryModel(app_constants.GALLERY_ADDITION_DATA, parent, gallerydb.PATH_INDEX)
         elif v_type == app_constants.ViewType.Duplicate:
             model = GalleryModel([], parent)
 
@@ -1626,15 +1636,14 @@ class MangaViews:
                 g.view = self.view_type
                 if self.view_type != app_constants.ViewType.Duplicate:
                     g.state = app_constants.GalleryState.New
-                if db:
-                    gallerydb.execute(gallerydb.GalleryDB.add_gallery, True, g)
-                else:
-                    if not g.profile:
-                        Executors.generate_thumbnail(g, on_method=g.set_profile)
+                if record_time:
+                    g.qtime = QTime.currentTime()
+            if db:
+                gallerydb.execute(gallerydb.GalleryDB.add_galleries, True, list(gallery))
+            else:
+                Executors.generate_thumbnails([g for g in gallery if not g.profile])
             rows = len(gallery)
             self.list_view.gallery_model._gallery_to_add.extend(gallery)
-            if record_time:
-                g.qtime = QTime.currentTime()
         else:
             gallery.view = self.view_type
             if self.view_type != app_constants.ViewType.Duplicate:
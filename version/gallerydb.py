@@ -13,6 +13,8 @@
 #"""
 
 import datetime
+import time
+import hashlib
 import os
 import enum
 import scandir
@@ -23,6 +25,7 @@ import io
 import uuid
 import functools
 import re as regex
+from concurrent import futures
 from dateutil import parser as dateparser
 
 from PyQt5.QtCore import QObject, pyqtSignal, QTime
@@ -35,6 +38,7 @@ from database.db import DBBase
 from executors import Executors
 
 import app_constants
+import caches
 import utils
 
 log = logging.getLogger(__name__)
@@ -51,9 +55,10 @@ db_constants.METHOD_QUEUE = method_queue
 db_constants.METHOD_RETURN = method_return
 
 class PriorityObject:
-    def __init__(self, priority, data):
+    def __init__(self, priority, data, ret=None):
         self.p = priority
         self.data = data
+        self.ret = ret # queue to put the return value in
 
     def __lt__(self, other):
         return self.p < other.p
@@ -65,7 +70,8 @@ def process_methods():
     method. Named arguments are put in a dict.
     """
     while True:
-        l = method_queue.get().data
+        item = method_queue.get()
+        l = item.data
         log_d('Processing a method from queue...')
         method = l.pop(0)
         log_d(method)
@@ -95,7 +101,7 @@ def process_methods():
         else:
             r = method()
         if not no_return:
-            method_return.put(r)
+            (item.ret or method_return).put(r)
         method_queue.task_done()
 
 method_queue_thread = threading.Thread(name='Method Queue Thread', target=process_methods,
@@ -114,9 +120,11 @@ def execute(method, no_return, *args, **kwargs):
             arg_list.append(x)
     if kwargs:
         arg_list.append(kwargs)
-    method_queue.put(PriorityObject(priority, arg_list))
+    # every call gets its own return queue so callers on different threads can't swap results
+    ret = None if no_return else queue.Queue()
+    method_queue.put(PriorityObject(priority, arg_list, ret))
     if not no_return:
-        return method_return.get()
+        return ret.get()
 
 def chapter_map(row, chapter):
     assert isinstance(chapter, Chapter)
@@ -231,6 +239,73 @@ def default_exec(object):
                 }]
     return executing
 
+class GalleryPathIndex:
+    """
+    Keeps a normcased path -> gallery mapping of the galleries in the gallery models.
+    Models add and remove galleries as rows change, a gallery moves itself when its path is set.
+    Safe to use from any thread.
+    add <- adds a gallery
+    remove <- removes a gallery
+    move <- moves a gallery from its old path to its current path
+    get -> returns the gallery with given path or None
+    get_id -> returns the id of the gallery with given path or None
+    """
+    def __init__(self):
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(path)
+
+    def add(self, gallery):
+        with self._lock:
+            self._paths.setdefault(self._key(gallery.path), []).append(gallery)
+
+    def _remove(self, key, gallery):
+        gs = self._paths.get(key)
+        if gs:
+            for n, g in enumerate(gs):
+                if g is gallery:
+                    del gs[n]
+                    break
+            if not gs:
+                del self._paths[key]
+
+    def remove(self, gallery):
+        with self._lock:
+            self._remove(self._key(gallery.path), gallery)
+
+    def move(self, gallery, old_path):
+        key = self._key(old_path)
+        with self._lock:
+            gs = self._paths.get(key)
+            count = sum(1 for g in gs if g is gallery) if gs else 0
+            for x in range(count):
+                self._remove(key, gallery)
+            if count:
+                self._paths.setdefault(self._key(gallery.path), []).extend([gallery]*count)
+
+    def get(self, path):
+        with self._lock:
+            gs = self._paths.get(self._key(path))
+            return gs[0] if gs else None
+
+    def get_id(self, path):
+        with self._lock:
+            for g in self._paths.get(self._key(path), []):
+                if g.id is not None:
+                    return g.id
+        return None
+
+    def __contains__(self, path):
+        return self._key(path) in self._paths
+
+    def __len__(self):
+        return len(self._paths)
+
+PATH_INDEX = GalleryPathIndex()
+
 class GalleryDB(DBBase):
     """
     Provides the following s methods:
@@ -241,6 +316,8 @@ class GalleryDB(DBBase):
         get_gallery_by_path -> Returns gallery with given path
         get_gallery_by_id -> Returns gallery with given id
         add_gallery -> adds gallery into db
+        add_galleries -> adds a list of galleries into db in one transaction
+        set_profiles -> saves the profiles of a list of galleries
         set_gallery_title -> changes gallery title
         gallery_count -> returns amount of gallery (can be used for indexing)
         del_gallery -> deletes the gallery with the given id recursively
@@ -426,15 +503,10 @@ class GalleryDB(DBBase):
     def get_gallery_by_path(cls, path):
         "Returns gallery with given path"
         assert isinstance(path, str), "Provided path is invalid"
-        cursor = cls.execute(cls, 'SELECT * FROM series WHERE series_path=?', (str.encode(path),))
-        row = cursor.fetchone()
-        try:
-            gallery = Gallery()
-            gallery.id = row['series_id']
-            gallery = gallery_map(row, gallery)
-            return gallery
-        except TypeError:
+        g_id = PATH_INDEX.get_id(path)
+        if g_id is None:
             return None
+        return cls.get_gallery_by_id(g_id)
 
     @classmethod
     def get_gallery_by_id(cls, id):
@@ -469,6 +541,32 @@ class GalleryDB(DBBase):
             TagDB.add_tags(object)
         ChapterDB.add_chapters(object)
 
+    @classmethod
+    def add_galleries(cls, galleries):
+        "Adds a list of galleries into db in one transaction"
+        log_i('Recevied {} galleries'.format(len(galleries)))
+        try:
+            with DBBase.transaction():
+                for g in galleries:
+                    cursor = cls.execute(cls, *default_exec(g))
+                    g.id = cursor.lastrowid
+                    if g.tags:
+                        TagDB.add_tags(g)
+                    ChapterDB.add_chapters(g)
+        except:
+            for g in galleries:
+                g.id = None # rolled back
+            raise
+        # profiles are saved as their thumbnails finish
+        Executors.generate_thumbnails([g for g in galleries if not g.profile],
+                                on_method=lambda gs: execute(cls.set_profiles, True, gs, priority=0))
+
+    @classmethod
+    def set_profiles(cls, galleries):
+        "Saves the profiles of the given galleries"
+        cls.executemany(cls, 'UPDATE series SET profile=? WHERE series_id=?',
+                  [(str.encode(g.profile), g.id) for g in galleries if g.id != None and g.profile])
+
     @classmethod
     def gallery_count(cls):
         """
@@ -503,6 +601,7 @@ class GalleryDB(DBBase):
                     continue
 
             GalleryDB.clear_thumb(gallery.profile)
+            caches.SCAN_SNAPSHOT.invalidate(gallery.path) # rediscover it if it's still there
             cls.execute(cls, 'DELETE FROM series WHERE series_id=?', (gallery.id,))
             gallery.id = None
             log_i('Successfully deleted: {}'.format(gallery.title.encode('utf-8', 'ignore')))
@@ -511,37 +610,19 @@ class GalleryDB(DBBase):
     @staticmethod
     def check_exists(name, galleries=None, filter=True):
         """
-        Checks if provided string exists in provided sorted
+        Checks if provided string exists in provided
         list based on path name.
+        Checks the galleries in the gallery models if no list is provided.
         Note: key will be normcased
         """
-        #pdb.set_trace()
         if galleries is None:
-            galleries = app_constants.GALLERY_DATA + app_constants.GALLERY_ADDITION_DATA
-            filter = True
+            return name in PATH_INDEX
 
         if filter:
-            filter_list = []
-            for gallery in galleries:
-                filter_list.append(os.path.normcase(gallery.path))
-            filter_list = sorted(filter_list)
+            filter_list = set(os.path.normcase(gallery.path) for gallery in galleries)
         else:
             filter_list = galleries
-
-        def binary_search(key):
-            low = 0
-            high = len(filter_list) - 1
-            while high >= low:
-                mid = low + (high - low) // 2
-                if filter_list[mid] < key:
-                    low = mid + 1
-                elif filter_list[mid] > key:
-                    high = mid - 1
-                else:
-                    return True
-            return False
-
-        return binary_search(os.path.normcase(name))
+        return os.path.normcase(name) in filter_list
 
 class ChapterDB(DBBase):
     """
@@ -1025,52 +1106,76 @@ class HashDB(DBBase):
     """
     Contains the following methods:
 
-    find_gallery -> returns galleries which matches the given list of hashes
+    find_gallery -> returns the gallery which has all of the given hashes
+    find_galleries -> returns ids of galleries ranked by how many of the given hashes they have
     get_gallery_hashes -> returns all hashes with the given gallery id in a list
     get_gallery_hash -> returns hash of chapter specified. If page is specified, returns hash of chapter page
+    get_unhashed_chapters -> returns chapters which have missing hashes
+    iter_hash_groups -> yields every hash with the ids of galleries which have it
     gen_gallery_hashes <- generates hashes for gallery's chapters and inserts them to db
     rebuild_gallery_hashes <- inserts hashes into DB only if it doesnt already exist
     """
 
+    _MAX_VARS = 900 # sqlite allows 999 variables per query
+
+    @classmethod
+    def find_galleries(cls, hashes):
+        """
+        Returns a list of (gallery id, amount of matching hashes) of galleries which have
+        any of the given hashes, best match first
+        """
+        hashes = list(set(utils.hash_from_hex(h) for h in hashes))
+        counts = {}
+        for i in range(0, len(hashes), cls._MAX_VARS): # one grouped query unless there are too many hashes
+            chunk = hashes[i:i+cls._MAX_VARS]
+            c = cls.execute(cls, """SELECT series_id, COUNT(DISTINCT hash) AS matches FROM hashes
+                            WHERE hash IN ({}) GROUP BY series_id""".format(','.join('?'*len(chunk))), chunk)
+            for r in c.fetchall():
+                counts[r['series_id']] = counts.get(r['series_id'], 0) + r['matches']
+        return sorted(counts.items(), key=lambda x: x[1], reverse=True)
+
     @classmethod
     def find_gallery(cls, hashes):
+        """
+        Returns the gallery which has all the given hashes, or None
+        """
         assert isinstance(hashes, list)
-        gallery_ids = {}
-        hash_status = []
-        for hash in hashes:
-            r = cls.execute(cls, 'SELECT series_id FROM hashes WHERE hash=?', (hash,))
-            try:
-                g_ids = r.fetchall()
-                for r in g_ids:
-                    g_id = r['series_id']
-                    if g_id not in gallery_ids:
-                        gallery_ids[g_id] = 1
-                    else:
-                        gallery_ids[g_id] = gallery_ids[g_id] + 1
-                if g_ids:
-                    hash_status.append(True)
-                else:
-                    hash_status.append(False)
-            except KeyError:
-                hash_status.append(False)
-            except TypeError:
-                hash_status.append(False)
-
-        if all(hash_status):
-            # the one with most matching hashes
-            g_id = None
-            h_match_count = 0
-            for g in gallery_ids:
-                if gallery_ids[g] > h_match_count:
-                    h_match_count = gallery_ids[h]
-                    g_id = g
-            if g_id:
-                weak_gallery = Gallery()
-                weak_gallery.id = g_id
-                return weak_gallery
-
+        candidates = cls.find_galleries(hashes)
+        if candidates and candidates[0][1] == len(set(utils.hash_from_hex(h) for h in hashes)):
+            weak_gallery = Gallery()
+            weak_gallery.id = candidates[0][0]
+            return weak_gallery
         return None
-    
+
+    @classmethod
+    def iter_hash_groups(cls, batch=50000):
+        """
+        Yields (hash, set of gallery ids) for every hash in DB, ordered by hash.
+        Rows are fetched in batches to keep memory down
+        """
+        last = b''
+        while True:
+            c = cls.execute(cls, 'SELECT hash, series_id FROM hashes WHERE hash > ? ORDER BY hash LIMIT ?',
+                   (last, batch))
+            rows = c.fetchall()
+            if not rows:
+                return
+            if len(rows) == batch:
+                if rows[0]['hash'] == rows[-1]['hash']: # one huge group
+                    c = cls.execute(cls, 'SELECT hash, series_id FROM hashes WHERE hash = ?', (rows[0]['hash'],))
+                    rows = c.fetchall()
+                else: # the last group might continue in the next batch
+                    rows = [r for r in rows if r['hash'] != rows[-1]['hash']]
+            group_hash, group = None, set()
+            for r in rows:
+                if r['hash'] != group_hash:
+                    if group:
+                        yield group_hash, group
+                    group_hash, group = r['hash'], set()
+                group.add(r['series_id'])
+            yield group_hash, group
+            last = group_hash
+
     @classmethod
     def get_gallery_hashes(cls, gallery_id):
         "Returns all hashes with the given gallery id in a list"
@@ -1111,6 +1216,33 @@ class HashDB(DBBase):
                 pass
         return hashes
 
+    @classmethod
+    def get_unhashed_chapters(cls, after=0):
+        """
+        Returns a list of (gallery id, chapter number) of chapters with missing hashes,
+        ordered by gallery id. Only galleries with an id above after are included
+        """
+        c = cls.execute(cls, """SELECT chapters.series_id, chapters.chapter_number FROM chapters
+                        LEFT JOIN (SELECT chapter_id, COUNT(*) AS n FROM hashes GROUP BY chapter_id) AS h
+                        ON h.chapter_id = chapters.chapter_id
+                        WHERE chapters.series_id > ? AND chapters.pages > IFNULL(h.n, 0)
+                        ORDER BY chapters.series_id, chapters.chapter_number""", (after,))
+        return [(r['series_id'], r['chapter_number']) for r in c.fetchall()]
+
+    @classmethod
+    def get_chapter_hashes(cls, chapter=0):
+        """
+        Returns the stored page hashes of the given chapter number of every gallery
+        in one query, as a dict of gallery id -> {page: hash}
+        """
+        c = cls.execute(cls, """SELECT hashes.series_id, hashes.page, hashes.hash FROM hashes
+                        INNER JOIN chapters ON chapters.chapter_id = hashes.chapter_id
+                        WHERE chapters.chapter_number = ?""", (chapter,))
+        hashes = {}
+        for r in c.fetchall():
+            hashes.setdefault(r['series_id'], {})[r['page']] = r['hash']
+        return hashes
+
     @classmethod
     def gen_gallery_hash(cls, gallery, chapter, page=None, color_img=False, _name=None):
         """
@@ -1120,23 +1252,53 @@ class HashDB(DBBase):
         color_img: if true then a hash to colored img will be returned if possible
         Returns dict with chapter number or 'mid' as key and hash as value
         """
+        chap_id = stored = None
+        if gallery.id:
+            chap_id, stored = cls.get_stored_hashes(gallery, chapter)
+        r_hash, new_hashes = cls.hash_chapter(gallery, chapter, page, color_img, _name, stored)
+        if new_hashes:
+            cls.insert_hashes(gallery.id, chap_id, new_hashes)
+        return r_hash
+
+    @classmethod
+    def get_stored_hashes(cls, gallery, chapter):
+        "Returns the chapter id and a dict of page -> hash of the hashes in DB of a chapter"
+        chap_id = ChapterDB.get_chapter_id(gallery.id, chapter)
+        c = cls.execute(cls, 'SELECT hash, page FROM hashes WHERE series_id=? AND chapter_id=?',
+               (gallery.id, chap_id,))
+        hashes = {}
+        for r in c.fetchall():
+            try:
+                if r['hash'] and r['page'] != None:
+                    hashes[r['page']] = r['hash']
+            except TypeError:
+                pass
+        return chap_id, hashes
+
+    @classmethod
+    def insert_hashes(cls, gallery_id, chap_id, hashes):
+        "Inserts a dict of page -> hash of a chapter into DB"
+        cls.executemany(cls, 'INSERT INTO hashes(hash, series_id, chapter_id, page) VALUES(?, ?, ?, ?)',
+               [(hashes[p], gallery_id, chap_id, p) for p in hashes])
+
+    @classmethod
+    def hash_chapter(cls, gallery, chapter, page=None, color_img=False, _name=None, stored=None):
+        """
+        Same as gen_gallery_hash but doesn't touch the DB, so it can run on any thread.
+        stored is the dict of page -> hash already in DB, see get_stored_hashes, or None
+        if the gallery isn't in DB.
+        Returns the dict gen_gallery_hash would return and a dict of page -> hash of
+        the generated hashes missing from stored
+        """
         assert isinstance(gallery, Gallery)
         assert isinstance(chapter, int)
         if page != None:
             assert isinstance(page, (int, str, list))
         skip_gen = False
-        if gallery.id:
-            chap_id = ChapterDB.get_chapter_id(gallery.id, chapter)
-            
-            c = cls.execute(cls, 'SELECT hash, page FROM hashes WHERE series_id=? AND chapter_id=?',
-                   (gallery.id, chap_id,))
-            hashes = {}
-            for r in c.fetchall():
-                try:
-                    if r['hash'] and r['page'] != None:
-                        hashes[r['page']] = r['hash']
-                except TypeError:
-                    pass
+        new_hashes = {}
+        if stored != None:
+            hashes = dict(stored)
+            existing = stored
             if isinstance(page, (int, list)):
                 if isinstance(page, int):
                     _page = [page]
@@ -1164,21 +1326,19 @@ class HashDB(DBBase):
 
         if not skip_gen or color_img:
 
-            def look_exists(page):
-                """check if hash already exists in database
-                returns hash, else returns None"""
-                c = cls.execute(cls, 'SELECT hash FROM hashes WHERE page=? AND chapter_id=?',
-                       (page, chap_id,))
-                try: # exists
-                    return c.fetchone()['hash']
-                except TypeError: # doesnt exist
-                    return None
-                except IndexError:
-                    return None
+            def hash_missing(pages, archive=None):
+                """hashes only the pages which aren't in the database yet
+                and collects the new ones in new_hashes"""
+                if stored == None:
+                    return Executors.hash_pages(pages, archive)
+                hashes = {p:existing[p] for p in pages if p in existing}
+                new_hashes.update(Executors.hash_pages({p:pages[p] for p in pages if p not in hashes}, archive))
+                hashes.update(new_hashes)
+                return hashes
 
             if gallery.dead_link:
                 log_e("Could not generate hash of dead gallery: {}".format(gallery.title.encode(errors='ignore')))
-                return {}
+                return {}, {}
 
             try:
                 chap = gallery.chapters[chapter]
@@ -1187,9 +1347,8 @@ class HashDB(DBBase):
                 try:
                     chap = gallery.chapters[chapter]
                 except KeyError:
-                    return {}
-                
-            executing = []
+                    return {}, {}
+
             try:
                 if gallery.is_archive:
                     raise NotADirectoryError
@@ -1203,7 +1362,7 @@ class HashDB(DBBase):
                     if color_img:
                         # if first img is colored, then return filepath of that
                         if not utils.image_greyscale(imgs[0]):
-                            return {'color':imgs[0]}
+                            return {'color':imgs[0]}, {}
                     if page == 'mid':
                         imgs = imgs[len(imgs) // 2]
                         pages[len(imgs) // 2] = imgs
@@ -1217,31 +1376,19 @@ class HashDB(DBBase):
                         imgs = imgs[page]
                         pages = {page:imgs}
 
-                hashes = {}
-                if gallery.id != None:
-                    for p in pages:
-                        h = look_exists(p)
-                        if not h:
-                            with open(pages[p], 'rb') as f:
-                                h = generate_img_hash(f)
-                            executing.append((h, gallery.id, chap_id, p,))
-                        hashes[p] = h
-                else:
-                    for i in pages:
-                        with open(pages[i], 'rb') as f:
-                            hashes[i] = generate_img_hash(f)
+                hashes = hash_missing(pages)
 
             except NotADirectoryError:
                 temp_dir = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
                 is_archive = gallery.is_archive
                 try:
                     if is_archive:
-                        zip = ArchiveFile(gallery.path)
+                        zip = utils.open_archive(gallery.path)
                     else:
-                        zip = ArchiveFile(chap.path)
+                        zip = utils.open_archive(chap.path)
                 except app_constants.CreateArchiveFail:
                     log_e('Could not generate hash: CreateZipFail')
-                    return {}
+                    return {}, {}
 
                 pages = {}
                 if page != None:
@@ -1251,43 +1398,27 @@ class HashDB(DBBase):
                         # if first img is colored, then return hash of that
                         f_bytes = io.BytesIO(zip.open(con[0], False))
                         if not utils.image_greyscale(f_bytes):
-                            return {'color':zip.extract(con[0])}
+                            color_path = zip.extract(con[0])
+                            zip.close()
+                            return {'color':color_path}, {}
                         f_bytes.close()
                     if page == 'mid':
                         p = len(con) // 2
-                        img = con[p]
-                        pages = {p:zip.open(img, True)}
+                        pages = {p:con[p]}
                     elif isinstance(page, list):
                         for x in page:
-                            pages[x] = zip.open(con[x], True)
+                            pages[x] = con[x]
                     else:
-                        p = page
-                        img = con[p]
-                        pages = {p:zip.open(img, True)}
-
+                        pages = {page:con[page]}
 
                 else:
                     imgs = sorted(zip.dir_contents(chap.path))
                     for n, img in enumerate(imgs):
-                        pages[n] = zip.open(img, True)
-                zip.close()
-
-                hashes = {}
-                if gallery.id != None:
-                    for p in pages:
-                        h = look_exists(p)
-                        if not h:
-                            h = generate_img_hash(pages[p])
-                            executing.append((h, gallery.id, chap_id, p,))
-                        hashes[p] = h
-                else:
-                    for i in pages:
-                        hashes[i] = generate_img_hash(pages[i])
-
-            if executing:
-                cls.executemany(cls, 'INSERT INTO hashes(hash, series_id, chapter_id, page) VALUES(?, ?, ?, ?)',
-                       executing)
-
+                        pages[n] = img
+                try:
+                    hashes = hash_missing(pages, zip)
+                finally:
+                    zip.close()
 
         if page == 'mid':
             r_hash = {'mid':list(hashes.values())[0]}
@@ -1299,7 +1430,7 @@ class HashDB(DBBase):
                 r_hash[_name] = r_hash[page]
             except KeyError:
                 pass
-        return r_hash
+        return r_hash, new_hashes
 
     @classmethod
     def gen_gallery_hashes(cls, gallery):
@@ -1523,7 +1654,10 @@ class Gallery:
 
     @path.setter
     def path(self, n_p):
+        o_p = self._path
         self._path = n_p
+        if o_p != n_p:
+            PATH_INDEX.move(self, o_p)
         _, ext = os.path.splitext(n_p)
         if ext:
             self.file_type = ext[1:].lower() # remove dot
@@ -1879,18 +2013,23 @@ class Chapter:
         except KeyError:
             return None
 
+    def open_args(self):
+        "Returns the arguments for utils.open_chapter"
+        if self.in_archive:
+            if self.gallery.is_archive:
+                return self.path, self.gallery.path
+            else:
+                return '', self.path
+        return self.path,
+
     def open(self, stat_msg=True):
         if stat_msg:
             txt = "Opening chapter {} of {}".format(self.number + 1, self.gallery.title)
             app_constants.STAT_MSG_METHOD(txt)
             app_constants.NOTIF_BAR.add_text(txt)
-        if self.in_archive:
-            if self.gallery.is_archive:
-                execute(utils.open_chapter, True, self.path, self.gallery.path)
-            else:
-                execute(utils.open_chapter, True, '', self.path)
-        else:
-            execute(utils.open_chapter, True, self.path)
+        next_chapter = self.next_chapter
+        Executors.open_chapter(*self.open_args(),
+                         prefetch=next_chapter.open_args() if next_chapter else None)
         self.gallery.times_read += 1
         self.gallery.last_read = datetime.datetime.now().replace(microsecond=0)
         execute(GalleryDB.modify_gallery, True, self.gallery.id, times_read=self.gallery.times_read,
@@ -1962,7 +2101,7 @@ class ChaptersContainer:
             return False
         chap = self[number]
         if chap.in_archive:
-            _archive = utils.ArchiveFile(chap.gallery.path)
+            _archive = utils.open_archive(chap.gallery.path)
             chap.pages = len([x for x in _archive.dir_contents(chap.path) if x.endswith(IMG_FILES)])
             _archive.close()
         else:
@@ -2244,6 +2383,275 @@ class DatabaseStartup(QObject):
             g.hashes = execute(HashDB.get_gallery_hashes, False, g.id)
 
 
+class PHashDB(DBBase):
+    """
+    Perceptual hashes of a few sampled pages of each gallery's first chapter,
+    used to find re-encoded or resized copies of galleries.
+    Hashes are stored as signed 64 bit integers.
+
+    get_all_phashes -> returns a dict of gallery id -> list of perceptual hashes
+    gen_gallery_phashes -> generates missing perceptual hashes for gallery and inserts them to db
+    phash_pages -> generates missing perceptual hashes for gallery without touching the db
+    insert_phashes <- inserts a dict of page -> perceptual hash of a gallery to db
+    """
+    SAMPLE_PAGES = 4
+
+    @staticmethod
+    def _to_db(h):
+        return h - (1 << 64) if h >= (1 << 63) else h
+
+    @staticmethod
+    def _from_db(h):
+        return h + (1 << 64) if h < 0 else h
+
+    @classmethod
+    def get_all_phashes(cls):
+        c = cls.execute(cls, 'SELECT series_id, phash FROM phashes')
+        phashes = {}
+        for r in c.fetchall():
+            phashes.setdefault(r['series_id'], []).append(cls._from_db(r['phash']))
+        return phashes
+
+    @classmethod
+    def gen_gallery_phashes(cls, gallery):
+        assert isinstance(gallery, Gallery)
+        c = cls.execute(cls, 'SELECT page, phash FROM phashes WHERE series_id=?', (gallery.id,))
+        phashes = {r['page']:cls._from_db(r['phash']) for r in c.fetchall()}
+        new_phashes = cls.phash_pages(gallery, phashes)
+        if new_phashes:
+            cls.insert_phashes(gallery.id, new_phashes)
+        phashes.update(new_phashes)
+        return list(phashes.values())
+
+    @classmethod
+    def insert_phashes(cls, gallery_id, phashes):
+        cls.executemany(cls, 'INSERT OR REPLACE INTO phashes(phash, series_id, page) VALUES(?, ?, ?)',
+               [(cls._to_db(phashes[p]), gallery_id, p) for p in phashes])
+
+    @classmethod
+    def phash_pages(cls, gallery, stored):
+        """
+        Generates the perceptual hashes of the sampled pages missing from stored, a dict of
+        page -> perceptual hash. Doesn't touch the db so it can run on any thread.
+        Returns a dict of page -> perceptual hash
+        """
+        assert isinstance(gallery, Gallery)
+        try:
+            chap = gallery.chapters[0]
+        except KeyError:
+            return {}
+        pages = utils.sample_pages(chap.pages, cls.SAMPLE_PAGES)
+        missing = [p for p in pages if p not in stored]
+        new_phashes = {}
+        if not missing:
+            return new_phashes
+
+        try:
+            if gallery.is_archive or chap.in_archive:
+                zip = utils.open_archive(gallery.path if gallery.is_archive else chap.path)
+                try:
+                    imgs = sorted([x for x in zip.dir_contents(chap.path if gallery.is_archive else '')\
+                        if x.lower().endswith(utils.IMG_FILES)])
+                    for p in missing:
+                        if p < len(imgs):
+                            new_phashes[p] = utils.image_dhash(io.BytesIO(zip.open(imgs[p])))
+                finally:
+                    zip.close()
+            else:
+                imgs = sorted([x.path for x in scandir.scandir(chap.path) if x.name.lower().endswith(utils.IMG_FILES)])
+                for p in missing:
+                    if p < len(imgs):
+                        new_phashes[p] = utils.image_dhash(imgs[p])
+        except (app_constants.CreateArchiveFail, OSError, ValueError):
+            log.exception('Could not generate perceptual hash: {}'.format(gallery.title.encode(errors='ignore')))
+        return new_phashes
+
+class DuplicateFinder:
+    """
+    Finds duplicate galleries in one pass by putting them into buckets keyed by
+    normalized title and normalized path.
+    In advanced mode galleries are also grouped by identical content (page counts and page hashes)
+    and by how many page hashes they share, see threshold.
+    If phash_distance is set, galleries whose sampled pages look alike (see PHashDB) are grouped too.
+    find -> yields tuples of galleries as soon as they are found to be duplicates,
+        each gallery is only yielded once, except to go with a gallery found later
+    """
+    COMMON_HASH = 10 # hashes shared by more galleries than this are ignored, e.g. scanlator credit pages
+
+    def __init__(self, advanced=False, threshold=0.5, phash_distance=None):
+        self.advanced = advanced
+        self.threshold = threshold # fraction of the smaller gallery's pages which must be shared
+        self.phash_distance = phash_distance # max hamming distance of similar pages, None to skip
+        self._found = set()
+        self._buckets = {}
+
+    def _new(self, galleries):
+        "Returns the galleries not yielded before, with one which was if only one is new"
+        new = tuple(g for g in galleries if g.id not in self._found)
+        self._found.update(g.id for g in new)
+        if len(new) == 1: # the others have been yielded already, but it needs something to compare with
+            new = (next(g for g in galleries if g.id != new[0].id),) + new
+        return new
+
+    def _bucket(self, key, gallery):
+        bucket = self._buckets.setdefault(key, [])
+        bucket.append(gallery)
+        if len(bucket) > 1:
+            return self._new(bucket)
+
+    def find(self, galleries):
+        by_id = {}
+        for g in galleries:
+            by_id[g.id] = g
+            for key in (('title', g.title.strip().lower()), ('path', os.path.normcase(g.path))):
+                new = self._bucket(key, g)
+                if new:
+                    yield new
+        if not self.advanced:
+            return
+
+        content = {} # gallery id -> sha1 of all its hashes, they arrive in sorted order
+        count = {}
+        shared = {}
+        for h, ids in HashDB.iter_hash_groups():
+            ids = [i for i in ids if i in by_id]
+            for i in ids:
+                content.setdefault(i, hashlib.sha1()).update(h)
+                count[i] = count.get(i, 0) + 1
+            if 1 < len(ids) <= self.COMMON_HASH:
+                ids.sort()
+                for n, a in enumerate(ids):
+                    for b in ids[n+1:]:
+                        shared[(a, b)] = shared.get((a, b), 0) + 1
+
+        for i in content:
+            g = by_id[i]
+            pages = tuple(c.pages for c in g.chapters) if g.chapters else ()
+            new = self._bucket(('content', pages, content[i].digest()), g)
+            if new:
+                yield new
+        for (a, b), n in shared.items():
+            if n >= self.threshold * min(count[a], count[b]):
+                new = self._new((by_id[a], by_id[b]))
+                if new:
+                    yield new
+
+        if self.phash_distance is not None:
+            for new in self._find_similar(by_id):
+                yield new
+
+    def _find_similar(self, by_id):
+        phashes = PHashDB.get_all_phashes()
+        # the missing ones are generated on a pool, only this thread touches the db
+        missing = [g for g in by_id.values() if g.id not in phashes]
+        if missing:
+            with futures.ThreadPoolExecutor(app_constants.HASH_WORKERS) as pool:
+                for g, new_phashes in zip(missing, pool.map(lambda g: PHashDB.phash_pages(g, {}), missing)):
+                    if new_phashes:
+                        PHashDB.insert_phashes(g.id, new_phashes)
+                    phashes[g.id] = list(new_phashes.values())
+        tree = utils.BKTree()
+        for g_id in by_id:
+            for h in phashes.get(g_id, []):
+                tree.add(h, g_id)
+        for g_id in by_id:
+            own = phashes.get(g_id, [])
+            matches = {}
+            for h in own:
+                for other in set(i for _, i in tree.search(h, self.phash_distance)):
+                    if other != g_id:
+                        matches[other] = matches.get(other, 0) + 1
+            for other, n in matches.items():
+                if n >= self.threshold * min(len(own), len(phashes[other])):
+                    new = self._new((by_id[g_id], by_id[other]))
+                    if new:
+                        yield new
+
+class HashBackfill(QObject):
+    """
+    Generates missing hashes for the whole library in the background.
+    Only hashes while the user is idle and no downloads are active, and stays
+    within the CPU and I/O budget from settings.
+    position is the last gallery id handled, pass it back in to resume after a restart.
+    The DB is only used through the method queue, the pages are hashed on the hash workers.
+    PROGRESS: emitted with galleries handled and total galleries to handle
+    POSITION: emitted with position every SAVE_EVERY galleries so it can be saved
+    DONE: emitted when finished or stopped
+    """
+    PROGRESS = pyqtSignal(int, int)
+    POSITION = pyqtSignal(int)
+    DONE = pyqtSignal()
+    SAVE_EVERY = 10
+
+    def __init__(self, position=0):
+        super().__init__()
+        self.position = position
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+
+    def _idle(self):
+        if time.time() - app_constants.LAST_USER_ACTIVITY < app_constants.HASH_BACKFILL_IDLE:
+            return False
+        if app_constants.DOWNLOAD_MANAGER and app_constants.DOWNLOAD_MANAGER.active_items:
+            return False
+        return True
+
+    def _throttle(self, work_time, read_bytes):
+        "Sleeps long enough to stay within the CPU and I/O budget"
+        cpu = min(max(app_constants.HASH_BACKFILL_CPU, 1), 100) / 100
+        pause = work_time * (1 / cpu - 1)
+        if app_constants.HASH_BACKFILL_IO > 0:
+            pause = max(pause, read_bytes / (app_constants.HASH_BACKFILL_IO * 1048576) - work_time)
+        time.sleep(pause)
+
+    def _hash_gallery(self, g_id, chapters):
+        "Hashes the given chapter numbers of a gallery, returns False if stopped before finishing"
+        gallery = execute(GalleryDB.get_gallery_by_id, False, g_id)
+        if not gallery:
+            log_d('Hash backfill: gallery {} no longer exists'.format(g_id))
+            return True
+        if not os.path.exists(gallery.path):
+            return True
+        for chap_number in chapters:
+            while not self._stop and not self._idle():
+                time.sleep(1)
+            if self._stop:
+                return False
+            start = time.time()
+            read_bytes = Executors.hash_stats['bytes']
+            try:
+                chap_id, stored = execute(HashDB.get_stored_hashes, False, gallery, chap_number)
+                new_hashes = HashDB.hash_chapter(gallery, chap_number, stored=stored)[1]
+                if new_hashes:
+                    execute(HashDB.insert_hashes, True, gallery.id, chap_id, new_hashes)
+            except Exception:
+                log.exception('Hash backfill: could not hash {}'.format(gallery.title.encode(errors='ignore')))
+            self._throttle(time.time() - start, Executors.hash_stats['bytes'] - read_bytes)
+        return True
+
+    def start(self):
+        galleries = [] # (gallery id, [chapter numbers]), ordered by gallery id
+        for g_id, chap_number in execute(HashDB.get_unhashed_chapters, False, self.position):
+            if not galleries or galleries[-1][0] != g_id:
+                galleries.append((g_id, []))
+            galleries[-1][1].append(chap_number)
+        total = len(galleries)
+        log_i('Hash backfill: {} galleries with missing hashes'.format(total))
+        for done, (g_id, chapters) in enumerate(galleries, 1):
+            if not self._hash_gallery(g_id, chapters):
+                break
+            self.position = g_id
+            self.PROGRESS.emit(done, total)
+            if done % self.SAVE_EVERY == 0:
+                self.POSITION.emit(self.position)
+        else:
+            self.position = 0 # start over on next run
+            self.POSITION.emit(self.position)
+            log_i('Hash backfill: OK')
+        self.DONE.emit()
+
 if __name__ == '__main__':
     #unit testing here
     pass
@@ -1,8 +1,12 @@
-﻿import logging, os, json, datetime, random, re, queue
+﻿import logging, os, json, gzip, datetime, random, re, queue, time, threading, collections
 
-from watchdog.events import FileSystemEventHandler, DirDeletedEvent
+from watchdog.events import (FileSystemEventHandler, DirDeletedEvent, DirCreatedEvent,
+                             FileCreatedEvent, FileDeletedEvent, DirMovedEvent,
+                             FileMovedEvent, DirModifiedEvent, FileModifiedEvent)
 from watchdog.observers import Observer
 from threading import Timer
+from concurrent import futures
+import scandir
 
 from PyQt5.QtCore import (Qt, QObject, pyqtSignal, QTimer, QSize, QThread)
 from PyQt5.QtGui import (QPixmap, QIcon, QColor, QTextOption, QKeySequence)
@@ -14,6 +18,7 @@ from PyQt5.QtWidgets import (QWidget, QHBoxLayout, QVBoxLayout,
                              QShortcut, QMenu, qApp)
 
 import app_constants
+import caches
 import misc
 import gallerydb
 import utils
@@ -584,15 +589,135 @@ class DeletedPopup(misc.BasePopup):
         self.adjustSize()
         self.show()
 
+class WatcherEventQueue:
+    """
+    Holds filesystem events back until nothing has happened at or below their path
+    for the quiet period, so that copies in progress can settle before they are looked at.
+    Created events below a pending created folder are merged into it.
+    A created event at the path of a pending deleted or moved event is queued once that one has settled.
+    Settled events are passed to on_settle in batches of [kind, path, dest, last seen] on a worker thread.
+    add <- adds a 'created', 'deleted' or 'moved' event
+    touch <- marks activity at path, postponing the pending events of its parent folders
+    """
+    def __init__(self, on_settle, quiet=3):
+        self.on_settle = on_settle
+        self.quiet = quiet
+        self._pending = collections.OrderedDict() # normcased path -> [kind, path, dest, last seen]
+        self._after = {} # normcased path -> path created behind a pending deleted or moved event
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._work, name='watcher events', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _parents(key):
+        parent = os.path.dirname(key)
+        while parent and parent != key:
+            yield parent
+            key, parent = parent, os.path.dirname(parent)
+
+    def _touch(self, key, now):
+        "Postpones pending parents of key, returns the closest pending created parent"
+        created = None
+        for p in self._parents(key):
+            e = self._pending.get(p)
+            if e:
+                e[3] = now
+                if not created and e[0] == 'created':
+                    created = e
+        return created
+
+    def touch(self, path):
+        with self._cond:
+            if self._pending:
+                self._touch(os.path.normcase(path), time.monotonic())
+
+    def add(self, kind, path, dest=None):
+        key = os.path.normcase(path)
+        now = time.monotonic()
+        with self._cond:
+            e = self._pending.get(key)
+            if kind == 'created':
+                if self._touch(key, now):
+                    return # will be looked at with its parent
+                if e and e[0] != 'created':
+                    self._after[key] = path
+                    return
+                prefix = os.path.join(key, '')
+                for k in [k for k, x in self._pending.items() if k.startswith(prefix) and x[0] == 'created']:
+                    del self._pending[k]
+                self._pending[key] = ['created', path, None, now]
+            elif key in self._after:
+                # the queued create never settled, the pending event at key stays
+                del self._after[key]
+                if kind == 'moved':
+                    self.add('created', dest)
+                return
+            elif e and e[0] == 'created':
+                # it never settled, only the new location matters
+                del self._pending[key]
+                if kind == 'moved':
+                    self.add('created', dest)
+                return
+            else:
+                self._touch(key, now)
+                self._pending[key] = [kind, path, dest, now]
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                settled = [k for k, e in self._pending.items() if now - e[3] >= self.quiet]
+                if not settled:
+                    self._cond.wait(min(e[3] for e in self._pending.values()) + self.quiet - now)
+                    continue
+                batch = [self._pending.pop(k) for k in settled]
+                for k in settled:
+                    if k in self._after:
+                        self.add('created', self._after.pop(k))
+            try:
+                self.on_settle(batch)
+            except Exception:
+                log.exception('Failed to process filesystem events')
+
 class GalleryHandler(FileSystemEventHandler, QObject):
-    CREATE_SIGNAL = pyqtSignal(str)
+    CREATE_SIGNAL = pyqtSignal(list)
     MODIFIED_SIGNAL = pyqtSignal(str, int)
     DELETED_SIGNAL = pyqtSignal(str, object)
     MOVED_SIGNAL = pyqtSignal(str, object)
 
     def __init__(self):
         super().__init__()
-        #self.g_queue = []
+        self.events = WatcherEventQueue(self.process_events, app_constants.MONITOR_QUIET_PERIOD)
+
+    def process_events(self, batch):
+        "Looks at settled events, emits all new galleries at once"
+        created = []
+        for kind, path, dest, _ in batch:
+            if kind == 'created':
+                gs = 0
+                if not os.path.exists(path):
+                    continue
+                if path.endswith(utils.ARCHIVE_FILES):
+                    gs = len(utils.check_archive(path))
+                elif os.path.isdir(path):
+                    g_dirs, g_archs = utils.recursive_gallery_check(path)
+                    gs = len(g_dirs) + len(g_archs)
+                if gs:
+                    created.append(path)
+            elif kind == 'deleted':
+                gallery = gallerydb.GalleryDB.get_gallery_by_path(path)
+                if gallery:
+                    self.DELETED_SIGNAL.emit(path, gallery)
+            elif kind == 'moved':
+                gallery = gallerydb.GalleryDB.get_gallery_by_path(path)
+                if gallery:
+                    self.MOVED_SIGNAL.emit(dest, gallery)
+        if created:
+            log_i('Found {} new paths with galleries'.format(len(created)))
+            self.CREATE_SIGNAL.emit(created)
 
     def file_filter(self, event):
         if os.path.normcase(event.src_path) in app_constants.TEMP_PATH_IGNORE:
@@ -615,27 +740,21 @@ class GalleryHandler(FileSystemEventHandler, QObject):
 
     #	self.g_queue = []
 
+    def on_any_event(self, event):
+        # any activity, like files being written into a new folder, postpones its pending events
+        self.events.touch(event.src_path)
+
     def on_created(self, event):
         if not app_constants.OVERRIDE_MONITOR:
             if self.file_filter(event):
-                gs = 0
-                if event.src_path.endswith(utils.ARCHIVE_FILES):
-                    gs = len(utils.check_archive(event.src_path))
-                elif event.is_directory:
-                    g_dirs, g_archs = utils.recursive_gallery_check(event.src_path)
-                    gs = len(g_dirs) + len(g_archs)
-                if gs:
-                    self.CREATE_SIGNAL.emit(event.src_path)
+                self.events.add('created', event.src_path)
         else:
             app_constants.OVERRIDE_MONITOR = False
 
     def on_deleted(self, event):
         if not app_constants.OVERRIDE_MONITOR:
             if self.file_filter(event):
-                path = event.src_path
-                gallery = gallerydb.GalleryDB.get_gallery_by_path(path)
-                if gallery:
-                    self.DELETED_SIGNAL.emit(path, gallery)
+                self.events.add('deleted', event.src_path)
         else:
             app_constants.OVERRIDE_MONITOR = False
 
@@ -645,19 +764,146 @@ class GalleryHandler(FileSystemEventHandler, QObject):
     def on_moved(self, event):
         if not app_constants.OVERRIDE_MONITOR:
             if self.file_filter(event):
-                old_path = event.src_path
-                gallery = gallerydb.GalleryDB.get_gallery_by_path(old_path)
-                if gallery:
-                    self.MOVED_SIGNAL.emit(event.dest_path, gallery)
+                self.events.add('moved', event.src_path, event.dest_path)
         else:
             app_constants.OVERRIDE_MONITOR = False
 
+class GalleryPoller:
+    """
+    Watches a monitored folder by polling it, for network shares where no filesystem events are delivered.
+    A snapshot of the (mtime, size) of the folders and archives below the folder is kept,
+    folders use the amount of their entries as size and single images are left out.
+    Every poll lists the folders with a bounded amount of threads, and the differences to the
+    previous snapshot are dispatched to the handler as watchdog events.
+    stats -> seconds, cpu seconds, listed folders, stat calls and changes of the last poll
+    """
+    def __init__(self, handler, path, interval=60, workers=4):
+        self.handler = handler
+        self.path = path
+        self.interval = interval
+        self.workers = max(workers, 1)
+        self.stats = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='gallery poller', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def _is_dir(path):
+        return not path.endswith(utils.ARCHIVE_FILES)
+
+    def _list_dir(self, path):
+        "Returns (path, stamp of path, subfolders, dict of archive -> stamp, stat calls)"
+        dirs = []
+        archives = {}
+        stats = 1
+        try:
+            mtime = os.stat(path).st_mtime
+            entries = list(scandir.scandir(path))
+        except OSError:
+            return path, None, dirs, archives, stats
+        for e in entries:
+            try:
+                if e.is_dir():
+                    dirs.append(e.path)
+                elif e.name.endswith(utils.ARCHIVE_FILES):
+                    st = e.stat()
+                    stats += 1
+                    archives[e.path] = (st.st_mtime, st.st_size)
+            except OSError:
+                pass
+        return path, (mtime, len(entries)), dirs, archives, stats
+
+    def snapshot(self):
+        "Returns a dict of path -> stamp of the folders and archives below the watched folder"
+        snap = {}
+        listed = stats = 0
+        with futures.ThreadPoolExecutor(self.workers) as pool:
+            pending = {pool.submit(self._list_dir, self.path)}
+            while pending:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for f in done:
+                    path, stamp, dirs, archives, s = f.result()
+                    listed += 1
+                    stats += s
+                    snap.update(archives)
+                    for d in dirs:
+                        pending.add(pool.submit(self._list_dir, d))
+                    if stamp and path != self.path: # the watched folder itself is left out
+                        snap[path] = stamp
+        self.stats['folders'] = listed
+        self.stats['stat calls'] = stats
+        return snap
+
+    def _diff(self, old, new):
+        "Returns the watchdog events describing the differences between two snapshots"
+        # only the top of a new or removed tree is reported
+        added = new.keys() - old.keys()
+        removed = old.keys() - new.keys()
+        created = [p for p in added if os.path.dirname(p) not in added]
+        deleted = [p for p in removed if os.path.dirname(p) not in removed]
+        events = []
+        # an entry which disappeared and one which appeared with the same stamp were moved
+        by_stamp = collections.defaultdict(list)
+        for p in created:
+            by_stamp[(new[p], self._is_dir(p))].append(p)
+        for p in deleted:
+            match = by_stamp.get((old[p], self._is_dir(p)))
+            if match and len(match) == 1:
+                dest = match.pop()
+                created.remove(dest)
+                events.append(DirMovedEvent(p, dest) if self._is_dir(p) else FileMovedEvent(p, dest))
+            else:
+                events.append(DirDeletedEvent(p) if self._is_dir(p) else FileDeletedEvent(p))
+        for p in created:
+            events.append(DirCreatedEvent(p) if self._is_dir(p) else FileCreatedEvent(p))
+        for p in new:
+            if p in old and new[p] != old[p]:
+                events.append(DirModifiedEvent(p) if self._is_dir(p) else FileModifiedEvent(p))
+        return events
+
+    def poll(self, old):
+        "Dispatches the changes since the old snapshot, returns the new snapshot"
+        start, cpu = time.time(), time.process_time()
+        new = self.snapshot()
+        events = self._diff(old, new)
+        for e in events:
+            self.handler.dispatch(e)
+        if events:
+            caches.POLL_SNAPSHOT.update(self.path, new)
+        self.stats['seconds'] = time.time() - start
+        self.stats['cpu seconds'] = time.process_time() - cpu
+        self.stats['changes'] = len(events)
+        log_d('Polled {}: {}'.format(self.path.encode(errors='ignore'), self.stats))
+        return new
+
+    def _run(self):
+        snap = caches.POLL_SNAPSHOT.get(self.path)
+        if not snap:
+            snap = self.snapshot()
+            caches.POLL_SNAPSHOT.update(self.path, snap)
+        while not self._stop.wait(self.interval):
+            try:
+                snap = self.poll(snap)
+            except Exception:
+                log.exception('Could not poll: {}'.format(self.path.encode(errors='ignore')))
+
 class Watchers:
     def __init__(self):
 
         self.gallery_handler = GalleryHandler()
         self.watchers = []
         for path in app_constants.MONITOR_PATHS:
+            if app_constants.MONITOR_POLLING:
+                poller = GalleryPoller(self.gallery_handler, path, app_constants.MONITOR_POLL_INTERVAL,
+                                app_constants.MONITOR_POLL_WORKERS)
+                poller.start()
+                self.watchers.append(poller)
+                continue
             gallery_observer = Observer()
 
             try:
@@ -674,6 +920,8 @@ class Watchers:
 class GalleryImpExpData:
 
     hash_pages_count = 4
+    STREAM_FORMAT = 2 # gzipped json lines, see open
+    STREAM_VERSION = 1
 
     def __init__(self, format=1):
         self.type = format
@@ -681,21 +929,14 @@ class GalleryImpExpData:
             self.structure = ""
         else:
             self.structure = {}
+        self._fp = None
+        self._path = None
+        self._written = set()
 
     @classmethod
     def get_pages(self, pages):
         "Returns pages to generate hashes from"
-        p = []
-        if pages < self.hash_pages_count+1:
-            for x in range(pages):
-                p.append(x)
-        else:
-            x = 0
-            i = pages//self.hash_pages_count
-            for t in range(self.hash_pages_count):
-                x += i
-                p.append(x-1)
-        return p
+        return utils.sample_pages(pages, self.hash_pages_count)
 
     def add_data(self, name, data):
         if self.type == 0:
@@ -710,68 +951,230 @@ class GalleryImpExpData:
         with open(file_name, 'w', encoding='utf-8') as fp:
             json.dump(self.structure, fp, indent=4)
 
-    def find_pair(self, found_pairs):
+    def open(self, file_path, galleries=0, lists=0):
+        """
+        Starts an export to file_path.
+        The stream format is a gzipped file with one json record per line:
+        a header with the amount of galleries and lists, then
+        {"type": "gallery", "id": ..., "data": ...} for each gallery and
+        {"type": "list", "id": ..., "data": ...} for each list.
+        Other formats are kept in memory until close
+        """
+        if self.type != self.STREAM_FORMAT:
+            self._path = file_path
+            self.add_data("galleries", {})
+            return
+        file_name = os.path.join(file_path,
+                           'happypanda-{}.hpdb.gz'.format(
+                              datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")))
+        self._fp = gzip.open(file_name, 'wt', encoding='utf-8')
+        self._write({'format':'happypanda', 'version':self.STREAM_VERSION,
+                     'galleries':galleries, 'lists':lists})
+
+    def _write(self, record):
+        self._fp.write(json.dumps(record))
+        self._fp.write('\n')
+
+    def add_gallery(self, g_id, g_data):
+        if self._fp:
+            self._write({'type':'gallery', 'id':g_id, 'data':g_data})
+            self._written.add(g_id)
+        else:
+            self.structure["galleries"][g_id] = g_data
+
+    def add_list(self, l_id, l_data, members):
+        """
+        Adds a gallery list. members is a dict of gallery id -> identifier.
+        The stream format only stores the ids of galleries already written
+        """
+        l_data = dict(l_data)
+        if self._fp:
+            l_data['galleries'] = [g_id for g_id in members if g_id in self._written]
+            l_data['identifiers'] = {g_id: self.list_identifier(members[g_id])
+                                     for g_id in members if not g_id in self._written}
+            self._write({'type':'list', 'id':l_id, 'data':l_data})
+        else:
+            l_data['galleries'] = {g_id: {'identifier':self.list_identifier(members[g_id])}
+                                   for g_id in members}
+            self.structure.setdefault("lists", {})[l_id] = l_data
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+        elif self._path != None:
+            self.save(self._path)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Reads an export file of any format.
+        Returns a header dict with the amount of galleries and lists, and a generator of
+        (kind, id, data) records where kind is 'gallery' or 'list'.
+        Galleries come before lists. The galleries of a list are a dict of
+        gallery id -> identifier, with None if the gallery's own record has the identifier
+        """
+        with open(path, 'rb') as fp:
+            compressed = fp.read(2) == b'\x1f\x8b'
+
+        if compressed:
+            fp = gzip.open(path, 'rt', encoding='utf-8')
+            header = json.loads(fp.readline())
+            if header.get('version', 1) > cls.STREAM_VERSION:
+                log_w("Export file is from a newer version: {}".format(path.encode(errors='ignore')))
+
+            def records():
+                with fp:
+                    for line in fp:
+                        if not line.strip():
+                            continue
+                        record = json.loads(line)
+                        r_data = record['data']
+                        if record['type'] == 'list':
+                            members = dict.fromkeys(r_data.pop('galleries', []))
+                            members.update(r_data.pop('identifiers', {}))
+                            r_data['galleries'] = members
+                        yield record['type'], record['id'], r_data
+            return header, records()
+
+        with open(path, 'r', encoding='utf-8') as fp:
+            data = json.load(fp)
+        galleries = data["galleries"] if "galleries" in data else data
+        lists = data.get("lists", {}) if "galleries" in data else {}
+
+        def records():
+            for g_id in galleries:
+                yield 'gallery', g_id, galleries[g_id]
+            for l_id in lists:
+                l_data = dict(lists[l_id])
+                l_data['galleries'] = {g_id: l_data['galleries'][g_id]['identifier']
+                                       for g_id in l_data['galleries']}
+                yield 'list', l_id, l_data
+        return {'galleries':len(galleries), 'lists':len(lists)}, records()
+
+    @classmethod
+    def _hash_sample(cls, g, stored):
+        "Hashes the sample pages of a gallery's first chapter without touching the DB"
+        pages = cls.get_pages(g.chapters[0].pages)
+        try:
+            hashes, new_hashes = gallerydb.HashDB.hash_chapter(g, 0, pages, stored=stored)
+        except app_constants.InternalPagesMismatch:
+            return None
+        return pages, hashes, new_hashes
+
+    @classmethod
+    def identify(cls, galleries):
+        """
+        Yields (gallery, identifier) for each gallery in order, where identifier is
+        {'pages': page count, page: hex hash, ...} of the first chapter's sample pages or None.
+        Stored hashes are read in one query and missing sample pages are hashed on
+        HASH_WORKERS threads. The DB is only read and written from the calling thread.
+        """
+        stored = gallerydb.HashDB.get_chapter_hashes(0)
+
+        def hash_sample(g):
+            return cls._hash_sample(g, stored.get(g.id, {}) if g.id else None)
+
+        with futures.ThreadPoolExecutor(app_constants.HASH_WORKERS) as pool:
+            for g, result in zip(galleries, pool.map(hash_sample, galleries)):
+                if result is None and g.chapters.update_chapter_pages(0):
+                    result = hash_sample(g)
+                if not result or not result[1]:
+                    yield g, None
+                    continue
+                pages, hashes, new_hashes = result
+                if new_hashes:
+                    gallerydb.HashDB.insert_hashes(g.id, gallerydb.ChapterDB.get_chapter_id(g.id, 0), new_hashes)
+                identifier = {'pages':g.chapters[0].pages}
+                for n in pages:
+                    identifier[n] = utils.hash_to_hex(hashes[n])
+                yield g, identifier
+
+    @staticmethod
+    def list_identifier(identifier):
+        "Returns a gallery identifier without the page count, as stored in lists"
+        return {p: h for p, h in identifier.items() if p != 'pages'}
+
+    @staticmethod
+    def page_hashes(identifier):
+        "Returns the page hashes of an identifier as a frozenset of (page, hex hash) pairs"
+        return frozenset((str(p), h) for p, h in identifier.items() if p != 'pages')
+
+    @classmethod
+    def identifier_key(cls, identifier):
+        "Returns the (page count, page hashes) key of a gallery identifier"
+        return identifier['pages'], cls.page_hashes(identifier)
+
+    @classmethod
+    def build_index(cls, galleries):
+        """
+        Indexes galleries by their first chapter's sampled page hashes, see identify.
+        Returns a dict of identifier_key -> [galleries]
+        """
+        index = {}
+        for g, identifier in cls.identify(galleries):
+            if identifier:
+                index.setdefault(cls.identifier_key(identifier), []).append(g)
+        return index
+
+    def find_pair(self, found_pairs, index):
+        """
+        Finds the gallery matching this data's identifier in an index from build_index
+        and applies this data to it. Galleries in found_pairs are skipped.
+        """
         identifier = self.structure.get('identifier')
         found = None
         if identifier:
-            for g in app_constants.GALLERY_DATA:
-                if not g in found_pairs and g.chapters[0].pages == identifier['pages']:
-                    pages = self.get_pages(g.chapters[0].pages)
-                    hashes = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
-                    for p in hashes:
-                        if hashes[p] != identifier[str(p)]:
-                            break
-                    else:
-                        found = g
-                        g.title = self.structure['title']
-                        g.artist = self.structure['artist']
-                        if self.structure['pub_date'] and self.structure['pub_date'] != 'None':
-                            g.pub_date = datetime.datetime.strptime(
-                                self.structure['pub_date'], "%Y-%m-%d %H:%M:%S")
-                        g.date_added = datetime.datetime.strptime(
-                                self.structure['date_added'], "%Y-%m-%d %H:%M:%S")
-                        g.type = self.structure['type']
-                        g.status = self.structure['status']
-                        if self.structure['last_read'] and self.structure['last_read'] != 'None':
-                            g.last_read = datetime.datetime.strptime(
-                                self.structure['last_read'], "%Y-%m-%d %H:%M:%S")
-                        g.times_read += self.structure['times_read']
-                        g._db_v = self.structure['db_v']
-                        g.language = self.structure['language']
-                        g.link = self.structure['link']
-                        g.view = self.structure['view']
-                        g.rating = self.structure['rating']
-                        for ns in self.structure['tags']:
-                            if not ns in g.tags:
-                                g.tags[ns] = []
-                            for tag in self.structure['tags'][ns]:
-                                if not tag in g.tags[ns]:
-                                    g.tags[ns].append(tag)
-                        g.exed = self.structure['exed']
-                        g.info = self.structure['info']
-                        g.fav = self.structure['fav']
-                        gallerydb.GalleryDB.modify_gallery(
-                            g.id,
-                            g.title,
-                            artist=g.artist,
-                            info=g.info,
-                            type=g.type,
-                            fav=g.fav,
-                            tags=g.tags,
-                            language=g.language,
-                            status=g.status,
-                            pub_date=g.pub_date,
-                            date_added=g.date_added,
-                            link=g.link,
-                            times_read=g.times_read,
-                            _db_v=g._db_v,
-                            exed=g.exed,
-                            rating=g.rating,
-                            view=g.view,
-                            last_read=g.last_read
-                            )
-
-                if found:
+            for g in index.get(self.identifier_key(identifier), []):
+                if not g in found_pairs:
+                    found = g
+                    g.title = self.structure['title']
+                    g.artist = self.structure['artist']
+                    if self.structure['pub_date'] and self.structure['pub_date'] != 'None':
+                        g.pub_date = datetime.datetime.strptime(
+                            self.structure['pub_date'], "%Y-%m-%d %H:%M:%S")
+                    g.date_added = datetime.datetime.strptime(
+                            self.structure['date_added'], "%Y-%m-%d %H:%M:%S")
+                    g.type = self.structure['type']
+                    g.status = self.structure['status']
+                    if self.structure['last_read'] and self.structure['last_read'] != 'None':
+                        g.last_read = datetime.datetime.strptime(
+                            self.structure['last_read'], "%Y-%m-%d %H:%M:%S")
+                    g.times_read += self.structure['times_read']
+                    g._db_v = self.structure['db_v']
+                    g.language = self.structure['language']
+                    g.link = self.structure['link']
+                    g.view = self.structure['view']
+                    g.rating = self.structure['rating']
+                    for ns in self.structure['tags']:
+                        if not ns in g.tags:
+                            g.tags[ns] = []
+                        for tag in self.structure['tags'][ns]:
+                            if not tag in g.tags[ns]:
+                                g.tags[ns].append(tag)
+                    g.exed = self.structure['exed']
+                    g.info = self.structure['info']
+                    g.fav = self.structure['fav']
+                    gallerydb.GalleryDB.modify_gallery(
+                        g.id,
+                        g.title,
+                        artist=g.artist,
+                        info=g.info,
+                        type=g.type,
+                        fav=g.fav,
+                        tags=g.tags,
+                        language=g.language,
+                        status=g.status,
+                        pub_date=g.pub_date,
+                        date_added=g.date_added,
+                        link=g.link,
+                        times_read=g.times_read,
+                        _db_v=g._db_v,
+                        exed=g.exed,
+                        rating=g.rating,
+                        view=g.view,
+                        last_read=g.last_read
+                        )
                     break
         else:
             log_w("Identifier key not found!")
@@ -790,79 +1193,88 @@ class ImportExport(QObject):
         super().__init__()
     
     def import_data(self, path):
-        with open(path, 'r', encoding='utf-8') as fp:
-            data = json.load(fp)
-            pairs_found = []
-            galleries = data["galleries"] if "galleries" in data else data
-            data_count = len(galleries)
-            self.amount.emit(data_count)
-            for prog, g_id in enumerate(galleries, 1):
+        header, records = GalleryImpExpData.read(path)
+        pairs_found = set()
+        identifiers = {} # exported gallery id -> page hashes
+        by_hashes = None
+        data_count = header['galleries']
+        self.imported_g.emit("Indexing galleries...")
+        index = GalleryImpExpData.build_index(app_constants.GALLERY_DATA)
+        self.amount.emit(data_count)
+        g_prog = l_prog = 0
+        for kind, r_id, r_data in records:
+            if kind == 'gallery':
+                g_prog += 1
                 g_data = GalleryImpExpData()
-                g_data.structure.update(galleries[g_id])
-                g = g_data.find_pair(pairs_found)
+                g_data.structure.update(r_data)
+                g = g_data.find_pair(pairs_found, index)
                 if g:
-                    pairs_found.append(g)
+                    pairs_found.add(g)
                 else:
-                    log_w("Could not find pair for id: {}".format(g_id))
+                    log_w("Could not find pair for id: {}".format(r_id))
+                if r_data.get('identifier'):
+                    identifiers[r_id] = GalleryImpExpData.page_hashes(r_data['identifier'])
                 self.imported_g.emit(
                     "Importing database file... ({}/{} imported)".format(len(pairs_found), data_count))
-                self.progress.emit(prog)
-
-            if "lists" in data:
-                data_count = len(data["lists"])
-                self.amount.emit(data_count)
-                for prog, l_id in enumerate(data['lists'], 1):
-                    list_data = data['lists'][l_id]
-
-                    g_list = None
-                    for g_l in app_constants.GALLERY_LISTS:
-                        if g_l.name == list_data["name"]:
-                            g_list = g_l
-                            break
-                    if not g_list:
-                        g_list = gallerydb.GalleryList(list_data["name"])
-                        g_list.add_to_db()
-                       
-                    g_list.type = list_data["type"]
-                    g_list.filter = list_data["filter"]
-                    g_list.enforce = list_data["enforce"]
-                    g_list.regex = list_data["regex"]
-                    g_list.case = list_data["case"]
-                    g_list.strict = list_data["strict"]
-
-                    # ineffiecent, go through gallery data once
-                    for g in app_constants.GALLERY_DATA:
-                        pages = GalleryImpExpData.get_pages(g.chapters[0].pages)
-                        hashes = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
-                        p_hashes = {}
-                        for p in hashes:
-                            p_hashes[str(p)] = hashes[p]
-                        for g_id in list_data["galleries"]:
-                            if p_hashes == list_data["galleries"][g_id]["identifier"]:
-                                g_list.add_gallery(g, _check_filter=False)
-                                break
-                    
-                    self.imported_g.emit("Importing gallery lists")
-                    self.progress.emit(prog)
-            self.finished.emit()
+                self.progress.emit(g_prog)
+
+            elif kind == 'list':
+                if by_hashes is None:
+                    self.amount.emit(header['lists'])
+                    by_hashes = {}
+                    for key, gs in index.items():
+                        by_hashes.setdefault(key[1], []).extend(gs)
+                l_prog += 1
+                self._import_list(r_data, identifiers, by_hashes)
+                self.imported_g.emit("Importing gallery lists")
+                self.progress.emit(l_prog)
+        self.finished.emit()
+
+    def _import_list(self, list_data, identifiers, by_hashes):
+        g_list = None
+        for g_l in app_constants.GALLERY_LISTS:
+            if g_l.name == list_data["name"]:
+                g_list = g_l
+                break
+        if not g_list:
+            g_list = gallerydb.GalleryList(list_data["name"])
+            g_list.add_to_db()
+
+        g_list.type = list_data["type"]
+        g_list.filter = list_data["filter"]
+        g_list.enforce = list_data["enforce"]
+        g_list.regex = list_data["regex"]
+        g_list.case = list_data["case"]
+        g_list.strict = list_data["strict"]
+
+        added = set()
+        for g_id, identifier in list_data["galleries"].items():
+            if identifier:
+                key = GalleryImpExpData.page_hashes(identifier)
+            else:
+                key = identifiers.get(g_id)
+            for g in by_hashes.get(key, []):
+                if not g in added:
+                    added.add(g)
+                    g_list.add_gallery(g, _check_filter=False)
 
     def export_data(self, gallery=None):
-        galleries = []
-        export_lists = False
         if gallery:
-            galleries.append(gallery)
+            galleries = [gallery]
         else:
             galleries = app_constants.GALLERY_DATA
-            exports_lists = True
 
         amount = len(galleries)
         log_i("Exporting {} galleries".format(amount))
         data = GalleryImpExpData(app_constants.EXPORT_FORMAT)
-        gallery_data = {}
-        data.add_data("galleries", gallery_data)
+        data.open(app_constants.EXPORT_PATH, amount, len(app_constants.GALLERY_LISTS))
+        identifiers = {}
         self.amount.emit(amount)
-        for prog, g in enumerate(galleries, 1):
+        for prog, (g, identifier) in enumerate(GalleryImpExpData.identify(galleries), 1):
             log_d("Exporting {} out of {} galleries".format(prog, amount))
+            if not identifier:
+                log_e("Failed to export gallery: {}".format(g.title.encode(errors='ignore')))
+                continue
             g_data = {}
             g_data['title'] = g.title
             g_data['artist'] = g.artist
@@ -881,28 +1293,22 @@ class ImportExport(QObject):
             g_data['exed'] = g.exed
             g_data['db_v'] = g._db_v
             g_data['tags'] = g.tags.copy()
-            g_data['identifier'] = {'pages':g.chapters[0].pages}
-            pages = data.get_pages(g.chapters[0].pages)
-            try:
-                h_list = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
-            except app_constants.InternalPagesMismatch:
-                if g.chapters.update_chapter_pages(0):
-                    pages = data.get_pages(g.chapters[0].pages)
-                    h_list = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
-                else:
-                    h_list = {}
-            if not h_list:
-                log_e("Failed to export gallery: {}".format(g.title.encode(errors='ignore')))
-                continue
-            for n in pages:
-                g_data['identifier'][n] = h_list[n]
-
-            gallery_data[str(g.id)] = g_data
+            g_data['identifier'] = identifier
+            identifiers[g.id] = identifier
+            data.add_gallery(str(g.id), g_data)
             self.progress.emit(prog)
 
-        lists = {}
+        # list members which weren't exported above still need their identifiers
+        unhashed = list({g.id: g for l in app_constants.GALLERY_LISTS
+                         for g in l._galleries if not g.id in identifiers}.values())
+        for g, identifier in GalleryImpExpData.identify(unhashed):
+            if identifier:
+                identifiers[g.id] = identifier
+            else:
+                log_e("Failed to export gallery: {}".format(g.title.encode(errors='ignore')))
+
         for l in app_constants.GALLERY_LISTS:
-            lists[str(l._id)] = l_data = {}
+            l_data = {}
             l_data["name"] = l.name
             l_data["type"] = l.type
             l_data["filter"] = l.filter
@@ -910,29 +1316,10 @@ class ImportExport(QObject):
             l_data["regex"] = l.regex
             l_data["case"] = l.case
             l_data["strict"] = l.strict
-            l_galleries = l_data["galleries"] = {}
-            for g in l._galleries:
-                l_galleries[str(g.id)] = l_gallery = {}
-                pages = data.get_pages(g.chapters[0].pages)
-                try:
-                    h_list = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
-                except app_constants.InternalPagesMismatch:
-                    if g.chapters.update_chapter_pages(0):
-                        pages = data.get_pages(g.chapters[0].pages)
-                        h_list = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
-                    else:
-                        h_list = {}
-                if not h_list:
-                    log_e("Failed to export gallery: {}".format(g.title.encode(errors='ignore')))
-                    continue
-                l_gallery['identifier'] = {}
-                for n in pages:
-                    l_gallery['identifier'][n] = h_list[n]
-
-        if lists:
-            data.add_data("lists", lists)
+            members = {str(g.id): identifiers[g.id] for g in l._galleries if g.id in identifiers}
+            data.add_list(str(l._id), l_data, members)
 
         log_i("Finished exporting galleries!")
-        data.save(app_constants.EXPORT_PATH)
+        data.close()
         self.finished.emit()
 
@@ -205,16 +205,9 @@ def start(test=False):
         style = str(style_file.readAll(), 'utf-8')
         application.setStyleSheet(style)
         try:
-            os.mkdir(app_constants.temp_dir)
-        except FileExistsError:
-            try:
-                for root, dirs, files in scandir.walk('temp', topdown=False):
-                    for name in files:
-                        os.remove(os.path.join(root, name))
-                    for name in dirs:
-                        os.rmdir(os.path.join(root, name))
-            except:
-                log.exception("Empty temp: FAIL")
+            utils.TEMP_MANAGER.purge() # emptied in the background
+        except:
+            log.exception("Empty temp: FAIL")
         log_d('Create temp: OK')
 
         if test:
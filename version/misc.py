@@ -1960,9 +1960,9 @@ class FileIcon:
                     return False
                 for name in zip.namelist():
                     if name.lower().endswith(tuple(IMG_FILES)):
-                        folder = os.path.join(app_constants.temp_dir,
-                            '{}{}'.format(name, n))
+                        folder = utils.TEMP_MANAGER.allocate()
                         zip.extract(name, folder)
+                        utils.TEMP_MANAGER.account(folder)
                         file = os.path.join(folder, name)
                         break
             else:
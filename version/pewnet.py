@@ -12,6 +12,7 @@
 #along with Happypanda.  If not, see <http://www.gnu.org/licenses/>.
 #"""
 
+import collections
 import html
 import logging
 import os
@@ -21,6 +22,7 @@ import requests
 import shutil
 import threading
 import time
+import urllib.parse
 import uuid
 from datetime import datetime
 from queue import Queue
@@ -30,12 +32,15 @@ from tempfile import (
 )
 
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from robobrowser import RoboBrowser
 from robobrowser.exceptions import RoboError
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
 import app_constants
+import caches
 import utils
 import settings
 from utils import makedirs_if_not_exists
@@ -47,6 +52,188 @@ log_w = log.warning
 log_e = log.error
 log_c = log.critical
 
+class SessionManager:
+    """
+    Shares one requests.Session per host between all threads, so connections
+    are kept alive and reused instead of doing a new handshake per request.
+    Requests with cookies get a separate session per set of cookies, so requests
+    without them never send them.
+    Connection errors and 5xx responses to idempotent requests are retried with backoff.
+    429 responses make LIMITER slow down and idempotent requests are sent again once it allows.
+    """
+    RETRY_STATUS = (500, 502, 503, 504)
+    IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self):
+        self._sessions = {} # (host, cookies) -> session
+        self._requests = collections.Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        "Returns the scheme and host of an url"
+        u = urllib.parse.urlsplit(url)
+        return "{}://{}".format(u.scheme, u.netloc.lower())
+
+    @classmethod
+    def _retries(cls):
+        # only idempotent methods are retried, the default of Retry
+        return Retry(total=app_constants.HTTP_RETRIES, backoff_factor=app_constants.HTTP_RETRY_BACKOFF,
+                     status_forcelist=cls.RETRY_STATUS, raise_on_status=False)
+
+    def session(self, url, cookies=None):
+        "Returns the shared session of the url's host which sends the given cookies"
+        key = (self.host(url), frozenset(dict(cookies).items()) if cookies else None)
+        with self._lock:
+            s = self._sessions.get(key)
+            if not s:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=app_constants.HTTP_POOL_SIZE,
+                                      max_retries=self._retries())
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                if cookies:
+                    s.cookies.update(cookies)
+                self._sessions[key] = s
+            return s
+
+    @staticmethod
+    def _retry_after(response):
+        "Returns the seconds to wait asked for by a 429 response"
+        try:
+            return max(float(response.headers.get('Retry-After', '')), 0)
+        except ValueError:
+            return app_constants.GLOBAL_EHEN_TIME
+
+    def request(self, method, url, cookies=None, **kwargs):
+        "Same as requests.request. Only the given cookies are sent, see session"
+        s = self.session(url, cookies)
+        host = self.host(url)
+        with self._lock:
+            self._requests[host] += 1
+        r = s.request(method, url, **kwargs)
+        tries = 0
+        while r.status_code == 429:
+            LIMITER.throttle(url, self._retry_after(r))
+            tries += 1
+            if method.upper() not in self.IDEMPOTENT or tries > app_constants.HTTP_RETRIES:
+                break
+            log_w("Too many requests to {}, retrying".format(host))
+            LIMITER.acquire(url)
+            try:
+                with self._lock:
+                    self._requests[host] += 1
+                r = s.request(method, url, **kwargs)
+            finally:
+                LIMITER.release(url)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """
+        Returns a dict of host -> {'requests', 'connections', 'reused'}
+        where connections is the amount of connections opened to the host
+        """
+        with self._lock:
+            sessions = dict(self._sessions)
+            counts = dict(self._requests)
+        connections = collections.Counter()
+        for (host, _), s in sessions.items():
+            for adapter in set(s.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool:
+                        connections[host] += pool.num_connections
+        stats = {}
+        for host in set(h for h, _ in sessions):
+            n = counts.get(host, 0)
+            stats[host] = {'requests':n, 'connections':connections[host],
+                           'reused':max(n - connections[host], 0)}
+        return stats
+
+SESSIONS = SessionManager()
+
+class RateLimiter:
+    """
+    A token bucket per host.
+    Tokens refill at 1/GLOBAL_EHEN_TIME per second up to HEN_RATE_BURST, and each request
+    takes one. Callers reserve their slot under the lock and sleep outside of it, so
+    waiting requests are spread out exactly as much as the rate needs instead of
+    queueing behind one lock.
+    """
+    _STATS_SIZE = 100
+
+    def __init__(self):
+        self._buckets = {} # host -> [tokens, last refill]
+        self._in_flight = collections.Counter()
+        self._waits = {} # host -> recent waits in seconds
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        "Waits until a request to the url's host is allowed, returns the time waited"
+        host = SessionManager.host(url)
+        rate = 1 / max(app_constants.GLOBAL_EHEN_TIME, 0.01)
+        burst = max(app_constants.HEN_RATE_BURST, 1)
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(host, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            bucket[0] -= 1
+            wait = 0
+            if bucket[0] < 0:
+                wait = -bucket[0] / rate + random.uniform(0, app_constants.HEN_RATE_JITTER)
+        if wait:
+            time.sleep(wait)
+        with self._lock:
+            self._in_flight[host] += 1
+            self._waits.setdefault(host, collections.deque(maxlen=self._STATS_SIZE)).append(wait)
+        log_d("Waited {:.2f}s for {}".format(wait, host))
+        return wait
+
+    def throttle(self, url, delay):
+        "Makes the next request to the url's host wait at least delay seconds, e.g. after a 429 response"
+        host = SessionManager.host(url)
+        rate = 1 / max(app_constants.GLOBAL_EHEN_TIME, 0.01)
+        burst = max(app_constants.HEN_RATE_BURST, 1)
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(host, [burst, now])
+            bucket[0] = min(0, bucket[0] + (now - bucket[1]) * rate) - delay * rate
+            bucket[1] = now
+
+    def release(self, url):
+        "Marks a request from acquire as done"
+        with self._lock:
+            self._in_flight[SessionManager.host(url)] -= 1
+
+    def in_flight(self, url=None):
+        "Returns the amount of requests in flight to the url's host, or to all hosts"
+        with self._lock:
+            if url:
+                return self._in_flight[SessionManager.host(url)]
+            return sum(self._in_flight.values())
+
+    def stats(self):
+        """
+        Returns a dict of host -> {'in_flight', 'requests', 'waited', 'max_wait'}
+        for the most recent requests
+        """
+        with self._lock:
+            return {host: {'in_flight':self._in_flight[host],
+                           'requests':len(waits),
+                           'waited':sum(waits),
+                           'max_wait':max(waits)}
+                    for host, waits in self._waits.items()}
+
+LIMITER = RateLimiter()
+
 class DownloaderItem(QObject):
     "Convenience class"
     IN_QUEUE, DOWNLOADING, FINISHED, CANCELLED = range(4)
@@ -145,7 +332,7 @@ class Downloader(QObject):
         if self._browser_session:
             r = self._browser_session.get(url, stream=True)
         else:
-            r = requests.get(url, stream=True)
+            r = SESSIONS.get(url, stream=True)
         return r
 
     def _get_item_and_temp_base(self):
@@ -649,12 +836,19 @@ class HenItem(DownloaderItem):
 
 class DLManager(QObject):
     "Base class for site-specific download managers"
-    _browser = RoboBrowser(history=True,
-                        user_agent="Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 Firefox/36.0",
-                        parser='html.parser', allow_redirects=False)
+    url = ""
+
     def __init__(self, download_type=app_constants.DOWNLOAD_TYPE_OTHER):
         super().__init__()
         self._download_type = download_type
+        self._browser = self.new_browser(self.url)
+
+    @staticmethod
+    def new_browser(url, cookies=None):
+        "Returns a browser on the shared session of the url's host, see SessionManager.session"
+        return RoboBrowser(session=SESSIONS.session(url, cookies), history=True,
+                        user_agent="Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 Firefox/36.0",
+                        parser='html.parser', allow_redirects=False)
 
     def _error(self):
         pass
@@ -697,11 +891,8 @@ class DLManager(QObject):
 
 class ChaikaManager(DLManager):
     "panda.chaika.moe manager"
-
-    def __init__(self):
-        super().__init__()
-        self.url = "http://panda.chaika.moe/"
-        self.api = "http://panda.chaika.moe/jsearch/?"
+    url = "http://panda.chaika.moe/"
+    api = "http://panda.chaika.moe/jsearch/?"
 
     def from_gallery_url(self, url):
         h_item = HenItem(self._browser.session)
@@ -732,7 +923,7 @@ class ChaikaManager(DLManager):
     def _gallery_page(self, g_id, h_item):
         "Returns url to archive and updates h_item metadata from the /gallery/g_id page"
         g_url = self.api + "gallery={}".format(g_id)
-        r = requests.get(g_url)
+        r = SESSIONS.get(g_url)
         try:
             r.raise_for_status()
             chaika = r.json()
@@ -766,7 +957,7 @@ class ChaikaManager(DLManager):
     def _archive_page(self, a_id, h_item):
         "Returns url to gallery and updates h_item metadata from the /archive/a_id page"
         a_url = self.api + "archive={}".format(a_id)
-        r = requests.get(a_url)
+        r = SESSIONS.get(a_url)
         try:
             r.raise_for_status()
             chaika = r.json()
@@ -794,7 +985,7 @@ class HenManager(DLManager):
             else:
                 raise app_constants.NeedLogin
 
-        self._browser.session.cookies.update(cookies)
+        self._browser = self.new_browser(self.e_url, cookies)
 
 
     def _archive_url_d(self, gid, token, key):
@@ -954,29 +1145,31 @@ class ExHenManager(HenManager):
 
 class CommenHen:
     "Contains common methods"
-    LOCK = threading.Lock()
-    TIME_RAND = app_constants.GLOBAL_EHEN_TIME
     QUEUE = []
     COOKIES = {}
-    LAST_USED = time.time()
     HEADERS = {'user-agent':"Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 Firefox/36.0"}
     _QUEUE_LIMIT = 25
-    _browser = RoboBrowser(user_agent=HEADERS['user-agent'], parser='html.parser')
-
-    def begin_lock(self):
-        log_d('locked')
-        self.LOCK.acquire()
-        t1 = time.time()
-        while int(time.time() - self.LAST_USED) < self.TIME_RAND:
-            t = random.randint(3, self.TIME_RAND)
-            time.sleep(t)
-        t2 = time.time() - t1
-        log_d("Slept for {}".format(t2))
-
-    def end_lock(self):
-        log_d('unlocked')
-        self.LAST_USED = time.time()
-        self.LOCK.release()
+
+    @staticmethod
+    def cached(source, key):
+        "Returns the cached response of source for key or None, see caches.ResponseCache"
+        if not app_constants.HTTP_CACHE_SIZE:
+            return None
+        return caches.RESPONSE_CACHE.get(source, key, app_constants.HTTP_CACHE_TTL,
+                                   app_constants.HTTP_CACHE_NEGATIVE_TTL)
+
+    @staticmethod
+    def cache(source, key, value, negative=False):
+        "Caches the response of source for key"
+        if app_constants.HTTP_CACHE_SIZE:
+            caches.RESPONSE_CACHE.put(source, key, value, negative, app_constants.HTTP_CACHE_SIZE)
+
+    def begin_lock(self, url):
+        "Waits for the rate limit of the url's host"
+        LIMITER.acquire(url)
+
+    def end_lock(self, url):
+        LIMITER.release(url)
 
     def add_to_queue(self, url='', proc=False, parse=True):
         """Add url the the queue, when the queue has reached _QUEUE_LIMIT entries will auto process
@@ -1095,14 +1288,16 @@ class NHen(CommenHen):
                     cls.COOKIES.update(exprops.cookies)
                     return cls.COOKIES
 
-        cls._browser.open(cls.LOGIN_URL)
-        login_form = cls._browser.get_form()
+        # a session of its own, the login cookies are read back from it
+        browser = RoboBrowser(user_agent=cls.HEADERS['user-agent'], parser='html.parser')
+        browser.open(cls.LOGIN_URL)
+        login_form = browser.get_form()
         if login_form:
             login_form['username'].value = user
             login_form['password'].value = password
-            cls._browser.submit_form(login_form)
+            browser.submit_form(login_form)
 
-        n_c = cls._browser.session.cookies.get_dict()
+        n_c = browser.session.cookies.get_dict()
         if not cls.check_login(n_c):
             log_w("NH login failed")
             raise app_constants.WrongLogin
@@ -1284,34 +1479,49 @@ class EHen(CommenHen):
              "namespace": 1
              }
         dict_metadata = {}
+        cached = []
         for url in list_of_urls:
             parsed_url = EHen.parse_url(url.strip())
             if parsed_url:
                 dict_metadata[parsed_url[0]] = url # gallery id
-                payload['gidlist'].append(parsed_url)
+                g_data = self.cached(self.e_url, "{}/{}".format(*parsed_url))
+                if g_data is None:
+                    payload['gidlist'].append(parsed_url)
+                else:
+                    cached.append(g_data)
+        if cached:
+            log_i("Using cached metadata for {} galleries".format(len(cached)))
 
         if payload['gidlist']:
-            self.begin_lock()
+            self.begin_lock(self.e_url)
             try:
                 if cookies:
                     self.check_cookie(cookies)
-                    r = requests.post(self.e_url, json=payload, timeout=30, headers=self.HEADERS, cookies=self.COOKIES)
-                else:
-                    r = requests.post(self.e_url, json=payload, timeout=30, headers=self.HEADERS)
+                r = SESSIONS.post(self.e_url, json=payload, timeout=30, headers=self.HEADERS,
+                                  cookies=self.COOKIES if cookies else None)
             except requests.ConnectionError as err:
-                self.end_lock()
+                self.end_lock(self.e_url)
                 log_e("Could not fetch metadata: {}".format(err))
                 raise app_constants.MetadataFetchFail("connection error")
-            self.end_lock()
+            self.end_lock(self.e_url)
             if not self.handle_error(r):
                 return 'error'
+        elif cached:
+            return {'gmetadata':cached}, dict_metadata
         else: return None
         try:
             r.raise_for_status()
         except:
             log.exception('Could not fetch metadata: status error')
             return None
-        return r.json(), dict_metadata
+        data = r.json()
+        tokens = dict(payload['gidlist'])
+        for g_data in data.get('gmetadata', []):
+            # errors don't always include the token
+            key = "{}/{}".format(g_data.get('gid'), tokens.get(g_data.get('gid')))
+            self.cache(self.e_url, key, g_data, 'error' in g_data)
+        data['gmetadata'] = cached + data.get('gmetadata', [])
+        return data, dict_metadata
 
     @classmethod
     def parse_metadata(cls, metadata_json, dict_metadata):
@@ -1431,17 +1641,19 @@ class EHen(CommenHen):
                 f_url = "https://upload.e-hentai.org/image_lookup.php/"
             if cookies:
                 self.check_cookie(cookies)
-                self._browser.session.cookies.update(self.COOKIES)
             log_d("searching with color img: {}".format(filepath))
-            files = {'sfile': open(filepath,'rb')}
             values = {'fs_similar': '1'}
             if app_constants.INCLUDE_EH_EXPUNGED:
                 values['fs_exp'] = '1'
+            def post():
+                with open(filepath, 'rb') as f:
+                    return SESSIONS.post(f_url, files={'sfile': f}, data=values, headers=self.HEADERS,
+                                         cookies=self.COOKIES if cookies else None)
             try:
-                r = self._browser.session.post(f_url, files=files, data=values)
+                r = post()
             except requests.ConnectionError:
                 time.sleep(file_search_delay+3)
-                r = self._browser.session.post(f_url, files=files, data=values)
+                r = post()
                 
             s = BeautifulSoup(r.text, "html.parser")
             if "Please wait a bit longer between each file search." in "{}".format(s):
@@ -1456,7 +1668,17 @@ class EHen(CommenHen):
         log_d("search strings: ".format(search_string))
         for h in search_string:
             log_d('Hash search: {}'.format(h))
-            self.begin_lock()
+            use_cache = not 'color' in kwargs # file searches are keyed by a temporary path
+            # hits depend on whether expunged galleries are included and on the account
+            cache_key = "{}|expunged={}|login={}".format(h, int(bool(app_constants.INCLUDE_EH_EXPUNGED)), int(bool(cookies)))
+            if use_cache:
+                hits = self.cached(self.e_url_o, cache_key)
+                if hits is not None:
+                    log_d('Using cached search: {}'.format(h))
+                    if hits:
+                        found_galleries[h] = [tuple(x) for x in hits]
+                    continue
+            self.begin_lock(self.e_url_o)
             try:
                 if 'color' in kwargs:
                     soup = do_filesearch(h)
@@ -1467,21 +1689,22 @@ class EHen(CommenHen):
                         hash_search + '&fs_exp=1'
                     if cookies:
                         self.check_cookie(cookies)
-                        r = requests.get(hash_search, timeout=30, headers=self.HEADERS, cookies=self.COOKIES)
-                    else:
-                        r = requests.get(hash_search, timeout=30, headers=self.HEADERS)
+                    r = SESSIONS.get(hash_search, timeout=30, headers=self.HEADERS,
+                                     cookies=self.COOKIES if cookies else None)
                     log_d("searching with greyscale img: {}".format(hash_search))
                     if not self.handle_error(r):
                         return 'error'
                     soup = BeautifulSoup(r.text, "html.parser")
             except requests.ConnectionError as err:
-                self.end_lock()
                 log.exception("Could not search for gallery: {}".format(err))
                 raise app_constants.MetadataFetchFail("connection error")
-            self.end_lock()
+            finally:
+                self.end_lock(self.e_url_o)
 
             if not no_hits_found_check(soup):
                 log_e('No hits found with hash/image: {}'.format(h))
+                if use_cache:
+                    self.cache(self.e_url_o, cache_key, [], True)
                 continue
             log_i('Parsing html')
             try:
@@ -1499,6 +1722,8 @@ class EHen(CommenHen):
                         title = gallery.text
                         g_url = gallery.a.attrs['href']
                         found_galleries[h].append((title,g_url))
+                    if use_cache:
+                        self.cache(self.e_url_o, cache_key, found_galleries[h], not found_galleries[h])
             except AttributeError:
                 log.exception('Unparseable html')
                 log_d("\n{}\n".format(soup.prettify()))
@@ -1569,18 +1794,22 @@ class ChaikaHen(CommenHen):
                     url = self.a_api_url+g_or_a_id
                 hash_search = False
             try:
-                try:
-                    r = requests.get(url)
-                except requests.ConnectionError as err:
-                    log_e("Could not fetch metadata: {}".format(err))
-                    raise app_constants.MetadataFetchFail("connection error")
-                r.raise_for_status()
-                if not r.json():
+                g_json = self.cached(self.g_url, url)
+                if g_json is None:
+                    try:
+                        r = SESSIONS.get(url)
+                    except requests.ConnectionError as err:
+                        log_e("Could not fetch metadata: {}".format(err))
+                        raise app_constants.MetadataFetchFail("connection error")
+                    r.raise_for_status()
+                    g_json = r.json()
+                    self.cache(self.g_url, url, g_json, not g_json)
+                if not g_json:
                     return None
                 if hash_search:
-                    g_data = r.json()[0] # TODO: multiple archives can be returned! Please fix!
+                    g_data = g_json[0] # TODO: multiple archives can be returned! Please fix!
                 else:
-                    g_data = r.json()
+                    g_data = g_json
                 if chaika_g_id:
                     g_data['gallery'] = chaika_g_id
                 g_data['gid'] = g_id
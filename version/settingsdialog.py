@@ -263,6 +263,11 @@ class SettingsDialog(QWidget):
         self.g_data_fixer_title.setChecked(app_constants.GALLERY_DATA_FIX_TITLE)
         self.g_data_fixer_artist.setChecked(app_constants.GALLERY_DATA_FIX_ARTIST)
 
+        # Advanced / Database / Import/Export
+        f_index = self.export_format.findData(app_constants.EXPORT_FORMAT)
+        if f_index != -1:
+            self.export_format.setCurrentIndex(f_index)
+
     def accept(self):
         set = settings.set
 
@@ -529,9 +534,14 @@ class SettingsDialog(QWidget):
         app_constants.GALLERY_DATA_FIX_REPLACE = self.g_data_replace_fix_edit.text()
         set(app_constants.GALLERY_DATA_FIX_REPLACE, 'Advanced', 'gallery data fix replace')
 
+        # Advanced / Database / Import/Export
+        app_constants.EXPORT_FORMAT = self.export_format.currentData()
+        set(app_constants.EXPORT_FORMAT, 'Advanced', 'export format')
+
         # About / DB Overview
 
         settings.save()
+        utils.TITLE_NORMALIZER.rebuild() # languages or the text fixer might have changed
         self.close()
 
     def init_right_panel(self):
@@ -1210,7 +1220,7 @@ class SettingsDialog(QWidget):
 
         def init_import():
             path = QFileDialog.getOpenFileName(self,
-                                      'Choose happypanda database file', filter='*.hpdb')
+                                      'Choose happypanda database file', filter='*.hpdb *.hpdb.gz')
             path = path[0]
             if len(path) != 0:
                 app_popup = AppDialog(self.parent_widget)
@@ -1235,6 +1245,7 @@ class SettingsDialog(QWidget):
         self.export_format = QComboBox(advanced_db_page)
         #self.export_format.addItem('Text File', 0)
         self.export_format.addItem('HPDB', 1)
+        self.export_format.addItem('Compressed HPDB', io_misc.GalleryImpExpData.STREAM_FORMAT)
         self.export_format.adjustSize()
         self.export_format.setFixedWidth(self.export_format.width())
         advanced_impexp_l.addRow('Export Format:', self.export_format)
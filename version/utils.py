@@ -25,18 +25,29 @@ import re
 import scandir
 import rarfile
 import json
+import io
 import send2trash
 import functools
 import time
+import threading
+import collections
+import contextlib
+import queue
 
 from PyQt5.QtGui import QImage, qRgba
 from PIL import Image,ImageChops
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 try:
     import app_constants
+    import caches
     from database import db_constants
 except:
     from . import app_constants
+    from . import caches
     from .database import db_constants
 
 log = logging.getLogger(__name__)
@@ -57,6 +68,11 @@ if not app_constants.unrar_tool_path:
     ARCHIVE_FILES = ('.zip', '.cbz')
 
 class GMetafile:
+    """
+    Parses the metafiles found in a gallery folder or in a gallery in an archive.
+    archive can be a path to an archive or an already opened ArchiveFile.
+    Metafiles in archives are read straight from the archive without extracting them.
+    """
     def __init__(self, path=None, archive=''):
         self.metadata = {
             "title":'',
@@ -73,11 +89,23 @@ class GMetafile:
         if path is None:
             return
         if archive:
-            zip = ArchiveFile(archive)
-            c = zip.dir_contents(path)
-            for x in c:
-                if x.endswith(app_constants.GALLERY_METAFILE_KEYWORDS):
-                    self.files.append(open(zip.extract(x), encoding='utf-8'))
+            opened = isinstance(archive, ArchiveFile)
+            metafiles = None # look in the archive itself
+            if not opened:
+                try:
+                    metafiles = archive_listing(archive)['metafiles'].get(path)
+                except app_constants.CreateArchiveFail:
+                    pass
+            if metafiles is None or metafiles:
+                zip = archive if opened else open_archive(archive)
+                try:
+                    c = zip.dir_contents(path) if metafiles is None else metafiles
+                    for x in c:
+                        if x.endswith(app_constants.GALLERY_METAFILE_KEYWORDS):
+                            self.files.append(self._member_stream(zip, x))
+                finally:
+                    if not opened:
+                        zip.close()
         else:
             for p in scandir.scandir(path):
                 if p.name in app_constants.GALLERY_METAFILE_KEYWORDS:
@@ -87,6 +115,13 @@ class GMetafile:
         else:
             log_d('No metafile found...')
 
+    @staticmethod
+    def _member_stream(zip, name):
+        "Returns a text stream of the given file in the archive"
+        fp = io.StringIO(zip.open(name).decode('utf-8', errors='replace'))
+        fp.name = name # the parsers look at the name
+        return fp
+
     def _eze(self, fp):
         if not fp.name.endswith('.json'):
             return
@@ -314,6 +349,8 @@ def move_files(path, dest='', only_path=False):
     if not os.path.exists(new_path):
         app_constants.TEMP_PATH_IGNORE.append(os.path.normcase(new_path))
         if not only_path:
+            ARCHIVE_POOL.discard(path)
+            caches.ARCHIVE_LISTING_CACHE.invalidate(path)
             new_path = shutil.move(path, new_path)
     else:
         return path
@@ -333,25 +370,7 @@ def check_ignore_list(key):
     return True
 
 def gallery_text_fixer(gallery):
-    regex_str = app_constants.GALLERY_DATA_FIX_REGEX
-    if regex_str:
-        try:
-            valid_regex = re.compile(regex_str)
-        except re.error:
-            return None
-        if not valid_regex:
-            return None
-
-        def replace_regex(text):
-            new_text = re.sub(regex_str, app_constants.GALLERY_DATA_FIX_REPLACE, text)
-            return new_text
-
-        if app_constants.GALLERY_DATA_FIX_TITLE:
-            gallery.title = replace_regex(gallery.title)
-        if app_constants.GALLERY_DATA_FIX_ARTIST:
-            gallery.artist = replace_regex(gallery.artist)
-
-        return gallery
+    return TITLE_NORMALIZER.fix_gallery(gallery)
 
 def b_search(data, key):
     if key:
@@ -367,19 +386,27 @@ def b_search(data, key):
                 return data[mid]
     return None
 
+HASH_CHUNK = 1 << 20 # 1 MiB
+
 def generate_img_hash(src):
     """
     Generates sha1 hash based on the given bytes.
-    Returns hex-digits
+    Returns the 20 byte digest, see hash_to_hex
     """
-    chunk = 8129
     sha1 = hashlib.sha1()
-    buffer = src.read(chunk)
-    log_d("Generating hash")
+    buffer = src.read(HASH_CHUNK)
     while len(buffer) > 0:
         sha1.update(buffer)
-        buffer = src.read(chunk)
-    return sha1.hexdigest()
+        buffer = src.read(HASH_CHUNK)
+    return sha1.digest()
+
+def hash_to_hex(h):
+    "Returns hex-digits of a binary hash. Anything else is returned as is"
+    return h.hex() if isinstance(h, bytes) else h
+
+def hash_from_hex(h):
+    "Returns the binary form of a hash given as hex-digits. Anything else is returned as is"
+    return bytes.fromhex(h) if isinstance(h, str) else h
 
 class ArchiveFile():
     """
@@ -388,10 +415,17 @@ class ArchiveFile():
     extract <- Extracts one specific file to given path
     open -> open the given file in archive, returns bytes
     close -> close archive
+
+    Directory lookups (dir_list, dir_contents, is_dir) are answered from a tree index
+    which is built once on first use.
     """
     zip, rar = range(2)
     def __init__(self, filepath):
         self.type = 0
+        self.filepath = filepath
+        self._index = None
+        self._pool = None
+        self._evicted = False
         try:
             if filepath.endswith(ARCHIVE_FILES):
                 if filepath.endswith(ARCHIVE_FILES[:2]):
@@ -414,6 +448,33 @@ class ArchiveFile():
             log.exception('Create archive: FAIL')
             raise app_constants.CreateArchiveFail
 
+    def _tree(self):
+        """
+        Returns the tree index of the archive, building it if needed.
+        The index is a tuple of (set of names, set of directories, dict of dir -> children)
+        where the top folder is the empty string
+        """
+        if self._index is None:
+            names = set()
+            dirs = set()
+            children = collections.defaultdict(list)
+            for info in self.archive.infolist():
+                name = info.filename
+                names.add(name)
+                if self.type == self.zip:
+                    if name.endswith('/'):
+                        dirs.add(name)
+                    parent = name[:-1] if name.endswith('/') else name
+                    parent = parent.rpartition('/')[0]
+                    parent = parent + '/' if parent else ''
+                else:
+                    if info.isdir():
+                        dirs.add(name)
+                    parent = name.rpartition('/')[0]
+                children[parent].append(name)
+            self._index = (names, dirs, children)
+        return self._index
+
     def namelist(self):
         filelist = self.archive.namelist()
         return filelist
@@ -424,59 +485,33 @@ class ArchiveFile():
         """
         if not name:
             return False
-        if not name in self.namelist():
+        names, dirs, _ = self._tree()
+        if not name in names:
             log_e('File {} not found in archive'.format(name))
             raise app_constants.FileNotFoundInArchive
-        if self.type == self.zip:
-            if name.endswith('/'):
-                return True
-        elif self.type == self.rar:
-            info = self.archive.getinfo(name)
-            return info.isdir()
-        return False
+        return name in dirs
 
     def dir_list(self, only_top_level=False):
         """
         Returns a list of all directories found recursively. For directories not in toplevel
         a path in the archive to the diretory will be returned.
         """
-        
+        _, dirs, children = self._tree()
         if only_top_level:
-            if self.type == self.zip:
-                return [x for x in self.namelist() if x.endswith('/') and x.count('/') == 1]
-            elif self.type == self.rar:
-                potential_dirs = [x for x in self.namelist() if x.count('/') == 0]
-                return [x.filename for x in [self.archive.getinfo(y) for y in potential_dirs] if x.isdir()]
+            return [x for x in children.get('', []) if x in dirs]
         else:
-            if self.type == self.zip:
-                return [x for x in self.namelist() if x.endswith('/') and x.count('/') >= 1]
-            elif self.type == self.rar:
-                return [x.filename for x in self.archive.infolist() if x.isdir()]
+            return [x for x in self.namelist() if x in dirs]
 
     def dir_contents(self, dir_name):
         """
         Returns a list of contents in the directory
         An empty string will return the contents of the top folder
         """
-        if dir_name and not dir_name in self.namelist():
+        names, _, children = self._tree()
+        if dir_name and not dir_name in names:
             log_e('Directory {} not found in archive'.format(dir_name))
             raise app_constants.FileNotFoundInArchive
-        if not dir_name:
-            if self.type == self.zip:
-                con = [x for x in self.namelist() if x.count('/') == 0 or \
-                    (x.count('/') == 1 and x.endswith('/'))]
-            elif self.type == self.rar:
-                con = [x for x in self.namelist() if x.count('/') == 0]
-            return con
-        if self.type == self.zip:
-            dir_con_start = [x for x in self.namelist() if x.startswith(dir_name)]
-            return [x for x in dir_con_start if x.count('/') == dir_name.count('/') and \
-                (x.count('/') == dir_name.count('/') and not x.endswith('/')) or \
-                (x.count('/') == 1 + dir_name.count('/') and x.endswith('/'))]
-        elif self.type == self.rar:
-            return [x for x in self.namelist() if x.startswith(dir_name) and \
-                x.count('/') == 1 + dir_name.count('/')]
-        return []
+        return list(children.get(dir_name, []))
 
     def extract(self, file_to_ext, path=None):
         """
@@ -484,9 +519,9 @@ class ArchiveFile():
         Creates a temp_dir if path is not specified
         Returns path to the extracted file
         """
-        if not path:
-            path = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
-            os.mkdir(path)
+        temp = not path
+        if temp:
+            path = TEMP_MANAGER.allocate()
 
         if not file_to_ext:
             return self.extract_all(path)
@@ -502,19 +537,33 @@ class ArchiveFile():
             elif self.type == self.rar:
                 temp_p = os.path.join(path, file_to_ext)
                 self.archive.extract(file_to_ext, path)
+            if temp:
+                TEMP_MANAGER.account(path)
             return temp_p
 
+    def extract_member(self, member, path):
+        """
+        Extracts only the given member (not its children) to given path
+        Returns path to the extracted file
+        """
+        if self.type == self.zip:
+            return self.archive.extract(member, path)
+        self.archive.extract(member, path)
+        return os.path.join(path, member)
+
     def extract_all(self, path=None, member=None):
         """
         Extracts all files to given path, and returns path
         If path is not specified, a temp dir will be created
         """
-        if not path:
-            path = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
-            os.mkdir(path)
+        temp = not path
+        if temp:
+            path = TEMP_MANAGER.allocate()
         if member:
             self.archive.extractall(path, member)
         self.archive.extractall(path)
+        if temp:
+            TEMP_MANAGER.account(path)
         return path
 
     def open(self, file_to_open, fp=False):
@@ -527,20 +576,364 @@ class ArchiveFile():
             return self.archive.open(file_to_open).read()
 
     def close(self):
-        self.archive.close()
+        if self._pool:
+            self._pool.release(self)
+        else:
+            self.archive.close()
 
-def check_archive(archive_path):
+def dir_size(path):
+    "Returns the total size in bytes of all files in the given folder"
+    size = 0
+    for root, _, files in scandir.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+class TempManager:
     """
-    Checks archive path for potential galleries.
-    Returns a list with a path in archive to galleries
-    if there is no directories
+    Hands out folders in the temp dir and keeps track of how much space they take.
+    The least recently used folders are removed when the total goes above the cap.
+    Folders are removed one by one in a background thread.
+    allocate -> returns path to a new empty folder
+    scoped -> context manager which returns a new folder and removes it on exit
+    account <- updates the size of a folder after something has been written to it
+    touch <- marks a folder as recently used
+    release <- removes a folder
+    purge <- removes everything in the temp dir which wasn't handed out
     """
-    try:
-        zip = ArchiveFile(archive_path)
-    except app_constants.CreateArchiveFail:
-        return []
-    if not zip:
-        return []
+    def __init__(self, cap=1024):
+        self.cap = cap*1024*1024 # MB to bytes
+        self._entries = collections.OrderedDict() # path -> size
+        self._lock = threading.RLock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    @property
+    def total_size(self):
+        with self._lock:
+            return sum(self._entries.values())
+
+    def allocate(self):
+        path = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
+        os.makedirs(path)
+        with self._lock:
+            self._entries[path] = 0
+        return path
+
+    @contextlib.contextmanager
+    def scoped(self):
+        path = self.allocate()
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def _owner(self, path):
+        "Returns the allocated folder which contains the given path"
+        path = os.path.normpath(path)
+        for p in self._entries:
+            if path == os.path.normpath(p) or path.startswith(os.path.join(os.path.normpath(p), '')):
+                return p
+
+    def account(self, path):
+        with self._lock:
+            folder = self._owner(path)
+        if not folder:
+            return
+        size = dir_size(folder)
+        with self._lock:
+            if folder in self._entries:
+                self._entries[folder] = size
+                self._entries.move_to_end(folder)
+                self._evict(folder)
+
+    def touch(self, path):
+        with self._lock:
+            folder = self._owner(path)
+            if folder:
+                self._entries.move_to_end(folder)
+
+    def release(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+        self._remove(path)
+
+    def _evict(self, keep):
+        "Removes least recently used folders until below cap, never the one in keep"
+        while self.total_size > self.cap:
+            path = next((p for p in self._entries if p != keep), None)
+            if path is None:
+                break
+            log_d('Evicting temp folder {}'.format(path.encode(errors='ignore')))
+            self.release(path)
+
+    def purge(self):
+        """
+        Moves everything in the temp dir which wasn't handed out to a trash folder
+        and removes it in the background
+        """
+        os.makedirs(app_constants.temp_dir, exist_ok=True)
+        with self._lock:
+            keep = set(os.path.normcase(os.path.abspath(p)) for p in self._entries)
+        trash = os.path.join(app_constants.temp_dir, '.trash-{}'.format(uuid.uuid4()))
+        for entry in scandir.scandir(app_constants.temp_dir):
+            if os.path.normcase(os.path.abspath(entry.path)) in keep:
+                continue
+            if entry.name.startswith('.trash-'):
+                self._remove(entry.path)
+                continue
+            try:
+                os.makedirs(trash, exist_ok=True)
+                os.rename(entry.path, os.path.join(trash, entry.name))
+            except OSError:
+                log.exception('Could not move temp entry {}'.format(entry.path.encode(errors='ignore')))
+        if os.path.exists(trash):
+            self._remove(trash)
+
+    def _remove(self, path):
+        self._queue.put(path)
+        if not self._worker:
+            self._worker = threading.Thread(target=self._work, name='temp cleanup', daemon=True)
+            self._worker.start()
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                log.exception('Could not remove temp entry {}'.format(path.encode(errors='ignore')))
+            self._queue.task_done()
+
+TEMP_MANAGER = TempManager(app_constants.TEMP_DIR_CAP)
+
+class ArchivePool:
+    """
+    Keeps a LRU pool of opened archives keyed by path, so that repeated
+    operations on the same archive reuse its parsed central directory and tree index.
+    An archive is reopened if its size or modification time has changed.
+    get -> returns a pooled ArchiveFile, call close on it when done
+    discard <- closes and removes the archive with the given path from the pool
+    clear <- closes and removes all archives
+    """
+    def __init__(self, size=8):
+        self.size = size
+        self._archives = collections.OrderedDict()
+        self._refs = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(filepath):
+        return os.path.normcase(os.path.abspath(filepath))
+
+    def get(self, filepath):
+        "Returns an ArchiveFile for the given path, raises CreateArchiveFail"
+        if self.size < 1:
+            return ArchiveFile(filepath)
+        key = self._key(filepath)
+        try:
+            st = os.stat(filepath)
+            stamp = (st.st_size, st.st_mtime)
+        except OSError:
+            stamp = None
+        with self._lock:
+            pooled = self._archives.get(key)
+            if pooled:
+                if pooled[0] == stamp:
+                    self._archives.move_to_end(key)
+                    archive = pooled[1]
+                    self._refs[archive] += 1
+                    return archive
+                self._remove(key)
+
+        archive = ArchiveFile(filepath)
+        with self._lock:
+            if key in self._archives: # another thread beat us to it
+                return archive
+            archive._pool = self
+            self._archives[key] = (stamp, archive)
+            self._refs[archive] = 1
+            while len(self._archives) > self.size:
+                self._remove(next(iter(self._archives)))
+        return archive
+
+    def release(self, archive):
+        "Called by ArchiveFile.close"
+        with self._lock:
+            if archive in self._refs:
+                self._refs[archive] -= 1
+                if self._refs[archive] <= 0 and archive._evicted:
+                    self._close(archive)
+
+    def _close(self, archive):
+        self._refs.pop(archive, None)
+        archive._pool = None
+        archive.archive.close()
+
+    def _remove(self, key):
+        "Removes archive from pool, the archive is closed when no one is using it anymore"
+        _, archive = self._archives.pop(key)
+        archive._evicted = True
+        if self._refs.get(archive, 0) <= 0:
+            self._close(archive)
+
+    def discard(self, path):
+        "Removes the archive with the given path, or all archives inside the given directory"
+        with self._lock:
+            key = self._key(path)
+            for k in [x for x in self._archives if x == key or x.startswith(os.path.join(key, ''))]:
+                self._remove(k)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._archives):
+                self._remove(key)
+
+ARCHIVE_POOL = ArchivePool(app_constants.ARCHIVE_POOL_SIZE)
+
+def open_archive(filepath):
+    "Returns a pooled ArchiveFile for the given path, raises CreateArchiveFail"
+    return ARCHIVE_POOL.get(filepath)
+
+class ExtractionCache:
+    """
+    Keeps extracted chapters around in the temp folder so that reopening a chapter
+    doesn't extract it again. Entries are keyed by (archive path, mtime, path in archive)
+    and the least recently used are removed when the total size goes above the budget.
+    extract -> returns path to the extracted chapter, only the first page is extracted
+        before returning, the rest is extracted in the background. Chapters without
+        pages in their top folder are fully extracted before returning
+    wait <- blocks until the given chapter has been fully extracted
+    clear <- removes all extractions
+    """
+    def __init__(self, budget=1024):
+        self.budget = budget*1024*1024 # MB to bytes
+        self._entries = collections.OrderedDict() # key -> [chapter path, size, done event, folder]
+        self._lock = threading.RLock()
+
+    @property
+    def root(self):
+        return os.path.join(app_constants.temp_dir, 'chapters')
+
+    @property
+    def total_size(self):
+        with self._lock:
+            return sum(e[1] for e in self._entries.values())
+
+    @staticmethod
+    def _key(archive_path, chapter_path):
+        return (os.path.normcase(os.path.abspath(archive_path)), os.stat(archive_path).st_mtime, chapter_path)
+
+    def extract(self, archive_path, chapter_path=''):
+        """
+        Returns path to the extracted chapter_path ('' means the whole archive).
+        Raises CreateArchiveFail
+        """
+        key = self._key(archive_path, chapter_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and os.path.exists(entry[0]):
+                self._entries.move_to_end(key)
+                log_d('Reusing extracted chapter {}'.format(entry[0].encode(errors='ignore')))
+                return entry[0]
+            elif entry:
+                TEMP_MANAGER.release(self._entries.pop(key)[3])
+
+        folder = os.path.join(self.root, str(uuid.uuid4()))
+        os.makedirs(folder)
+        try:
+            zip = open_archive(archive_path)
+        except Exception:
+            TEMP_MANAGER.release(folder)
+            raise
+        try:
+            members = [n for n in zip.namelist() if n.startswith(chapter_path) and n != chapter_path]
+            pages = sorted([x for x in zip.dir_contents(chapter_path) if x.lower().endswith(IMG_FILES)\
+                and not x.startswith('.')])
+            if pages: # the first page goes first so the viewer can start right away
+                zip.extract_member(pages[0], folder)
+                members.remove(pages[0])
+            dirs = set(n for n in members if zip.is_dir(n))
+            files = [n for n in members if n not in dirs]
+        except Exception:
+            zip.close()
+            TEMP_MANAGER.release(folder)
+            raise
+        entry = [os.path.normpath(os.path.join(folder, chapter_path)), 0, threading.Event(), folder]
+        with self._lock:
+            other = self._entries.get(key)
+            if other and os.path.exists(other[0]): # extracted by another call in the meantime
+                zip.close()
+                TEMP_MANAGER.release(folder)
+                self._entries.move_to_end(key)
+                return other[0]
+            elif other:
+                TEMP_MANAGER.release(other[3])
+            self._entries[key] = entry
+
+        def extract_rest():
+            failed = False
+            try:
+                for d in dirs:
+                    os.makedirs(os.path.join(folder, d), exist_ok=True)
+                for f in files:
+                    zip.extract_member(f, folder)
+            except Exception:
+                log.exception('Could not extract {}'.format(archive_path.encode(errors='ignore')))
+                failed = True
+            finally:
+                zip.close()
+            size = 0 if failed else dir_size(folder)
+            with self._lock:
+                if failed: # a partial extraction must not be reused
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                    TEMP_MANAGER.release(folder)
+                else:
+                    entry[1] = size
+                    self._evict(key)
+                entry[2].set()
+
+        if not pages: # nothing to show yet, the returned path may not even exist
+            extract_rest()
+            if not os.path.exists(entry[0]):
+                raise app_constants.CreateArchiveFail
+            return entry[0]
+        threading.Thread(target=extract_rest, name='chapter extraction', daemon=True).start()
+        return entry[0]
+
+    def wait(self, archive_path, chapter_path='', timeout=None):
+        with self._lock:
+            entry = self._entries.get(self._key(archive_path, chapter_path))
+        if entry:
+            entry[2].wait(timeout)
+
+    def _evict(self, keep):
+        "Removes least recently used extractions until below budget, never the one in keep"
+        while self.total_size > self.budget:
+            key = next((k for k, e in self._entries.items() if k != keep and e[2].is_set()), None)
+            if key is None:
+                break
+            folder = self._entries.pop(key)[3]
+            log_d('Removing extracted chapter {}'.format(folder.encode(errors='ignore')))
+            TEMP_MANAGER.release(folder)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                if self._entries[key][2].is_set():
+                    TEMP_MANAGER.release(self._entries.pop(key)[3])
+
+EXTRACTION_CACHE = ExtractionCache(app_constants.EXTRACTION_CACHE_SIZE)
+
+def _list_archive(zip):
+    "Builds the listing of an opened archive, see caches.ArchiveListingCache"
     galleries = []
     zip_dirs = zip.dir_list()
     def gallery_eval(d):
@@ -561,13 +954,77 @@ def check_archive(archive_path):
             r = gallery_eval(d)
             if r:
                 galleries.append(r)
-        zip.close()
     else: # all pages are in top folder
         if isinstance(gallery_eval(''), str):
             galleries.append('')
-        zip.close()
 
-    return galleries
+    names = zip.namelist()
+    imgs = sorted([img for img in names if img.lower().endswith(IMG_FILES) and not img.startswith('.')])
+    listing = {'names':names, 'galleries':galleries, 'pages':{}, 'first_img':{}, 'metafiles':{},
+            'cover':imgs[0] if imgs else None}
+    for g in galleries:
+        con = zip.dir_contents(g)
+        imgs = sorted([img for img in con if img.lower().endswith(IMG_FILES) and not img.startswith('.')])
+        listing['pages'][g] = len([x for x in con if x.endswith(IMG_FILES)])
+        listing['first_img'][g] = imgs[0] if imgs else None
+        listing['metafiles'][g] = [x for x in con if x.endswith(app_constants.GALLERY_METAFILE_KEYWORDS)]
+    return listing
+
+def archive_listing(archive_path):
+    """
+    Returns the listing of an archive (see caches.ArchiveListingCache).
+    The archive is only opened when it has changed since it was last listed.
+    Raises CreateArchiveFail
+    """
+    listing = caches.ARCHIVE_LISTING_CACHE.get(archive_path)
+    if listing is None:
+        zip = open_archive(archive_path)
+        try:
+            listing = _list_archive(zip)
+        finally:
+            zip.close()
+        caches.ARCHIVE_LISTING_CACHE.put(archive_path, listing)
+    return listing
+
+def scan_archive(archive_path, galleries=None):
+    """
+    Lists an archive and parses the metafiles of its galleries in one go.
+    Only the metafiles of the given paths in archive are parsed if galleries is provided.
+    The archive is opened at most once, and only if it changed since it was
+    last listed or if it has metafiles.
+    Returns a tuple of (listing, dict of gallery path -> GMetafile)
+    Raises CreateArchiveFail
+    """
+    zip = None
+    try:
+        listing = caches.ARCHIVE_LISTING_CACHE.get(archive_path)
+        if listing is None:
+            zip = open_archive(archive_path)
+            listing = _list_archive(zip)
+            caches.ARCHIVE_LISTING_CACHE.put(archive_path, listing)
+        metafiles = {}
+        for g in listing['galleries'] if galleries is None else galleries:
+            if listing['metafiles'].get(g, True):
+                if not zip:
+                    zip = open_archive(archive_path)
+                metafiles[g] = GMetafile(g, zip)
+            else:
+                metafiles[g] = GMetafile()
+        return listing, metafiles
+    finally:
+        if zip:
+            zip.close()
+
+def check_archive(archive_path):
+    """
+    Checks archive path for potential galleries.
+    Returns a list with a path in archive to galleries
+    if there is no directories
+    """
+    try:
+        return list(archive_listing(archive_path)['galleries'])
+    except app_constants.CreateArchiveFail:
+        return []
 
 def recursive_gallery_check(path):
     """
@@ -622,6 +1079,43 @@ def external_viewer_checker(path):
         if allow:
             return x
 
+def chapter_source(chapterpath, archive=None):
+    """
+    Returns a tuple of (archive path, path in archive) which needs to be extracted
+    to read the given chapter, or None if it's not in an archive
+    """
+    if archive or chapterpath.endswith(ARCHIVE_FILES):
+        if os.path.isdir(chapterpath):
+            return None
+        elif chapterpath.endswith(ARCHIVE_FILES):
+            zip = open_archive(chapterpath)
+            f_d = sorted(zip.dir_list(True))
+            zip.close()
+            return chapterpath, f_d[0] if f_d else ''
+        return archive, chapterpath
+    elif os.path.isdir(chapterpath):
+        return None
+    return chapterpath, '' # Compatibility reasons..  TODO: REMOVE IN BETA
+
+def prefetch_chapter(chapterpath, archive=None):
+    """
+    Extracts the given chapter into the extraction cache ahead of time,
+    so that opening it later doesn't have to wait.
+    Nothing is done if the chapter won't be extracted when opened or the cache is full
+    """
+    if not app_constants.EXTRACT_CHAPTER_BEFORE_OPENING and app_constants.EXTERNAL_VIEWER_PATH:
+        return
+    if EXTRACTION_CACHE.total_size >= EXTRACTION_CACHE.budget:
+        log_d('Extraction cache is full, not prefetching chapter')
+        return
+    try:
+        source = chapter_source(chapterpath, archive)
+        if source:
+            log_d('Prefetching chapter {}'.format(str(source).encode(errors='ignore')))
+            EXTRACTION_CACHE.extract(*source)
+    except (app_constants.CreateArchiveFail, OSError):
+        log.exception('Could not prefetch chapter')
+
 def open_chapter(chapterpath, archive=None):
     is_archive = True if archive else False
     if not is_archive:
@@ -649,26 +1143,10 @@ def open_chapter(chapterpath, archive=None):
         return temp_p if send_folder else filepath
 
     def find_f_img_archive(extract=True):
-        zip = ArchiveFile(temp_p)
         if extract:
             app_constants.NOTIF_BAR.add_text('Extracting...')
-            t_p = os.path.join('temp', str(uuid.uuid4()))
-            os.mkdir(t_p)
-            if is_archive or chapterpath.endswith(ARCHIVE_FILES):
-                if os.path.isdir(chapterpath):
-                    t_p = chapterpath
-                elif chapterpath.endswith(ARCHIVE_FILES):
-                    zip2 = ArchiveFile(chapterpath)
-                    f_d = sorted(zip2.dir_list(True))
-                    if f_d:
-                        f_d = f_d[0]
-                        t_p = zip2.extract(f_d, t_p)
-                    else:
-                        t_p = zip2.extract('', t_p)
-                else:
-                    t_p = zip.extract(chapterpath, t_p)
-            else:
-                zip.extract_all(t_p) # Compatibility reasons..  TODO: REMOVE IN BETA
+            source = chapter_source(chapterpath, archive)
+            t_p = EXTRACTION_CACHE.extract(*source) if source else chapterpath
             if send_folder:
                 filepath = t_p
             else:
@@ -677,7 +1155,9 @@ def open_chapter(chapterpath, archive=None):
                 filepath = os.path.abspath(filepath)
         else:
             if is_archive or chapterpath.endswith(ARCHIVE_FILES):
+                zip = open_archive(temp_p)
                 con = zip.dir_contents('')
+                zip.close()
                 f_img = [x for x in sorted(con) if x.lower().endswith(IMG_FILES) and not x.startswith('.')]
                 if not f_img:
                     log_w('Extracting archive.. There are no images in the top-folder. ({})'.format(archive))
@@ -769,14 +1249,17 @@ def get_gallery_img(gallery_or_path, chap_number=0):
     if is_archive:
         try:
             log_i('Getting image from archive')
-            zip = ArchiveFile(real_path)
-            temp_path = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
-            os.mkdir(temp_path)
+            listing = archive_listing(real_path)
+            zip = open_archive(real_path)
+            temp_path = TEMP_MANAGER.allocate()
             if not archive:
-                f_img_name = sorted([img for img in zip.namelist() if img.lower().endswith(IMG_FILES) and not img.startswith('.')])[0]
+                f_img_name = listing['cover']
+            elif path in listing['first_img']:
+                f_img_name = listing['first_img'][path]
             else:
                 f_img_name = sorted([img for img in zip.dir_contents(path) if img.lower().endswith(IMG_FILES) and not img.startswith('.')])[0]
             img_path = zip.extract(f_img_name, temp_path)
+            TEMP_MANAGER.account(temp_path)
             zip.close()
         except app_constants.CreateArchiveFail:
             img_path = app_constants.NO_IMAGE_PATH
@@ -923,58 +1406,87 @@ def tag_to_dict(string, ns_capitalize=True):
     return namespace_tags
 
 import re as regex
-def title_parser(title):
-    "Receives a title to parse. Returns dict with 'title', 'artist' and language"
-    log_d("Parsing title: {}".format(title))
-    title = " ".join(title.split())
-    if '/' in title:
-        try:
+class TitleNormalizer:
+    """
+    Parses gallery titles and fixes gallery text.
+    The patterns, the set of languages and the text fixer regex are compiled once
+    from the settings, rebuild must be called when they change.
+    Parsed titles are memoized.
+    parse_title -> returns dict with 'title', 'artist' and 'language'
+    fix_gallery -> applies the text fixer to gallery, returns None if there is no valid fix regex
+    rebuild <- recompiles from the current settings and clears the memo
+    """
+    _brackets = regex.compile(r'((?<=\[) *[^\]]+( +\S+)* *(?=\]))')
+
+    def __init__(self, memo_size=4096):
+        self.memo_size = memo_size
+        self.rebuild()
+
+    def rebuild(self):
+        self.languages = frozenset(app_constants.G_LANGUAGES + app_constants.G_CUSTOM_LANGUAGES)
+        self.default_language = app_constants.G_DEF_LANGUAGE
+        self.fix_regex = None
+        if app_constants.GALLERY_DATA_FIX_REGEX:
+            try:
+                self.fix_regex = regex.compile(app_constants.GALLERY_DATA_FIX_REGEX)
+            except regex.error:
+                log_w('Invalid gallery text fixer regex')
+        self.fix_replace = app_constants.GALLERY_DATA_FIX_REPLACE
+        self.fix_title = app_constants.GALLERY_DATA_FIX_TITLE
+        self.fix_artist = app_constants.GALLERY_DATA_FIX_ARTIST
+        self._parse = functools.lru_cache(self.memo_size)(self._parse_title)
+
+    def parse_title(self, title):
+        # a copy, callers are free to modify it
+        return dict(self._parse(title))
+
+    def _parse_title(self, title):
+        log_d("Parsing title: {}".format(title))
+        title = " ".join(title.split())
+        if '/' in title:
             title = os.path.split(title)[1]
-            if not title:
-                title = title
-        except IndexError:
-            pass
 
-    for x in ARCHIVE_FILES:
-        if title.endswith(x):
-            title = title[:-len(x)]
+        for x in ARCHIVE_FILES:
+            if title.endswith(x):
+                title = title[:-len(x)]
 
-    parsed_title = {'title':"", 'artist':"", 'language':""}
-    try:
-        a = regex.findall('((?<=\[) *[^\]]+( +\S+)* *(?=\]))', title)
-        assert len(a) != 0
-        try:
-            artist = a[0][0].strip()
-        except IndexError:
-            artist = ''
-        parsed_title['artist'] = artist
+        parsed_title = {'title':"", 'artist':"", 'language':""}
+        a = self._brackets.findall(title)
+        if not a:
+            parsed_title['title'] = title
+            return parsed_title
 
-        try:
-            assert a[1]
-            lang = app_constants.G_LANGUAGES + app_constants.G_CUSTOM_LANGUAGES
+        parsed_title['artist'] = a[0][0].strip()
+        parsed_title['language'] = self.default_language
+        if len(a) > 1:
             for x in a:
-                l = x[0].strip()
-                l = l.lower()
-                l = l.capitalize()
-                if l in lang:
+                l = x[0].strip().lower().capitalize()
+                if l in self.languages:
                     parsed_title['language'] = l
                     break
-            else:
-                parsed_title['language'] = app_constants.G_DEF_LANGUAGE
-        except IndexError:
-            parsed_title['language'] = app_constants.G_DEF_LANGUAGE
 
         t = title
         for x in a:
             t = t.replace(x[0], '')
 
         t = t.replace('[]', '')
-        final_title = t.strip()
-        parsed_title['title'] = final_title
-    except AssertionError:
-        parsed_title['title'] = title
+        parsed_title['title'] = t.strip()
+        return parsed_title
 
-    return parsed_title
+    def fix_gallery(self, gallery):
+        if not self.fix_regex:
+            return None
+        if self.fix_title:
+            gallery.title = self.fix_regex.sub(self.fix_replace, gallery.title)
+        if self.fix_artist:
+            gallery.artist = self.fix_regex.sub(self.fix_replace, gallery.artist)
+        return gallery
+
+TITLE_NORMALIZER = TitleNormalizer()
+
+def title_parser(title):
+    "Receives a title to parse. Returns dict with 'title', 'artist' and language"
+    return TITLE_NORMALIZER.parse_title(title)
 
 import webbrowser
 def open_web_link(url):
@@ -1014,6 +1526,8 @@ def delete_path(path):
     "Deletes the provided recursively"
     s = True
     if os.path.exists(path):
+        ARCHIVE_POOL.discard(path)
+        caches.ARCHIVE_LISTING_CACHE.invalidate(path)
         error = ''
         if app_constants.SEND_FILES_TO_TRASH:
             try:
@@ -1160,6 +1674,81 @@ def image_greyscale(filepath):
             return False
     return True
 
+def sample_pages(pages, count=4):
+    "Returns a list of count page numbers spread evenly over the given amount of pages"
+    p = []
+    if pages < count+1:
+        for x in range(pages):
+            p.append(x)
+    else:
+        x = 0
+        i = pages//count
+        for t in range(count):
+            x += i
+            p.append(x-1)
+    return p
+
+def image_dhash(fp, size=8):
+    """
+    Generates a perceptual difference hash (dHash) of the given image path or file object.
+    Returns a size*size bit integer, similar images have a small hamming distance
+    """
+    im = Image.open(fp)
+    im.draft('L', (size*8, size*8)) # lets jpeg decode at a lower resolution
+    im = im.convert('L').resize((size+1, size), Image.LANCZOS)
+    if numpy:
+        px = numpy.asarray(im, dtype=numpy.int16)
+        bits = px[:, 1:] > px[:, :-1]
+        return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+    px = list(im.getdata())
+    h = 0
+    for row in range(size):
+        for col in range(size):
+            h = (h << 1) | (px[row*(size+1)+col+1] > px[row*(size+1)+col])
+    return h
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """
+    A BK-tree for finding values within a hamming distance.
+    add <- adds a value with an item attached to it
+    search -> returns a list of (distance, item) for values within the given distance
+    """
+    def __init__(self, distance=hamming_distance):
+        self._distance = distance
+        self._root = None # [value, items, {distance: child node}]
+
+    def add(self, value, item):
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = self._distance(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        found = []
+        nodes = [self._root] if self._root else []
+        while nodes:
+            node = nodes.pop()
+            d = self._distance(value, node[0])
+            if d <= max_distance:
+                found.extend((d, i) for i in node[1])
+            for cd, child in node[2].items():
+                if d - max_distance <= cd <= d + max_distance:
+                    nodes.append(child)
+        return found
+
 def PToQImageHelper(im):
     """
     The Python Imaging Library (PIL) is
@@ -1278,15 +1867,19 @@ def make_chapters(gallery_object):
         if path.endswith(ARCHIVE_FILES):
             gallery_object.is_archive = 1
             log_i("Gallery source is an archive")
-            archive_g = sorted(check_archive(path))
-            for g in archive_g:
-                chap = chap_container.create_chapter()
-                chap.path = g
-                chap.in_archive = 1
-                metafile.update(GMetafile(g, path))
-                arch = ArchiveFile(path)
-                chap.pages = len(arch.dir_contents(g))
-                arch.close()
+            try:
+                listing, metafiles = scan_archive(path)
+            except app_constants.CreateArchiveFail:
+                listing, metafiles = None, {}
+            archive_g = sorted(listing['galleries']) if listing else []
+            if archive_g:
+                pages = listing['pages']
+                for g in archive_g:
+                    chap = chap_container.create_chapter()
+                    chap.path = g
+                    chap.in_archive = 1
+                    metafile.update(metafiles[g])
+                    chap.pages = pages[g]
 
     metafile.apply_gallery(gallery_object)
 